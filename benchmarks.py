@@ -0,0 +1,810 @@
+"""Micro-benchmarks for micromodels.
+
+Run ``python benchmarks.py`` to run every benchmark, or pass the names of
+the ones to run, e.g. ``python benchmarks.py from_dict``. The script exits
+with an error when a benchmark exceeds its budget, such as ``import_time``.
+
+"""
+import base64
+import cPickle
+import datetime
+import gc
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import micromodels
+from micromodels import backends
+
+
+class TwitterUser(micromodels.Model):
+    id = micromodels.IntegerField()
+    screen_name = micromodels.CharField()
+    name = micromodels.CharField()
+    description = micromodels.CharField()
+    location = micromodels.CharField()
+    followers_count = micromodels.IntegerField()
+    verified = micromodels.BooleanField()
+
+
+class Tweet(micromodels.Model):
+    id = micromodels.IntegerField()
+    id_str = micromodels.CharField()
+    text = micromodels.CharField()
+    source = micromodels.CharField()
+    lang = micromodels.CharField()
+    created_at = micromodels.DateTimeField(
+        format="%a %b %d %H:%M:%S +0000 %Y",
+        serial_format="%a %b %d %H:%M:%S +0000 %Y")
+    truncated = micromodels.BooleanField()
+    favorited = micromodels.BooleanField()
+    retweeted = micromodels.BooleanField()
+    retweet_count = micromodels.IntegerField()
+    favorite_count = micromodels.IntegerField()
+    reply_count = micromodels.IntegerField()
+    in_reply_to_status_id = micromodels.IntegerField(null=True)
+    in_reply_to_user_id = micromodels.IntegerField(null=True)
+    in_reply_to_screen_name = micromodels.CharField(null=True)
+    possibly_sensitive = micromodels.BooleanField()
+    latitude = micromodels.FloatField(null=True)
+    longitude = micromodels.FloatField(null=True)
+    hashtags = micromodels.FieldCollectionField(micromodels.CharField())
+    user = micromodels.ModelField(TwitterUser)
+
+
+CompactTwitterUser = type('CompactTwitterUser', (micromodels.Model,),
+                          dict(TwitterUser._clsfields, _compact=True))
+CompactTweet = type('CompactTweet', (micromodels.Model,),
+                    dict(Tweet._clsfields, _compact=True,
+                         user=micromodels.ModelField(CompactTwitterUser)))
+
+
+def make_tweet(i):
+    return {
+        'id': 20 + i,
+        'id_str': str(20 + i),
+        'text': 'just setting up my twttr #%d' % i,
+        'source': 'web',
+        'lang': 'en',
+        'created_at': 'Tue Mar 21 20:50:14 +0000 2006',
+        'truncated': False,
+        'favorited': False,
+        'retweeted': False,
+        'retweet_count': i % 100,
+        'favorite_count': i % 50,
+        'reply_count': i % 7,
+        'in_reply_to_status_id': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_screen_name': None,
+        'possibly_sensitive': 'false',
+        'latitude': 37.78,
+        'longitude': -122.39,
+        'hashtags': ['twttr', 'first'],
+        'user': {
+            'id': 12 + i % 1000,
+            'screen_name': 'jack',
+            'name': 'Jack Dorsey',
+            'description': 'CEO',
+            'location': 'San Francisco',
+            'followers_count': 4000000,
+            'verified': True,
+        },
+    }
+
+
+BENCHMARKS = []
+
+#: Names of the benchmarks which exceeded their budget.
+FAILED = []
+
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+
+def best_of(func, number, repeat=3):
+    """Returns the best time of one call to ``func``, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def report(label, seconds, baseline=None):
+    line = '  %-40s %10.2f us' % (label, seconds * 1e6)
+    if baseline:
+        line += '  (%.2fx)' % (baseline / seconds)
+    print line
+
+
+@benchmark
+def from_dict():
+    """Decoding a 20-field tweet: generated decoder vs. __init__ + set_data"""
+    data = make_tweet(0)
+
+    def legacy():
+        instance = Tweet()
+        instance.set_data(data)
+
+    baseline = best_of(legacy, 2000)
+    report('Tweet() + set_data()', baseline)
+    report('Tweet.from_dict()', best_of(lambda: Tweet.from_dict(data), 2000),
+           baseline)
+
+
+@benchmark
+def serialize():
+    """Serializing a 20-field tweet: generic vs. generated serializers"""
+    tweet = Tweet.from_dict(make_tweet(0))
+
+    def generic():
+        return dict((key, field.to_serial(getattr(tweet, key)))
+                    for key, field in tweet._fields.iteritems()
+                    if hasattr(tweet, key))
+
+    baseline = best_of(generic, 2000)
+    report('generic to_dict(serial=True)', baseline)
+    report('tweet.to_dict(serial=True)',
+           best_of(lambda: tweet.to_dict(serial=True), 2000), baseline)
+    for name in backends.available():
+        encode = backends.get(name).encode
+        baseline = best_of(lambda: encode(generic()), 2000)
+        report('%s, encode(generic to_dict)' % name, baseline)
+        report('%s, tweet.to_json()' % name,
+               best_of(lambda: tweet.to_json(name), 2000), baseline)
+        report('%s, tweet.to_json(direct=True)' % name,
+               best_of(lambda: tweet.to_json(name, direct=True), 2000),
+               baseline)
+
+
+@benchmark
+def bulk():
+    """Throughput of from_dicts/to_dicts vs. one call per row, 10000 tweets"""
+    rows = [make_tweet(i) for i in range(10000)]
+
+    def throughput(label, func, baseline=None):
+        seconds = best_of(func, 1)
+        print '  %-40s %10d rows/s%s' % (
+            label, len(rows) / seconds,
+            '  (%.2fx)' % (baseline / seconds) if baseline else '')
+        return seconds
+
+    def legacy(row):
+        instance = Tweet()
+        instance.set_data(row)
+        return instance
+
+    baseline = throughput('[Tweet() + set_data(row) ...]',
+                          lambda: [legacy(row) for row in rows])
+    throughput('[Tweet.from_dict(row) ...]',
+               lambda: [Tweet.from_dict(row) for row in rows], baseline)
+    throughput('Tweet.from_dicts(rows)', lambda: Tweet.from_dicts(rows),
+               baseline)
+    tweets = Tweet.from_dicts(rows)
+    baseline = throughput('[tweet.to_dict(serial=True) ...]',
+                          lambda: [t.to_dict(serial=True) for t in tweets])
+    throughput('Tweet.to_dicts(tweets, serial=True)',
+               lambda: Tweet.to_dicts(tweets, serial=True), baseline)
+
+
+@benchmark
+def batch():
+    """Columnar ModelBatch vs. a list of models, 10000 tweets"""
+    rows = [make_tweet(i) for i in range(10000)]
+    baseline = best_of(lambda: Tweet.from_dicts(rows), 1)
+    report('Tweet.from_dicts(rows)', baseline)
+    report('ModelBatch(Tweet, rows)',
+           best_of(lambda: micromodels.ModelBatch(Tweet, rows), 1), baseline)
+    tweets = Tweet.from_dicts(rows)
+    columns = micromodels.ModelBatch(Tweet, rows).columns
+    baseline = best_of(lambda: sum(t.retweet_count for t in tweets), 10)
+    report('sum of retweet_count over models', baseline)
+    report('sum of retweet_count column',
+           best_of(lambda: sum(columns['retweet_count']), 10), baseline)
+    print '  %-40s %7d bytes' % ('retweet_count column',
+                                 sys.getsizeof(columns['retweet_count']))
+
+
+def write_tweets(fileobj, count):
+    """Writes a ``{"statuses": [...]}`` document of ``count`` tweets."""
+    fileobj.write('{"statuses": [')
+    for i in xrange(count):
+        if i:
+            fileobj.write(',')
+        fileobj.write(json.dumps(make_tweet(i)))
+    fileobj.write(']}')
+
+
+def peak_rss(func):
+    """Runs ``func`` in a child process and returns its peak RSS in KB."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_end)
+        func()
+        os.write(write_end, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        os._exit(0)
+    os.close(write_end)
+    result = os.read(read_end, 64)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+@benchmark
+def iter_json():
+    """Peak RSS decoding growing JSON documents, loaded vs. streamed"""
+    def drain(iterable):
+        for instance in iterable:
+            pass
+
+    for count in (5000, 20000, 80000):
+        with tempfile.TemporaryFile() as fileobj:
+            write_tweets(fileobj, count)
+            size = fileobj.tell()
+
+            def load():
+                fileobj.seek(0)
+                drain(Tweet.from_dicts(json.load(fileobj)['statuses']))
+
+            def stream():
+                fileobj.seek(0)
+                drain(Tweet.iter_json(fileobj, path='statuses'))
+
+            print '  %6d tweets (%5.1f MB): %7d KB loaded, %7d KB streamed' % (
+                count, size / 1e6, peak_rss(load), peak_rss(stream))
+
+
+@benchmark
+def jsonl():
+    """JSON Lines I/O of 10000 tweets, hand-rolled vs. read/write_jsonl"""
+    tweets = Tweet.from_dicts(make_tweet(i) for i in range(10000))
+    with tempfile.TemporaryFile() as fileobj:
+        def write_by_line():
+            fileobj.seek(0)
+            for tweet in tweets:
+                fileobj.write(tweet.to_json() + '\n')
+            fileobj.truncate()
+
+        def write_jsonl(compress=False):
+            fileobj.seek(0)
+            Tweet.write_jsonl(fileobj, tweets, compress=compress)
+            fileobj.truncate()
+
+        def read_by_line():
+            fileobj.seek(0)
+            for line in fileobj:
+                instance = Tweet()
+                instance.loads(line)
+
+        def read_jsonl():
+            fileobj.seek(0)
+            for instance in Tweet.read_jsonl(fileobj):
+                pass
+
+        baseline = best_of(write_by_line, 1)
+        report('write to_json() line by line', baseline)
+        report('Tweet.write_jsonl()', best_of(write_jsonl, 1), baseline)
+        baseline = best_of(read_by_line, 1)
+        report('read lines with Tweet().loads()', baseline)
+        report('Tweet.read_jsonl()', best_of(read_jsonl, 1), baseline)
+        report('Tweet.write_jsonl(compress=True)',
+               best_of(lambda: write_jsonl(compress=True), 1))
+        report('Tweet.read_jsonl() from gzip', best_of(read_jsonl, 1))
+
+
+@benchmark
+def parallel():
+    """from_json_many/to_json_many of 20000 tweets, 1 to N processes"""
+    lines = [json.dumps(make_tweet(i)) for i in range(20000)]
+    tweets = Tweet.from_dicts(make_tweet(i) for i in range(20000))
+    counts = sorted(set([1, 2, 4, 8, multiprocessing.cpu_count()]))
+    for label, func in (('decode', Tweet.from_json_many),
+                        ('encode', Tweet.to_json_many)):
+        items = lines if label == 'decode' else tweets
+        baseline = None
+        for workers in counts:
+            if workers > multiprocessing.cpu_count():
+                continue
+            seconds = best_of(lambda: func(items, workers=workers), 1, repeat=1)
+            report('%s, %d process(es)' % (label, workers), seconds, baseline)
+            baseline = baseline or seconds
+
+
+@benchmark
+def json_backends():
+    """Encoding and decoding typical payloads with each JSON backend"""
+    payloads = [
+        ('tweet', make_tweet(0)),
+        ('1000 integers', range(1000)),
+        ('100 long strings', ['lorem ipsum dolor sit amet ' * 40] * 100),
+    ]
+    for label, payload in payloads:
+        data = backends.encode(payload, 'json')
+        baseline = {}
+        for name in backends.available():
+            backend = backends.get(name)
+            for operation, func, arg in (('encode', backend.encode, payload),
+                                         ('decode', backend.decode, data)):
+                seconds = best_of(lambda: func(arg), 200)
+                report('%s, %s %s' % (name, operation, label), seconds,
+                       baseline.get(operation))
+                baseline.setdefault(operation, seconds)
+
+
+@benchmark
+def binary():
+    """Size and speed of to_binary() vs. the former pickle + base64 format"""
+    tweet = Tweet.from_dict(make_tweet(0))
+    pickled = base64.b64encode(cPickle.dumps(tweet))
+    for label, data in (('pickle + base64', pickled),
+                        ('to_binary()', tweet.to_binary()),
+                        ('to_binary(raw=True)', tweet.to_binary(raw=True))):
+        print '  %-40s %7d bytes' % (label, len(data))
+
+    def load_pickle():
+        restored = Tweet()
+        data = cPickle.loads(base64.b64decode(pickled))
+        for name in Tweet._clsfields:
+            object.__setattr__(restored, name, getattr(data, name))
+
+    data = tweet.to_binary(raw=True)
+    baseline = best_of(lambda: base64.b64encode(cPickle.dumps(tweet)), 2000)
+    report('dump with pickle + base64', baseline)
+    report('to_binary(raw=True)',
+           best_of(lambda: tweet.to_binary(raw=True), 2000), baseline)
+    baseline = best_of(load_pickle, 2000)
+    report('load with pickle + base64', baseline)
+    report('loads(raw binary)',
+           best_of(lambda: Tweet().loads(data, binary=True), 2000), baseline)
+    report('Tweet.from_binary(raw binary)',
+           best_of(lambda: Tweet.from_binary(data), 2000), baseline)
+
+
+@benchmark
+def records():
+    """Random access to 50000 tweets in a record file vs. a JSON Lines file"""
+    tweets = Tweet.from_dicts(make_tweet(i) for i in range(50000))
+    directory = tempfile.mkdtemp()
+    try:
+        jsonl_path = os.path.join(directory, 'tweets.jsonl')
+        records_path = os.path.join(directory, 'tweets.rec')
+        Tweet.write_jsonl(jsonl_path, tweets)
+        report('Tweet.write_records()',
+               best_of(lambda: Tweet.write_records(records_path, tweets), 1,
+                       repeat=1))
+        print '  %-40s %7.1f MB' % ('JSON Lines file',
+                                    os.path.getsize(jsonl_path) / 1e6)
+        print '  %-40s %7.1f MB' % ('record file',
+                                    os.path.getsize(records_path) / 1e6)
+        positions = [random.randrange(len(tweets)) for _ in range(100)]
+
+        def scan():
+            wanted = set(positions)
+            for position, tweet in enumerate(Tweet.read_jsonl(jsonl_path)):
+                if position in wanted:
+                    pass
+
+        def lookup():
+            with Tweet.open_records(records_path) as records:
+                for position in positions:
+                    records[position]
+
+        baseline = best_of(scan, 1, repeat=1)
+        report('100 lookups scanning the JSON Lines', baseline)
+        report('100 lookups in the record file', best_of(lookup, 1), baseline)
+        with Tweet.open_records(records_path) as records:
+            report('one record', best_of(lambda: records[31337], 2000))
+    finally:
+        shutil.rmtree(directory)
+
+
+class Timeline(micromodels.Model):
+    name = micromodels.CharField()
+    tweets = micromodels.ModelCollectionField(Tweet)
+
+
+@benchmark
+def dump_json():
+    """Peak RSS writing a timeline of N tweets: to_json() vs. dump_json()"""
+    for count in (5000, 20000, 80000):
+        timeline = Timeline.from_dict({'name': 'home', 'tweets': [
+            make_tweet(i) for i in xrange(count)]})
+        baseline = peak_rss(lambda: None)
+
+        def to_json():
+            with open(os.devnull, 'wb') as fileobj:
+                fileobj.write(timeline.to_json())
+
+        def dump():
+            with open(os.devnull, 'wb') as fileobj:
+                timeline.dump_json(fileobj)
+
+        print '  %6d tweets: %7d KB more with to_json(), %7d KB with dump_json()' % (
+            count, peak_rss(to_json) - baseline, peak_rss(dump) - baseline)
+
+
+@benchmark
+def dates():
+    """Parsing timestamps: strptime vs. compiled parsers vs. memoized"""
+    from micromodels.dates import compile_parser, memoize
+    for format, string in (('%Y-%m-%dT%H:%M:%S', '2011-01-30T12:34:56'),
+                           ('%a %b %d %H:%M:%S +0000 %Y',
+                            'Tue Mar 21 20:50:14 +0000 2006'),
+                           ('%Y-%m-%d %H:%M:%S.%f', '2011-1-30 12:34:56.789'),
+                           ('%Y-%m-%d', '2011-01-30')):
+        parse = compile_parser(format)
+        cached = memoize(parse, 1024)
+        strptime = datetime.datetime.strptime
+        baseline = best_of(lambda: strptime(string, format), 20000)
+        report('strptime %r' % string, baseline)
+        report('compiled parser', best_of(lambda: parse(string), 20000),
+               baseline)
+        report('memoized parser', best_of(lambda: cached(string), 20000),
+               baseline)
+    date_parse = compile_parser('%Y-%m-%d', datetime.date)
+    baseline = best_of(lambda: strptime('2011-01-30', '%Y-%m-%d').date(),
+                       20000)
+    report('strptime(...).date()', baseline)
+    report('compiled date parser', best_of(lambda: date_parse('2011-01-30'),
+                                            20000), baseline)
+
+
+@benchmark
+def mx_fields():
+    """Per-value conversion of MXDateTimeField and MXTimeDeltaField"""
+    try:
+        from mx.DateTime import DateTimeFrom, DateTimeDeltaFrom
+        import pytz
+    except ImportError:
+        DateTimeFrom = None
+    field = micromodels.MXDateTimeField()
+    for value in (datetime.datetime(2011, 1, 30, 10), 1296381600,
+                  '2011-01-30T10:00:00Z', 'Sun, 30 Jan 2011 10:00:00 +0000'):
+        baseline = None
+        if DateTimeFrom is not None and not isinstance(value, datetime.datetime):
+            convert = DateTimeFrom if isinstance(value, str) else \
+                datetime.datetime.utcfromtimestamp
+            baseline = best_of(lambda: pytz.utc.localize(
+                DateTimeFrom(value).gmtime().pydatetime()
+                if isinstance(value, str) else convert(value)), 5000)
+            report('mx %r' % (value,), baseline)
+        report('convert(%r)' % (value,),
+               best_of(lambda: field.convert(value), 5000), baseline)
+    field = micromodels.MXTimeDeltaField()
+    for value in (90, datetime.timedelta(seconds=90)):
+        baseline = None
+        if DateTimeFrom is not None:
+            baseline = best_of(
+                lambda: DateTimeDeltaFrom(value).pytimedelta(), 5000)
+            report('mx %r' % (value,), baseline)
+        report('convert(%r)' % (value,),
+               best_of(lambda: field.convert(value), 5000), baseline)
+    report("serialize('1d 2:30')",
+           best_of(lambda: field.serialize('1d 2:30'), 5000))
+
+
+#: Longest time ``import micromodels`` may take in a fresh interpreter, in
+#: seconds, with compiled bytecode available.
+IMPORT_BUDGET = 0.010
+
+_IMPORT_SCRIPT = """
+import sys, time
+before = len(sys.modules)
+start = time.time()
+import micromodels
+print time.time() - start, len(sys.modules) - before
+"""
+
+
+@benchmark
+def import_time():
+    """Time of import micromodels in a fresh interpreter"""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable, '-c', _IMPORT_SCRIPT]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    # The first run compiles the bytecode of the package.
+    for _ in range(11):
+        output = subprocess.check_output(command, env=env, cwd=cwd)
+        seconds, modules = output.split()
+        runs.append(float(seconds))
+    report('import micromodels (%s modules)' % modules, min(runs[1:]))
+    if min(runs[1:]) > IMPORT_BUDGET:
+        print '  over the budget of %.0f ms' % (IMPORT_BUDGET * 1e3)
+        FAILED.append('import_time')
+
+
+def instance_size(instance):
+    """Bytes used by an instance and the dictionaries it owns"""
+    return sys.getsizeof(instance) + sum(
+        sys.getsizeof(referent) for referent in gc.get_referents(instance)
+        if isinstance(referent, dict))
+
+
+@benchmark
+def compact():
+    """Memory and decoding time of regular vs. compact (slots) models"""
+    data = make_tweet(0)
+    for model in (Tweet, CompactTweet):
+        instance = model.from_dict(data)
+        print '  %-40s %7d bytes per tweet, %d per user' % (
+            model.__name__, instance_size(instance), instance_size(instance.user))
+    baseline = best_of(lambda: Tweet.from_dict(data), 2000)
+    report('Tweet.from_dict()', baseline)
+    report('CompactTweet.from_dict()',
+           best_of(lambda: CompactTweet.from_dict(data), 2000), baseline)
+
+
+@benchmark
+def identity_map():
+    """20000 tweets from JSON by 200 users, with and without an identity map"""
+    user = type('KeyedTwitterUser', (micromodels.Model,),
+                dict(TwitterUser._clsfields, _key='id'))
+    keyed = type('KeyedTweet', (micromodels.Model,),
+                 dict(Tweet._clsfields, user=micromodels.ModelField(user)))
+    rng = random.Random(21)
+    rows = []
+    for i in range(20000):
+        row = make_tweet(i)
+        number = rng.randrange(200)
+        row['user'].update(id=number, screen_name='user%d' % number,
+                           name='User %d' % number)
+        rows.append(json.dumps(row))
+
+    def decode(model):
+        user.clear_identity_map()
+        return list(model.from_dicts(rows, is_json=True))
+
+    baseline_rss = peak_rss(lambda: None)
+    for model in (Tweet, keyed):
+        users = len(set(id(tweet.user) for tweet in decode(model)))
+        print '  %-40s %7d KB, %d user instances' % (
+            model.__name__, peak_rss(lambda: decode(model)) - baseline_rss,
+            users)
+    baseline = best_of(lambda: decode(Tweet), 1)
+    report('Tweet.from_dicts(is_json=True)', baseline)
+    report('KeyedTweet.from_dicts(is_json=True)',
+           best_of(lambda: decode(keyed), 1), baseline)
+
+
+@benchmark
+def delta():
+    """Partial updates of a timeline of 1000 tweets: full vs. changed fields"""
+    timeline = Timeline.from_dict({'name': 'home', 'tweets': [
+        make_tweet(i) for i in xrange(1000)]})
+    timeline.name = 'renamed'
+    full, changed = timeline.to_json(), timeline.to_json(changed_only=True)
+    print '  %-40s %7d bytes, %d with changed_only=True' % (
+        'to_json()', len(full), len(changed))
+    baseline = best_of(timeline.to_json, 10)
+    report('to_json()', baseline)
+    report('to_json(changed_only=True)',
+           best_of(lambda: timeline.to_json(changed_only=True), 1000),
+           baseline)
+    tweet = Tweet.from_dict(make_tweet(0))
+    update = {'retweet_count': 5}
+    patch = dict(make_tweet(0), **update)
+    baseline = best_of(lambda: tweet.set_data(patch), 10000)
+    report('set_data(whole tweet)', baseline)
+    report('set_data(update, delta=True)',
+           best_of(lambda: tweet.set_data(update, delta=True), 10000),
+           baseline)
+
+
+@benchmark
+def json_cache():
+    """Repeated to_json() of an unchanged tweet, with _cache_json = True"""
+    cached = type('CachedTweet', (micromodels.Model,),
+                  dict(Tweet._clsfields, _cache_json=True))
+    tweet, cached_tweet = Tweet.from_dict(make_tweet(0)), \
+        cached.from_dict(make_tweet(0))
+    for direct in (False, True):
+        baseline = best_of(lambda: tweet.to_json(direct=direct), 10000)
+        report('Tweet.to_json(direct=%s)' % direct, baseline)
+        report('CachedTweet.to_json(direct=%s)' % direct,
+               best_of(lambda: cached_tweet.to_json(direct=direct), 10000),
+               baseline)
+
+    def change():
+        cached_tweet.user.followers_count += 1
+        return cached_tweet.to_json()
+    report('CachedTweet, nested change + to_json()', best_of(change, 10000))
+
+
+@benchmark
+def comparisons():
+    """Equality, hashing and fingerprints of tweets"""
+    def old_eq(self, other):
+        eq = type(other) == type(self)
+        if eq:
+            for name, field in self._clsfields.iteritems():
+                eq = eq and getattr(self, name) == getattr(other, name)
+        return eq
+
+    first, second = [Tweet.from_dict(make_tweet(0)) for _ in range(2)]
+    baseline = best_of(lambda: old_eq(first, second), 20000)
+    report('getattr loop ==', baseline)
+    report('generated ==', best_of(lambda: first == second, 20000), baseline)
+
+    hashable = type('HashableTweet', (micromodels.Model,),
+                    dict(Tweet._clsfields, _hashable=True,
+                         user=micromodels.ModelField(type(
+                             'HashableTwitterUser', (micromodels.Model,),
+                             dict(TwitterUser._clsfields, _hashable=True)))))
+    tweets = hashable.from_dicts(make_tweet(i % 1000) for i in range(20000))
+    report('set() of 20000 tweets, 1000 distinct',
+           best_of(lambda: set(tweets), 1))
+    tweet = hashable.from_dict(make_tweet(0))
+    report('fingerprint(), uncached',
+           best_of(lambda: (tweet.clear_json_cache(), tweet.fingerprint()),
+                   2000))
+    report('fingerprint(), cached', best_of(tweet.fingerprint, 20000))
+
+
+@benchmark
+def sparse():
+    """set_data() of 3 keys on models of 20 to 500 fields"""
+    def old_set_data(instance, data):
+        for name, field in instance._clsfields.iteritems():
+            key = field.source or name
+            if key in data:
+                instance.__setattr__(name, data.get(key))
+
+    for width in (20, 100, 500):
+        model = type('Wide%d' % width, (micromodels.Model,), dict(
+            ('field_%d' % i, micromodels.IntegerField()) for i in range(width)))
+        instance = model()
+        data = {'field_1': 1, 'field_7': 7, 'field_13': 13}
+        baseline = best_of(lambda: old_set_data(instance, data), 2000)
+        report('%d fields, field loop' % width, baseline)
+        report('%d fields, set_data()' % width,
+               best_of(lambda: instance.set_data(data), 2000), baseline)
+
+
+def interned_tweet():
+    """Returns a variant of Tweet interning its repetitive strings."""
+    def char():
+        return micromodels.CharField(intern=True)
+    user = type('InternedTwitterUser', (micromodels.Model,), dict(
+        TwitterUser._clsfields, screen_name=char(), name=char(),
+        description=char(), location=char()))
+    return type('InternedTweet', (micromodels.Model,), dict(
+        Tweet._clsfields, source=char(), lang=char(),
+        hashtags=micromodels.FieldCollectionField(char()),
+        user=micromodels.ModelField(user)))
+
+
+def string_bytes(instances):
+    """Bytes used by the distinct strings held by ``instances`` and by the
+    models and lists they contain.
+
+    """
+    seen, pending = set(), list(instances)
+    total = 0
+    while pending:
+        value = pending.pop()
+        if isinstance(value, basestring):
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+        elif isinstance(value, micromodels.Model):
+            pending.extend(value.__dict__.itervalues())
+        elif isinstance(value, list):
+            pending.extend(value)
+    return total
+
+
+@benchmark
+def interning():
+    """Strings of 20000 tweets from JSON by 500 users, with CharField(intern=True)"""
+    rng = random.Random(20)
+    rows = []
+    for i in range(20000):
+        row = make_tweet(i)
+        user = rng.randrange(500)
+        row['lang'] = rng.choice(['en', 'fr', 'es', 'ja', 'pt'])
+        row['source'] = rng.choice(['web', 'Twitter for iPhone',
+                                    'Twitter for Android', 'TweetDeck'])
+        row['hashtags'] = rng.sample(['news', 'sports', 'music', 'tech',
+                                      'politics', 'travel'], 2)
+        row['user'].update(id=user, screen_name='user%d' % user,
+                           name='User %d' % user,
+                           location=rng.choice(['Paris', 'Tokyo', 'Lima']))
+        rows.append(json.dumps(row))
+    interned = interned_tweet()
+    for model in (Tweet, interned):
+        instances = [model.from_dict(row, is_json=True) for row in rows]
+        print '  %-40s %10.1f MB of strings' % (
+            model.__name__, string_bytes(instances) / 1e6)
+    def decode(model):
+        return [model.from_dict(row, is_json=True) for row in rows]
+    baseline = best_of(lambda: decode(Tweet), 1)
+    report('Tweet.from_dict(is_json=True)', baseline)
+    report('InternedTweet.from_dict(is_json=True)',
+           best_of(lambda: decode(interned), 1), baseline)
+
+
+def wide_model(**attrs):
+    """Returns a 60-field model class, along with matching data."""
+    data = {}
+    for i in range(20):
+        attrs['text_%d' % i] = micromodels.CharField()
+        attrs['number_%d' % i] = micromodels.IntegerField()
+        data['text_%d' % i], data['number_%d' % i] = 'value %d' % i, i
+    for i in range(10):
+        attrs['when_%d' % i] = micromodels.DateTimeField('%Y-%m-%dT%H:%M:%S')
+        attrs['user_%d' % i] = micromodels.ModelField(TwitterUser)
+        data['when_%d' % i] = '2011-01-30T12:00:%02d' % i
+        data['user_%d' % i] = make_tweet(i)['user']
+    return type('Wide', (micromodels.Model,), attrs), data
+
+
+@benchmark
+def lazy():
+    """Decoding a 60-field record and reading 5 fields, eager vs. lazy"""
+    names = ['text_0', 'number_1', 'when_2', 'user_3', 'text_4']
+    eager, data = wide_model()
+    lazy, data = wide_model(_lazy=True)
+
+    def read(model):
+        instance = model.from_dict(data)
+        for name in names:
+            getattr(instance, name)
+
+    baseline = best_of(lambda: read(eager), 500)
+    report('eager from_dict() + 5 reads', baseline)
+    report('lazy from_dict() + 5 reads', best_of(lambda: read(lazy), 500),
+           baseline)
+    baseline = best_of(lambda: eager.from_dict(data).to_dict(serial=True), 500)
+    report('eager to_dict(serial=True)', baseline)
+    report('lazy to_dict(serial=True)',
+           best_of(lambda: lazy.from_dict(data).to_dict(serial=True), 500),
+           baseline)
+
+
+def nested_models(depth):
+    """Returns a chain of ``depth`` model classes, each nesting the previous
+    one through a :class:`~micromodels.ModelField` and two leaf models through
+    a :class:`~micromodels.ModelCollectionField`, along with matching data.
+
+    """
+    leaf = type('Leaf', (micromodels.Model,), {'name': micromodels.CharField()})
+    model, data = leaf, {'name': 'leaf'}
+    for level in range(1, depth + 1):
+        model = type('Level%d' % level, (micromodels.Model,), {
+            'name': micromodels.CharField(),
+            'child': micromodels.ModelField(model),
+            'leaves': micromodels.ModelCollectionField(leaf),
+        })
+        data = {'name': 'level', 'child': data,
+                'leaves': [{'name': 'left'}, {'name': 'right'}]}
+    return model, data
+
+
+@benchmark
+def nested():
+    """Decoding 1 to 6 levels of nested models (3 models per level)"""
+    for depth in range(1, 7):
+        model, data = nested_models(depth)
+        report('depth %d' % depth, best_of(lambda: model.from_dict(data), 5000))
+
+
+def main(names):
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        print '%s: %s' % (func.__name__, func.__doc__)
+        func()
+    if FAILED:
+        sys.exit('Over budget: %s' % ', '.join(FAILED))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,4 +1,5 @@
 from .models import Model
+from .batch import ModelBatch
 from .fields import BaseField, CharField, IntegerField, FloatField,\
                     BooleanField, DateTimeField, DateField, TimeField,\
                     ModelField, ModelCollectionField, FieldCollectionField, \
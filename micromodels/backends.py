@@ -0,0 +1,180 @@
+'''Pluggable JSON backends.
+
+micromodels encodes and decodes JSON through the fastest JSON library
+available at runtime, falling back to the standard library's :mod:`json`
+module. The preferred backends are, in order: ``ujson``, ``cjson``,
+``simplejson`` and ``json``. Other libraries can be added with
+:func:`register`, the backend used by the whole process can be chosen with
+:func:`use`, and the methods of :class:`~micromodels.Model` that encode or
+decode JSON take a ``backend`` argument to choose one for a single call::
+
+    >>> from micromodels import backends
+    >>> backends.available()
+    ['cjson', 'json']
+    >>> backends.use('json')
+    >>> instance.to_json(backend='cjson')
+
+``ujson`` only handles integers that fit in 64 bits: documents holding
+larger ones are encoded and decoded with :mod:`json` instead.
+
+'''
+
+
+class Backend(object):
+    """A JSON library, as a pair of ``encode`` and ``decode`` functions."""
+
+    def __init__(self, name, encode, decode):
+        self.name = name
+        self.encode = encode
+        self.decode = decode
+
+    def __repr__(self):
+        return '<JSON backend %r>' % self.name
+
+
+def _ujson():
+    import ujson
+    import json
+    dumps, loads = ujson.dumps, ujson.loads
+
+    def encode(obj):
+        try:
+            return dumps(obj)
+        except OverflowError:
+            return json.dumps(obj, separators=(',', ':'))
+
+    def decode(data):
+        try:
+            return loads(data)
+        except ValueError:
+            return json.loads(data)
+    return encode, decode
+
+
+def _cjson():
+    import cjson
+    return cjson.encode, cjson.decode
+
+
+def _simplejson():
+    import simplejson
+    return simplejson.dumps, simplejson.loads
+
+
+def _json():
+    import json
+    return json.dumps, json.loads
+
+
+#: Names of the registered backends, from the most to the least preferred.
+_preference = ['ujson', 'cjson', 'simplejson', 'json']
+
+#: Functions importing each backend, and returning its encode and decode
+#: functions.
+_loaders = {
+    'ujson': _ujson,
+    'cjson': _cjson,
+    'simplejson': _simplejson,
+    'json': _json,
+}
+
+_backends = {}
+_default = None
+
+#: Whether the default backend was chosen with :func:`use`.
+_chosen = False
+
+
+def register(name, encode, decode, preferred=False):
+    '''Registers a JSON library under ``name``. It becomes the most preferred
+    backend if ``preferred`` is ``True``, and the least preferred otherwise.
+    A default backend chosen with :func:`use` stays the default.
+
+    '''
+    global _default
+    if name in _preference:
+        _preference.remove(name)
+    if preferred:
+        _preference.insert(0, name)
+    else:
+        _preference.append(name)
+    _backends[name] = Backend(name, encode, decode)
+    _loaders.pop(name, None)
+    if not _chosen:
+        _default = None
+    elif _default.name == name:
+        _default = _backends[name]
+
+
+def _load(name):
+    try:
+        return _backends[name]
+    except KeyError:
+        pass
+    if name not in _loaders:
+        raise ValueError('Unknown JSON backend %r' % name)
+    encode, decode = _loaders[name]()
+    _backends[name] = backend = Backend(name, encode, decode)
+    return backend
+
+
+def available():
+    '''Returns the names of the backends that can be imported, from the most
+    to the least preferred.
+
+    '''
+    names = []
+    for name in _preference:
+        try:
+            _load(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def use(name=None):
+    '''Makes the backend ``name`` the default one for the whole process.
+    Without ``name``, goes back to the most preferred available backend.
+
+    '''
+    global _default, _chosen
+    _default = _load(name) if name else None
+    _chosen = bool(name)
+
+
+def get(name=None):
+    '''Returns the :class:`Backend` called ``name``, or the default one.'''
+    if name:
+        return _load(name)
+    global _default
+    if _default is None:
+        for name in _preference:
+            try:
+                _default = _load(name)
+            except ImportError:
+                continue
+            break
+    return _default
+
+
+def encode(obj, backend=None):
+    '''Encodes ``obj`` as a JSON string, using the backend called
+    ``backend`` or the default one.
+
+    '''
+    return get(backend).encode(obj)
+
+
+def decode(data, backend=None):
+    '''Decodes the JSON document ``data``, using the backend called
+    ``backend`` or the default one. ``data`` may be a byte string, which is
+    passed as it is to the backend, a unicode string, or an object
+    supporting the buffer protocol, such as a :class:`memoryview`.
+
+    '''
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    elif isinstance(data, buffer):
+        data = str(data)
+    return get(backend).decode(data)
@@ -0,0 +1,115 @@
+from array import array
+
+from .fields import IntegerField, FloatField, BooleanField, DateTimeField
+
+
+#: The NumPy module, imported when the first batch is built, or ``None`` if
+#: it isn't installed.
+numpy = None
+_numpy_imported = False
+
+
+def _import_numpy():
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_imported = True
+    return numpy
+
+#: ``array.array`` typecodes and NumPy dtypes of the columns of fields of
+#: exactly these types. The dtype of ``'l'`` matches the platform's C long.
+_TYPECODES = {
+    IntegerField: ('l', 'int%d' % (8 * array('l').itemsize)),
+    FloatField: ('d', 'float64'),
+}
+
+
+def _column(field, values, use_numpy):
+    '''Converts a list of source values into a column for ``field``.'''
+    codes = _TYPECODES.get(type(field))
+    if codes is not None:
+        typecode, dtype = codes
+        # Plain numbers need no conversion and are packed by a C loop.
+        try:
+            column = array(typecode, values)
+        except (TypeError, OverflowError):
+            converted = map(field.converter(), values)
+            try:
+                column = array(typecode, converted)
+            except (TypeError, OverflowError):
+                return converted
+        if use_numpy:
+            return numpy.frombuffer(column, dtype)
+        return column
+
+    converted = map(field.converter(), values)
+    if use_numpy and None not in converted:
+        if type(field) is BooleanField:
+            return numpy.array(converted, dtype='bool')
+        if type(field) is DateTimeField:
+            return numpy.array(converted, dtype='datetime64[us]')
+    return converted
+
+
+class ModelBatch(object):
+    """A collection of records of a single :class:`~micromodels.Model` class,
+    stored column by column.
+
+    Every field becomes one column. Integer and float fields are stored in
+    :class:`array.array` objects, or in NumPy arrays when NumPy is available
+    and ``use_numpy`` isn't ``False``, in which case boolean and datetime
+    fields become ``bool`` and ``datetime64`` arrays. Columns containing ``None`` and all other
+    fields are stored in lists. Each column is converted in one pass with the
+    field's :meth:`~micromodels.fields.BaseField.convert` method, so
+    aggregating a few columns does not require building any model instance::
+
+        >>> batch = ModelBatch(Tweet, list_of_dicts)
+        >>> sum(batch.columns['retweet_count'])
+        1234
+        >>> batch[0].text
+        u'just setting up my twttr'
+
+    Indexing or iterating over the batch builds model instances on demand.
+
+    """
+    def __init__(self, model, rows, use_numpy=None):
+        available = _import_numpy() is not None
+        if use_numpy is None:
+            use_numpy = available
+        elif use_numpy and not available:
+            raise ImportError('NumPy is not available')
+        rows = list(rows)
+        self.model = model
+        self.columns = {}
+        for name, field in model._clsfields.iteritems():
+            source = field.source or name
+            values = [row.get(source, field.default) for row in rows]
+            self.columns[name] = _column(field, values, use_numpy)
+        self._length = len(rows)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('ModelBatch index out of range')
+        model = self.model
+        if model._get_decoder() is None:
+            instance = model()
+        else:
+            instance = model.__new__(model)
+        for name, column in self.columns.iteritems():
+            value = column[index]
+            if numpy is not None and isinstance(value, numpy.generic):
+                value = value.item()
+            object.__setattr__(instance, name, value)
+        return instance
+
+    def __iter__(self):
+        for index in xrange(self._length):
+            yield self[index]
@@ -0,0 +1,377 @@
+'''The binary format of :meth:`micromodels.Model.to_binary`.
+
+An instance is encoded as a header followed by the values of the fields of
+its class, in the order of their names. The header is made of a marker byte,
+the version of the format and a checksum of the names and types of the
+fields, and of the layouts of the nested model classes, so data written for
+another layout of the class is rejected instead of being misread. Decoded
+values must also be of the types of their fields, or are converted by the
+field if it isn't one of the built-in field types. Every value starts with a one-byte tag giving its type:
+
+* ``N``, ``T``, ``F``: ``None``, ``True``, ``False``
+* ``I``, ``i``: a 32-bit or 64-bit signed integer, ``L``: a longer
+  integer, in decimal
+* ``d``: a double
+* ``s``, ``u``: a byte string, a unicode string encoded in UTF-8
+* ``D``, ``Z``: a naive or a UTC :class:`datetime.datetime`
+* ``a``, ``t``, ``e``: a :class:`datetime.date`, :class:`datetime.time` or
+  :class:`datetime.timedelta`
+* ``l``, ``m``: a list, a dictionary
+* ``M``: an instance of the class wrapped by the field, encoded as its
+  fields without a header
+* ``-``: a field which is not set on the instance
+
+Lengths are stored in one byte, or in five bytes above 254. Decoding only
+ever builds these types, and never runs :mod:`pickle`, so data from an
+untrusted cache can't execute code.
+
+'''
+import datetime
+import struct
+import zlib
+
+from .dates import utc
+from .fields import CharField, IntegerField, FloatField, BooleanField, \
+                    DateTimeField, DateField, TimeField, ModelField, \
+                    ModelCollectionField, FieldCollectionField, \
+                    WrappedObjectField, MXDateTimeField, MXTimeDeltaField
+
+
+VERSION = 1
+_MARKER = '\xa7'
+_HEADER = struct.Struct('<cBi')
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+_LENGTH = struct.Struct('<I')
+_DATETIME = struct.Struct('<HBBBBBI')
+_DATE = struct.Struct('<HBB')
+_TIME = struct.Struct('<BBBI')
+_TIMEDELTA = struct.Struct('<iII')
+_MISSING = object()
+
+#: Types of the values of fields of exactly these types. Values of other
+#: fields are passed to their converter.
+_FIELD_TYPES = {
+    CharField: (unicode, str),
+    IntegerField: (int, long),
+    FloatField: (float,),
+    BooleanField: (bool,),
+    DateTimeField: (datetime.datetime,),
+    DateField: (datetime.date,),
+    TimeField: (datetime.time,),
+    MXDateTimeField: (datetime.datetime,),
+    MXTimeDeltaField: (datetime.timedelta,),
+    ModelCollectionField: (list,),
+    FieldCollectionField: (list,),
+}
+
+
+def _layout(cls):
+    '''Returns the fields of ``cls`` in encoding order, as tuples of their
+    name, the model class the field wraps, if any, the types its values
+    must have, or else its converter, along with the checksum of that
+    layout. The result is cached on the class.
+
+    '''
+    try:
+        return cls.__dict__['_binary_layout']
+    except KeyError:
+        layout = ([_entry(name, field)
+                   for name, field in sorted(cls._clsfields.items())],
+                  _schema_checksum(cls, ()))
+        setattr(cls, '_binary_layout', layout)
+        return layout
+
+
+def _entry(name, field):
+    nested = _nested(field)
+    if type(field) is ModelField:
+        types = (nested,)
+    else:
+        types = _FIELD_TYPES.get(type(field))
+    if types is None:
+        return name, nested, None, field.converter()
+    return name, nested, types + (type(None),), None
+
+
+def _schema_checksum(cls, parents):
+    '''Returns the checksum of the names and types of the fields of
+    ``cls``, and of the fields of the model classes they wrap, recursively.
+    ``parents`` are the classes being walked, which nest ``cls``.
+
+    '''
+    parts = []
+    for name, field in sorted(cls._clsfields.items()):
+        part = '%s:%s' % (name, type(field).__name__)
+        nested = _nested(field)
+        if nested is not None:
+            if nested is cls or nested in parents:
+                part += '(%s)' % nested.__name__
+            else:
+                part += '(%d)' % _schema_checksum(nested, parents + (cls,))
+        parts.append(part)
+    return zlib.crc32(','.join(parts))
+
+
+def _nested(field):
+    '''Returns the model class wrapped by ``field``, if any.'''
+    while isinstance(field, FieldCollectionField):
+        field = field._instance
+    if isinstance(field, WrappedObjectField):
+        return field._wrapped_class
+
+
+def _length(out, length):
+    if length < 255:
+        out.append(chr(length))
+    else:
+        out.append('\xff' + _LENGTH.pack(length))
+
+
+def _encode(out, value, model):
+    if value is None:
+        out.append('N')
+    elif value is True:
+        out.append('T')
+    elif value is False:
+        out.append('F')
+    else:
+        encode = _ENCODERS.get(type(value))
+        if encode is not None:
+            encode(out, value, model)
+        elif model is not None and isinstance(value, model):
+            out.append('M')
+            _encode_fields(out, value)
+        else:
+            raise TypeError('Cannot encode %r in binary' % (value,))
+
+
+def _encode_int(out, value, model):
+    if -2 ** 31 <= value < 2 ** 31:
+        out.append('I' + _INT32.pack(value))
+    elif -2 ** 63 <= value < 2 ** 63:
+        out.append('i' + _INT64.pack(value))
+    else:
+        _encode_string(out, str(value), 'L')
+
+
+def _encode_string(out, value, tag):
+    out.append(tag)
+    _length(out, len(value))
+    out.append(value)
+
+
+def _encode_datetime(out, value, model):
+    if value.tzinfo is None:
+        tag = 'D'
+    elif value.utcoffset() == datetime.timedelta(0):
+        tag = 'Z'
+    else:
+        raise TypeError('Cannot encode %r in binary: only naive and UTC '
+                        'datetimes are supported' % (value,))
+    out.append(tag + _DATETIME.pack(value.year, value.month, value.day,
+                                    value.hour, value.minute, value.second,
+                                    value.microsecond))
+
+
+def _encode_time(out, value, model):
+    if value.tzinfo is not None:
+        raise TypeError('Cannot encode %r in binary: only naive times are '
+                        'supported' % (value,))
+    out.append('t' + _TIME.pack(value.hour, value.minute, value.second,
+                                value.microsecond))
+
+
+def _encode_list(out, value, model):
+    out.append('l')
+    _length(out, len(value))
+    for item in value:
+        _encode(out, item, model)
+
+
+def _encode_dict(out, value, model):
+    out.append('m')
+    _length(out, len(value))
+    for key, item in value.iteritems():
+        _encode(out, key, None)
+        _encode(out, item, model)
+
+
+_ENCODERS = {
+    int: _encode_int,
+    long: _encode_int,
+    float: lambda out, value, model: out.append('d' + _DOUBLE.pack(value)),
+    str: lambda out, value, model: _encode_string(out, value, 's'),
+    unicode: lambda out, value, model: _encode_string(
+        out, value.encode('utf-8'), 'u'),
+    datetime.datetime: _encode_datetime,
+    datetime.date: lambda out, value, model: out.append(
+        'a' + _DATE.pack(value.year, value.month, value.day)),
+    datetime.time: _encode_time,
+    datetime.timedelta: lambda out, value, model: out.append(
+        'e' + _TIMEDELTA.pack(value.days, value.seconds, value.microseconds)),
+    list: _encode_list,
+    tuple: _encode_list,
+    dict: _encode_dict,
+}
+
+
+def _encode_fields(out, instance):
+    for name, model, types, convert in _layout(type(instance))[0]:
+        value = getattr(instance, name, _MISSING)
+        if value is _MISSING:
+            out.append('-')
+        else:
+            _encode(out, value, model)
+
+
+def checksum(cls):
+    '''Returns the checksum of the layout of the fields of ``cls``.'''
+    return _layout(cls)[1]
+
+
+def dumps(instance):
+    '''Encodes the fields of the :class:`~micromodels.Model` ``instance``.'''
+    out = [_HEADER.pack(_MARKER, VERSION, _layout(type(instance))[1])]
+    _encode_fields(out, instance)
+    return ''.join(out)
+
+
+def dump_fields(instance):
+    '''Encodes the fields of ``instance`` without the header, for containers
+    storing the version and checksum once for many instances.
+
+    '''
+    out = []
+    _encode_fields(out, instance)
+    return ''.join(out)
+
+
+def is_binary(data):
+    '''Whether ``data`` is in this format, as opposed to base64 text.'''
+    return data[:1] == _MARKER
+
+
+def _string(data, pos):
+    """Returns the length-prefixed byte string at ``pos`` of ``data``, along
+    with the position following it.
+
+    """
+    length = ord(data[pos])
+    pos += 1
+    if length == 255:
+        length, = _LENGTH.unpack_from(data, pos)
+        pos += 4
+    end = pos + length
+    if end > len(data):
+        raise ValueError('Truncated binary data')
+    return data[pos:end], end
+
+
+def _decode(data, pos, model):
+    """Returns the value at ``pos`` of ``data``, along with the position
+    following it.
+
+    """
+    tag = data[pos]
+    pos += 1
+    if tag == 'u':
+        value, pos = _string(data, pos)
+        return value.decode('utf-8'), pos
+    elif tag == 'I':
+        return _INT32.unpack_from(data, pos)[0], pos + 4
+    elif tag == 'T':
+        return True, pos
+    elif tag == 'F':
+        return False, pos
+    elif tag == 'N':
+        return None, pos
+    elif tag == 'd':
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+    elif tag == 'M' and model is not None:
+        return _decode_fields(data, pos, model, None)
+    elif tag == 'l' or tag == 'm':
+        count, pos = ord(data[pos]), pos + 1
+        if count == 255:
+            count, = _LENGTH.unpack_from(data, pos)
+            pos += 4
+        items = []
+        for _ in xrange(count):
+            if tag == 'm':
+                key, pos = _decode(data, pos, None)
+            value, pos = _decode(data, pos, model)
+            items.append((key, value) if tag == 'm' else value)
+        return (dict(items) if tag == 'm' else items), pos
+    elif tag == 's':
+        return _string(data, pos)
+    elif tag == 'i':
+        return _INT64.unpack_from(data, pos)[0], pos + 8
+    elif tag == 'L':
+        value, pos = _string(data, pos)
+        return long(value), pos
+    elif tag == 'D' or tag == 'Z':
+        value = datetime.datetime(*_DATETIME.unpack_from(data, pos),
+                                  tzinfo=utc if tag == 'Z' else None)
+        return value, pos + _DATETIME.size
+    elif tag == 'a':
+        return datetime.date(*_DATE.unpack_from(data, pos)), pos + _DATE.size
+    elif tag == 't':
+        return datetime.time(*_TIME.unpack_from(data, pos)), pos + _TIME.size
+    elif tag == 'e':
+        value = datetime.timedelta(*_TIMEDELTA.unpack_from(data, pos))
+        return value, pos + _TIMEDELTA.size
+    raise ValueError('Invalid binary data: unknown tag %r at position %d'
+                     % (tag, pos - 1))
+
+
+def _decode_fields(data, pos, cls, instance):
+    if instance is None:
+        instance = cls.__new__(cls) if cls._get_decoder() else cls()
+    setter = object.__setattr__
+    for name, model, types, convert in _layout(cls)[0]:
+        if data[pos] == '-':
+            pos += 1
+            continue
+        value, pos = _decode(data, pos, model)
+        if types is None:
+            value = convert(value)
+        elif not isinstance(value, types):
+            raise ValueError('Invalid binary data: %r for the field %s.%s'
+                             % (value, cls.__name__, name))
+        setter(instance, name, value)
+    return instance, pos
+
+
+def loads(cls, data, instance=None):
+    '''Decodes ``data``, returned by :func:`dumps` for an instance of
+    ``cls``, into ``instance`` or a new instance of ``cls``.
+
+    '''
+    try:
+        marker, version, checksum = _HEADER.unpack_from(data)
+    except struct.error:
+        marker = None
+    if marker != _MARKER or version != VERSION:
+        raise ValueError('Not micromodels binary data, or an unsupported '
+                         'version of the format')
+    if checksum != _layout(cls)[1]:
+        raise ValueError('Binary data was written for another layout of %s'
+                         % cls.__name__)
+    instance, pos = load_fields(cls, data, _HEADER.size, instance)
+    if pos != len(data):
+        raise ValueError('Trailing data after binary %s' % cls.__name__)
+    return instance
+
+
+def load_fields(cls, data, pos=0, instance=None):
+    '''Decodes the output of :func:`dump_fields` found at ``pos`` of
+    ``data``, which may be any object supporting indexing and the buffer
+    protocol, such as an :class:`mmap.mmap`. Returns the instance along with
+    the position following it.
+
+    '''
+    try:
+        return _decode_fields(data, pos, cls, instance)
+    except (IndexError, struct.error):
+        raise ValueError('Truncated binary data')
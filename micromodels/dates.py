@@ -0,0 +1,356 @@
+'''Parsing of date and time strings with parsers compiled once per format.
+
+:func:`compile_parser` returns a function parsing strings exactly like
+:func:`datetime.datetime.strptime` does, without its per-call overhead: the
+regular expression used by :func:`~time.strptime` for the format is looked up
+once, and the result is built straight from the matched groups. Formats made
+only of fixed-width fields, such as ISO 8601 dates and the format of the
+Twitter API, are first tried with a simpler expression only matching fields
+of their full width.
+
+Month and weekday names are those of the locale in use when the parser is
+compiled.
+
+The module also provides the :data:`utc` time zone, and the flexible
+parsing of timestamps and durations used by
+:class:`~micromodels.MXDateTimeField` and
+:class:`~micromodels.MXTimeDeltaField`.
+
+'''
+import datetime
+import re
+import time
+
+
+#: Directives the compiled parsers handle, other formats use ``strptime``.
+_SUPPORTED = frozenset('YymdbBaAHMSf%')
+
+#: Names of the components given by numeric directives, and their widths in
+#: fixed-width formats.
+_WIDTHS = {'Y': 4, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2}
+_NAMES = {'Y': 'year', 'm': 'month', 'd': 'day', 'H': 'hour', 'M': 'minute',
+          'S': 'second'}
+
+_DATE_DIRECTIVES = frozenset('YymdbBaA')
+_TIME_DIRECTIVES = frozenset('HMSf')
+
+_TOKENS = re.compile(r'%(.)|([^%]+)', re.DOTALL)
+
+
+def _tokenize(format):
+    '''Splits ``format`` into ``(directive, literal)`` pairs, one of which is
+    empty.
+
+    '''
+    return _TOKENS.findall(format)
+
+
+def _strptime_parser(format, kind):
+    strptime = datetime.datetime.strptime
+    if kind is datetime.date:
+        return lambda string: strptime(string, format).date()
+    if kind is datetime.time:
+        return lambda string: strptime(string, format).time()
+    return lambda string: strptime(string, format)
+
+
+def _builder(directives, kind):
+    '''Returns the expression building a ``kind`` object, a datetime, date
+    or time class, from the components parsed for ``directives``. A full
+    datetime is built first when the other components must be validated.
+
+    '''
+    if kind is datetime.date and not directives & _TIME_DIRECTIVES:
+        return 'date(year, month, day)'
+    if kind is datetime.time and not directives & _DATE_DIRECTIVES:
+        return 'time(hour, minute, second, microsecond)'
+    expression = 'datetime(year, month, day, hour, minute, second, microsecond)'
+    if kind is datetime.date:
+        return expression + '.date()'
+    if kind is datetime.time:
+        return expression + '.time()'
+    return expression
+
+
+def _components(tokens, indent):
+    '''Returns the lines of code computing the components from the groups of
+    the ``found`` match object, which are the directives of ``tokens``.
+
+    '''
+    directives = [directive for directive, literal in tokens
+                  if directive and directive != '%']
+    if set(directives) <= set(_NAMES):
+        names = ', '.join(_NAMES[directive] for directive in directives)
+        return ['%s%s, = map(int, found.groups())' % (indent, names)]
+    lines = ['%s%s, = found.groups()' % (
+        indent, ', '.join('value_' + directive for directive in directives))]
+    for directive in directives:
+        value = 'value_' + directive
+        if directive in _NAMES:
+            line = '%s = int(%s)' % (_NAMES[directive], value)
+        elif directive == 'y':
+            line = ('year = int(%s); year += 2000 if year <= 68 else 1900'
+                    % value)
+        elif directive == 'b':
+            line = 'month = short_months[%s.lower()]' % value
+        elif directive == 'B':
+            line = 'month = long_months[%s.lower()]' % value
+        elif directive == 'f':
+            line = "microsecond = int(%s.ljust(6, '0'))" % value
+        else:
+            continue
+        lines.append(indent + line)
+    return lines
+
+
+def _fixed_width(tokens, locale_time):
+    '''Returns a regular expression only matching the strings of the
+    fixed-width format made of ``tokens``, in which every field has its
+    largest width, or ``None`` for other formats.
+
+    Every field then matches the same characters as in the expression used
+    by ``strptime``, which may only match shorter fields in strings of this
+    length if the string is invalid anyway.
+
+    '''
+    short_names = locale_time.a_month[1:] + locale_time.a_weekday
+    if len(set(map(len, short_names))) != 1:
+        return None
+    pattern = []
+    for directive, literal in tokens:
+        if literal or directive == '%':
+            pattern.append(re.escape(literal or '%'))
+        elif directive in _NAMES:
+            pattern.append(r'(\d{%d})' % _WIDTHS[directive])
+        elif directive == 'a':
+            pattern.append('(%s)' % '|'.join(locale_time.a_weekday))
+        elif directive == 'b':
+            pattern.append('(%s)' % '|'.join(locale_time.a_month[1:]))
+        else:
+            return None
+    return re.compile(''.join(pattern) + r'\Z', re.IGNORECASE)
+
+
+def compile_parser(format, kind=datetime.datetime):
+    '''Returns a function parsing strings in the :func:`~time.strptime`
+    ``format`` into instances of ``kind``, which is
+    :class:`datetime.datetime`, :class:`datetime.date` or
+    :class:`datetime.time`. Invalid strings raise :class:`ValueError`.
+
+    '''
+    import _strptime
+    tokens = _tokenize(format)
+    directives = set(directive for directive, literal in tokens if directive)
+    if not directives <= _SUPPORTED:
+        return _strptime_parser(format, kind)
+
+    # Makes sure the cache of strptime matches the current locale.
+    datetime.datetime.strptime('2000', '%Y')
+    with _strptime._cache_lock:
+        time_re = _strptime._TimeRE_cache
+        locale_time = time_re.locale_time
+        try:
+            regex = time_re.compile(format)
+        except re.error:
+            return _strptime_parser(format, kind)
+
+    namespace = {
+        'regex': regex, 'fixed': _fixed_width(tokens, locale_time),
+        'format': format,
+        'datetime': datetime.datetime, 'date': datetime.date,
+        'time': datetime.time,
+        'short_months': dict((name, index) for index, name
+                             in enumerate(locale_time.a_month) if index),
+        'long_months': dict((name, index) for index, name
+                            in enumerate(locale_time.f_month) if index),
+    }
+    build = _builder(directives, kind)
+    lines = ['def parse(string):',
+             '    year, month, day = 1900, 1, 1',
+             '    hour = minute = second = microsecond = 0']
+    if namespace['fixed'] is not None:
+        lines += ['    found = fixed.match(string)',
+                  '    if found is not None:']
+        lines += _components(tokens, ' ' * 8)
+        lines += ['        return %s' % build]
+    lines += ['    found = regex.match(string)',
+              '    if found is None or found.end() != len(string):',
+              "        raise ValueError('time data %r does not match format %r'",
+              '                         % (string, format))']
+    lines += _components(tokens, ' ' * 4)
+    lines.append('    return %s' % build)
+    exec compile('\n'.join(lines), '<%s parser>' % format, 'exec') in namespace
+    return namespace['parse']
+
+
+class LRUCache(object):
+    """A bounded mapping keeping the ``size`` most recently used items, safe
+    to use from several threads at once.
+
+    """
+    def __init__(self, size):
+        import threading
+        self.size = size
+        self._items = {}
+        # Circular doubly linked list of [previous, next, key] links, from
+        # the least to the most recently used key.
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            previous, next, _ = link
+            previous[1] = next
+            next[0] = previous
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0], link[1] = last, root
+            return self._items[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if key in self._links:
+                self._items[key] = value
+                return
+            root = self._root
+            if len(self._links) >= self.size:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self._links[oldest[2]], self._items[oldest[2]]
+            last = root[0]
+            last[1] = root[0] = self._links[key] = [last, root, key]
+            self._items[key] = value
+
+    def __len__(self):
+        return len(self._links)
+
+    def clear(self):
+        with self._lock:
+            root = self._root
+            root[:] = [root, root, None]
+            self._links.clear()
+            self._items.clear()
+
+
+def memoize(parse, size):
+    '''Wraps the parser ``parse`` with a :class:`LRUCache` of the results of
+    the last ``size`` distinct strings.
+
+    '''
+    cache = LRUCache(size)
+    missing = object()
+
+    def parse_cached(string):
+        value = cache.get(string, missing)
+        if value is missing:
+            value = cache[string] = parse(string)
+        return value
+    return parse_cached
+
+
+_ZERO = datetime.timedelta(0)
+
+
+class UTC(datetime.tzinfo):
+    """The UTC time zone. Use the :data:`utc` instance."""
+
+    def utcoffset(self, value):
+        return _ZERO
+
+    def dst(self, value):
+        return _ZERO
+
+    def tzname(self, value):
+        return 'UTC'
+
+    def __repr__(self):
+        return 'micromodels.dates.utc'
+
+    def __reduce__(self):
+        return 'utc'
+
+#: The UTC time zone.
+utc = UTC()
+
+
+_ISO_8601 = re.compile(r"""
+    \s*(\d{4})-?(\d\d)-?(\d\d)
+    (?:[T\s]\s*(\d\d):?(\d\d)(?::?(\d\d)(?:[.,](\d+))?)?)?
+    \s*(Z|[-+]\d\d(?::?\d\d)?)?\s*\Z""", re.VERBOSE | re.IGNORECASE)
+
+
+def _from_local(value):
+    '''Converts the naive datetime ``value``, in local time, to UTC.'''
+    timestamp = time.mktime(value.timetuple()[:8] + (-1,))
+    return datetime.datetime.utcfromtimestamp(timestamp).replace(
+        microsecond=value.microsecond, tzinfo=utc)
+
+
+def parse_timestamp(string):
+    '''Parses a timestamp in ISO 8601 or RFC 2822 format, or in the format
+    of :func:`time.ctime`, into an aware datetime in UTC. Timestamps
+    without a time zone are in local time.
+
+    '''
+    found = _ISO_8601.match(string)
+    if found is not None:
+        year, month, day, hour, minute, second, fraction, zone = \
+            found.groups()
+        value = datetime.datetime(
+            int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+            int(second or 0), int((fraction or '0')[:6].ljust(6, '0')))
+        if zone is None:
+            return _from_local(value)
+        if zone in 'Zz':
+            return value.replace(tzinfo=utc)
+        digits = zone[1:].replace(':', '').ljust(4, '0')
+        offset = datetime.timedelta(hours=int(digits[:2]),
+                                    minutes=int(digits[2:]))
+        if zone[0] == '-':
+            offset = -offset
+        return (value - offset).replace(tzinfo=utc)
+
+    from email.utils import parsedate_tz
+    parsed = parsedate_tz(string)
+    if parsed is None:
+        raise ValueError('Cannot parse the timestamp %r' % string)
+    value = datetime.datetime(*parsed[:6])
+    if parsed[9] is None:
+        return _from_local(value)
+    return (value - datetime.timedelta(seconds=parsed[9])).replace(tzinfo=utc)
+
+
+_DURATION = re.compile(r"""
+    \s*([-+])?\s*
+    (?:(\d+)\s*(?:d|days?)\s*,?\s*)?
+    (?:(\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?
+    \s*\Z""", re.VERBOSE | re.IGNORECASE)
+
+
+def parse_duration(string):
+    '''Parses a duration given as a number of seconds, or as
+    ``[-][<days>d ][<hours>:<minutes>[:<seconds>]]``, e.g. ``'1d 2:30'`` or
+    ``'-0:00:01.5'``, into a :class:`datetime.timedelta`. The output of
+    ``str()`` on positive timedeltas, such as ``'1 day, 2:30:00'``, is
+    accepted too.
+
+    '''
+    try:
+        return datetime.timedelta(seconds=float(string))
+    except ValueError:
+        pass
+    found = _DURATION.match(string)
+    if found is None or not any(found.groups()[1:]):
+        raise ValueError('Cannot parse the duration %r' % string)
+    sign, days, hours, minutes, seconds = found.groups()
+    value = datetime.timedelta(days=int(days or 0), hours=int(hours or 0),
+                               minutes=int(minutes or 0),
+                               seconds=float(seconds or 0))
+    return -value if sign == '-' else value
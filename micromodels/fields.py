@@ -1,11 +1,30 @@
-import time
-from datetime import tzinfo
 import datetime
-import types
-import pytz
-import calendar
-from mx.DateTime import DateTimeType, DateTimeDeltaType, \
-     DateTimeFrom, DateTimeDeltaFrom
+from . import dates
+
+def _defined_in(cls, name):
+    """Returns the class in the MRO of ``cls`` that defines ``name``"""
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass
+
+
+def _converts_statefully(cls):
+    """Whether the field class ``cls`` only overrides the stateful
+    :meth:`~BaseField.populate`/:meth:`~BaseField.to_python` pair."""
+    try:
+        return _stateful_classes[cls]
+    except KeyError:
+        modern = _defined_in(cls, 'convert')
+        stateful = False
+        for name in ('populate', 'to_python'):
+            legacy = _defined_in(cls, name)
+            stateful = stateful or (legacy is not modern and
+                                    issubclass(legacy, modern))
+        _stateful_classes[cls] = stateful
+        return stateful
+
+_stateful_classes = {}
+
 
 class BaseField(object):
     """Base class for all field types.
@@ -14,52 +33,108 @@ class BaseField(object):
     data. If ``source`` is not specified, the field instance will use its own
     name as the key to retrieve the value from the source data.
 
+    Fields are shared by every instance of the model class declaring them, so
+    conversion goes through the stateless :meth:`convert` and
+    :meth:`serialize` methods, which are safe to call from several threads at
+    once. :meth:`populate` and :meth:`to_python` are kept for compatibility.
+
     """
     def __init__(self, source=None, default=None, null=False):
         self.source = source
         self.default = default
         self.null = null
 
-    def populate(self, data):
-        """Set the value or values wrapped by this field"""
-        self.data = data
-
-    def to_python(self):
-        '''After being populated, this method casts the source data into a
-        Python object. The default behavior is to simply return the source
-        value. Subclasses should override this method.
+    def convert(self, value):
+        '''Casts the source value into a Python object and returns it,
+        without storing anything on the field. The default behavior is to
+        simply return the source value. Subclasses should override this
+        method.
 
         '''
-        return self.data
+        return value
 
-    def to_serial(self, data):
+    def serialize(self, value):
         '''Used to serialize forms back into JSON or other formats.
 
         This method is essentially the opposite of
-        :meth:`~micromodels.fields.BaseField.to_python`. A string, boolean,
+        :meth:`~micromodels.fields.BaseField.convert`. A string, boolean,
         number, dictionary, list, or tuple must be returned. Subclasses should
         override this method.
 
         '''
-        return data
+        return value
+
+    def converter(self):
+        '''Returns the callable used by :class:`~micromodels.Model` to
+        convert values for this field. This is :meth:`convert`, unless a
+        subclass only overrides the older :meth:`populate` and
+        :meth:`to_python` methods, in which case both are called in turn. That
+        fallback stores the value on the field and is not thread-safe.
+
+        '''
+        if _converts_statefully(type(self)):
+            return self._convert_populated
+        return self.convert
+
+    def _convert_populated(self, value):
+        self.populate(value)
+        return self.to_python()
+
+    def populate(self, data):
+        """Set the value or values wrapped by this field"""
+        self.data = data
+
+    def to_python(self):
+        '''After being populated, this method casts the source data into a
+        Python object using :meth:`convert`.
+
+        '''
+        return self.convert(self.data)
+
+    def to_serial(self, data):
+        '''Serializes ``data`` using :meth:`serialize`.'''
+        return self.serialize(data)
 
 
 class CharField(BaseField):
-    """Field to represent a simple Unicode string value."""
+    """Field to represent a simple Unicode string value.
+
+    If ``intern`` is ``True``, equal strings share a single object: the field
+    keeps a table of up to ``intern_size`` distinct strings it converted,
+    and returns the same object every time one of them comes up again. This
+    saves memory when decoding many values repeating the same few strings,
+    such as country codes or status values. The table is emptied once full.
 
+    """
     empty = ''
 
-    def to_python(self):
-        """Convert the data supplied using the :meth:`populate` method to a
-        Unicode string.
+    def __init__(self, source=None, default=None, null=False, intern=False,
+                 intern_size=65536):
+        super(CharField, self).__init__(source, default, null)
+        self.intern = intern
+        self.intern_size = intern_size
+        self._interned = {} if intern else None
+
+    def convert(self, value):
+        """Convert the value to a Unicode
+        string.
 
         """
-        if self.data is None:
+        if value is None:
             if self.null:
                 return None
             else:
                 return self.default or self.empty
-        return unicode(self.data)
+        interned = self._interned
+        if interned is None or not isinstance(value, basestring):
+            return unicode(value)
+        text = interned.get(value)
+        if text is None:
+            text = unicode(value)
+            if len(interned) >= self.intern_size:
+                interned.clear()
+            interned[value] = text
+        return text
 
 
 class IntegerField(BaseField):
@@ -67,17 +142,16 @@ class IntegerField(BaseField):
 
     empty = 0
 
-    def to_python(self):
-        """Convert the data supplied to the :meth:`populate` method to an
-        integer.
+    def convert(self, value):
+        """Convert the value to an integer.
 
         """
-        if self.data is None:
+        if value is None:
             if self.null:
                 return None
             else:
                 return self.default or self.empty
-        return int(self.data)
+        return int(value)
 
 
 class FloatField(BaseField):
@@ -85,32 +159,31 @@ class FloatField(BaseField):
 
     empty = 0.0
 
-    def to_python(self):
-        """Convert the data supplied to the :meth:`populate` method to a
-        float.
+    def convert(self, value):
+        """Convert the value to a float.
 
         """
-        if self.data is None:
+        if value is None:
             if self.null:
                 return None
             else:
                 return self.default or self.empty
-        return float(self.data)
+        return float(value)
 
 
 class BooleanField(BaseField):
     """Field to represent a boolean"""
 
-    def to_python(self):
+    def convert(self, value):
         """The string ``'True'`` (case insensitive) will be converted
         to ``True``, as will any positive integers.
 
         """
-        if isinstance(self.data, basestring):
-            return self.data.strip().lower() == 'true'
-        if isinstance(self.data, int):
-            return self.data > 0
-        return bool(self.data)
+        if isinstance(value, basestring):
+            return value.strip().lower() == 'true'
+        if isinstance(value, int):
+            return value > 0
+        return bool(value)
 
 
 class DateTimeField(BaseField):
@@ -123,20 +196,47 @@ class DateTimeField(BaseField):
     serialization. If ``serial_format`` isn't specified, an ISO formatted string
     will be returned by :meth:`~micromodels.DateTimeField.to_serial`.
 
+    Strings are parsed as :func:`~datetime.datetime.strptime` would, by a
+    parser compiled for ``format`` on first use (see
+    :mod:`micromodels.dates`). If ``cache_size`` is given, the results for
+    that many distinct strings are memoized, which helps when the same
+    timestamps come up again and again.
+
     """
-    def __init__(self, format, serial_format=None, **kwargs):
+    #: The class of the values of the field.
+    kind = datetime.datetime
+
+    _parse = None
+
+    def __init__(self, format, serial_format=None, cache_size=None, **kwargs):
         super(DateTimeField, self).__init__(**kwargs)
         self.format = format
         self.serial_format = serial_format
+        self.cache_size = cache_size
 
-    def to_python(self):
-        '''A :class:`datetime.datetime` object is returned.'''
+    def parser(self):
+        '''Returns the function parsing source strings for this field.'''
+        if self._parse is None:
+            parse = dates.compile_parser(self.format, self.kind)
+            if self.cache_size:
+                parse = dates.memoize(parse, self.cache_size)
+            self._parse = parse
+        return self._parse
+
+    def convert(self, value):
+        '''A :class:`datetime.datetime` object is returned. Values that
+        already are :class:`datetime.datetime` objects are returned as is.
 
-        if self.data is None:
+        '''
+        if value is None:
             return None
-        return datetime.datetime.strptime(str(self.data), self.format)
+        if isinstance(value, datetime.datetime):
+            return value
+        return self.parser()(str(value))
 
-    def to_serial(self, time_obj):
+    def serialize(self, time_obj):
+        if time_obj is None:
+            return None
         if not self.serial_format:
             return time_obj.isoformat()
         return time_obj.strftime(self.serial_format)
@@ -144,17 +244,27 @@ class DateTimeField(BaseField):
 class DateField(DateTimeField):
     """Field to represent a :mod:`datetime.date`"""
 
-    def to_python(self):
-        datetime = super(DateField, self).to_python()
-        return datetime.date()
+    kind = datetime.date
+
+    def convert(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if value is None or isinstance(value, datetime.date):
+            return value
+        return self.parser()(str(value))
 
 
 class TimeField(DateTimeField):
     """Field to represent a :mod:`datetime.time`"""
 
-    def to_python(self):
-        datetime = super(TimeField, self).to_python()
-        return datetime.time()
+    kind = datetime.time
+
+    def convert(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.time()
+        if value is None or isinstance(value, datetime.time):
+            return value
+        return self.parser()(str(value))
 
 
 class WrappedObjectField(BaseField):
@@ -200,15 +310,17 @@ class ModelField(WrappedObjectField):
         u'Some nested value'
 
     """
-    def populate(self, data):
-        if isinstance(data, dict):
-            data = self._wrapped_class.from_dict(data)
-        self.data = data
+    def convert(self, value):
+        '''Dictionaries are decoded into an instance of the nested class,
+        while instances of that class are returned as they are, so every
+        nested model is built exactly once.
 
-    def to_python(self):
-        return self._wrapped_class.from_dict(self.data or {})
+        '''
+        if isinstance(value, self._wrapped_class):
+            return value
+        return self._wrapped_class._from_nested(value or {})
 
-    def to_serial(self, model_instance):
+    def serialize(self, model_instance):
         try:
             return model_instance.to_dict(serial=True)
         except AttributeError:
@@ -248,19 +360,14 @@ class ModelCollectionField(WrappedObjectField):
         [u'First value', u'Second value', u'Third value']
 
     """
-    def populate(self, data):
-        new_data = []
-        for obj in data:
-            if isinstance(obj, dict):
-                new_data.append(self._wrapped_class.from_dict(obj))
-            else:
-                new_data.append(obj)
-        self.data = new_data
-
-    def to_python(self):
-        return [self._wrapped_class.from_dict(item) for item in self.data]
-
-    def to_serial(self, model_instances):
+    def convert(self, value):
+        '''Like :meth:`ModelField.convert`, for every item of the list.'''
+        wrapped_class = self._wrapped_class
+        from_nested = wrapped_class._from_nested
+        return [item if isinstance(item, wrapped_class) else from_nested(item)
+                for item in value or []]
+
+    def serialize(self, model_instances):
         return [instance.to_dict(serial=True) for instance in model_instances]
 
 class FieldCollectionField(BaseField):
@@ -331,59 +438,82 @@ class FieldCollectionField(BaseField):
         super(FieldCollectionField, self).__init__(**kwargs)
         self._instance = field_instance
 
-    def to_python(self):
-        def convert(item):
-            self._instance.populate(item)
-            return self._instance.to_python()
-        return [convert(item) for item in self.data or []]
+    def convert(self, value):
+        convert = self._instance.converter()
+        return [convert(item) for item in value or []]
 
-    def to_serial(self, list_of_fields):
-        return [self._instance.to_serial(data) for data in list_of_fields]
+    def serialize(self, list_of_fields):
+        to_serial = self._instance.to_serial
+        return [to_serial(data) for data in list_of_fields]
 
 
 class MXDateTimeField(BaseField):
+    """Field to represent an aware :class:`datetime.datetime` in UTC.
 
-    def populate(self, data):
-        if isinstance(data, types.NoneType):
-            self.data = None
+    Datetimes are converted to UTC, and naive ones are assumed to be in UTC
+    already. Numbers are UNIX timestamps, and strings are parsed with
+    :func:`micromodels.dates.parse_timestamp`. The values are serialized as
+    UNIX timestamps. ``mx.DateTime`` objects are accepted too, although the
+    field only relies on the standard library.
+
+    """
+    def convert(self, data):
+        if data is None:
+            return None
         elif isinstance(data, datetime.datetime):
             if data.tzinfo:
-                data = pytz.utc.normalize(data)
+                return data.astimezone(dates.utc)
             else:
-                data = pytz.utc.localize(data)
-            self.data = data
-        elif isinstance(data, (DateTimeType, basestring)):
-            data = DateTimeFrom(data).gmtime().pydatetime()
-            data = pytz.utc.localize(data)
-            self.data = data
-        elif isinstance(data, (int, float)):
+                return data.replace(tzinfo=dates.utc)
+        elif isinstance(data, basestring):
+            return dates.parse_timestamp(data)
+        elif isinstance(data, (int, long, float)):
             data = datetime.datetime.utcfromtimestamp(data)
-            data = pytz.utc.localize(data)
-            self.data = data
+            return data.replace(tzinfo=dates.utc)
+        elif hasattr(data, 'gmtime') and hasattr(data, 'pydatetime'):
+            return data.gmtime().pydatetime().replace(tzinfo=dates.utc)
         else:
             raise TypeError("Cannot cast given value to mx.DateTime type")
 
-    def to_serial(self, data):
+    def serialize(self, data):
         if isinstance(data, (datetime.datetime,)):
+            import calendar
             return calendar.timegm(data.utctimetuple())
-        elif isinstance(data, types.NoneType):
+        elif data is None:
             return None
         raise TypeError("Cannot cast given value to mx.DateTime type")
 
 
 class MXTimeDeltaField(BaseField):
+    """Field to represent a :class:`datetime.timedelta`.
 
-    def populate(self, data):
-        if isinstance(data, (DateTimeDeltaType, datetime.timedelta, int, float)):
-            self.data =  DateTimeDeltaFrom(data).pytimedelta()
-        elif isinstance(data, types.NoneType):
-            self.data = None
+    Numbers are durations in seconds, and ``mx.DateTime`` deltas are
+    accepted too. The values are serialized as a number of seconds, which
+    strings are converted to with
+    :func:`micromodels.dates.parse_duration`.
+
+    """
+    def convert(self, data):
+        if isinstance(data, datetime.timedelta):
+            return data
+        elif isinstance(data, (int, long, float)):
+            return datetime.timedelta(seconds=data)
+        elif data is None:
+            return None
+        elif hasattr(data, 'pytimedelta'):
+            return data.pytimedelta()
         else:
             raise TypeError("Cannot cast given value to mx.DateTime type")
 
-    def to_serial(self, data):
-        if isinstance(data, (int, float, DateTimeDeltaType, datetime.timedelta, basestring)):
-            return DateTimeDeltaFrom(data).seconds
-        elif isinstance(data, types.NoneType):
+    def serialize(self, data):
+        if isinstance(data, datetime.timedelta):
+            return data.total_seconds()
+        elif isinstance(data, (int, long, float)):
+            return float(data)
+        elif isinstance(data, basestring):
+            return dates.parse_duration(data).total_seconds()
+        elif data is None:
             return None
+        elif hasattr(data, 'pytimedelta'):
+            return data.seconds
         raise TypeError("Cannot cast given value to mx.DateTimeDelta type")
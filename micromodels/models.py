@@ -1,8 +1,291 @@
-import cjson as json
-import cPickle
-import base64
+import types
+from itertools import imap
+from weakref import WeakValueDictionary
 
-from .fields import BaseField
+from .fields import BaseField, CharField, IntegerField, FloatField, \
+                    BooleanField, ModelField, ModelCollectionField, \
+                    FieldCollectionField, WrappedObjectField
+from .streaming import iter_json_array, iter_lines, write_lines, \
+                       write_chunks, StreamDecoder
+from .records import RecordWriter, RecordFile
+from .dates import LRUCache
+from . import binary
+from . import parallel
+from . import backends as json
+
+
+#: Conversions that generated decoders inline for fields of exactly these
+#: types instead of dispatching through the field instance.
+_INLINE_CONVERSIONS = {
+    CharField: 'unicode',
+    IntegerField: 'int',
+    FloatField: 'float',
+}
+
+#: Types of source values that fields of exactly these types serialize back
+#: unchanged, so lazy models can serialize them without converting them.
+_SERIAL_TYPES = {
+    CharField: (str, unicode),
+    IntegerField: (int, long),
+    FloatField: (float,),
+    BooleanField: (bool,),
+}
+
+
+def _compile_decoder(cls):
+    '''Generates a function that builds an instance of ``cls`` from a
+    dictionary in a single straight-line pass over the declared fields.
+
+    Fields present in the dictionary are converted from their source key,
+    missing ones from their default, exactly as :meth:`Model.__init__`
+    followed by :meth:`Model.set_data` would do. Returns ``None`` when
+    ``cls`` defines its own ``__init__``, which must keep being called.
+
+    The decoder of a lazy model only keeps a reference to the dictionary.
+
+    '''
+    if cls.__init__.im_func is not Model.__init__.im_func:
+        return None
+
+    namespace = {'cls': cls, 'new': cls.__new__}
+    lines = ['def decode(data):',
+             '    instance = new(cls)']
+    fields = cls._clsfields.items()
+    if cls._lazy:
+        if isinstance(cls._raw, types.MemberDescriptorType):
+            namespace['set_raw'] = cls._raw.__set__
+            lines.append('    set_raw(instance, data)')
+        else:
+            lines.append("    instance.__dict__['_raw'] = data")
+        fields = []
+    else:
+        lines.append('    get = data.get')
+    for index, (name, field) in enumerate(fields):
+        namespace['default_%d' % index] = field.default
+        lines.append('    value = get(%r, default_%d)'
+                     % (field.source or name, index))
+        inline = _INLINE_CONVERSIONS.get(type(field))
+        if inline and not getattr(field, 'intern', False):
+            namespace['none_%d' % index] = field.convert(None)
+            value = 'none_%d if value is None else %s(value)' % (index, inline)
+        else:
+            namespace['convert_%d' % index] = field.converter()
+            value = 'convert_%d(value)' % index
+        slot = getattr(cls, name, None)
+        if isinstance(slot, types.MemberDescriptorType):
+            namespace['set_%d' % index] = slot.__set__
+            lines.append('    set_%d(instance, %s)' % (index, value))
+        else:
+            lines.append('    instance.__dict__[%r] = %s' % (name, value))
+    lines.append('    return instance')
+
+    exec compile('\n'.join(lines), '<%s decoder>' % cls.__name__, 'exec') \
+        in namespace
+    return namespace['decode']
+
+
+#: Expressions generated JSON writers use to encode the value ``%(v)s`` of
+#: fields of exactly these types, falling back to the ``encode`` function of
+#: the JSON backend for values of other types.
+_INLINE_JSON = {
+    CharField: "quote(%(v)s) if type(%(v)s) is unicode else "
+               "'null' if %(v)s is None else encode(%(v)s)",
+    IntegerField: "str(%(v)s) if type(%(v)s) is int else "
+                  "'null' if %(v)s is None else encode(%(v)s)",
+    FloatField: "repr(%(v)s) if type(%(v)s) is float and -inf < %(v)s < inf "
+                "else 'null' if %(v)s is None else encode(%(v)s)",
+    BooleanField: "'true' if %(v)s is True else 'false' if %(v)s is False "
+                  "else encode(%(v)s)",
+    ModelField: "%(v)s._write_json(encode) if isinstance(%(v)s, Model) "
+                "else encode(%(serial)s(%(v)s))",
+    ModelCollectionField: "'[%%s]' %% ','.join([item._write_json(encode) "
+                          "for item in %(v)s])",
+}
+
+
+def _json_text(value, encode, quote):
+    '''Encodes ``value`` as JSON, quoting strings, which many fields
+    serialize to, with ``quote`` instead of the ``encode`` function of the
+    backend.
+
+    '''
+    if type(value) is str or type(value) is unicode:
+        return quote(value)
+    return encode(value)
+
+
+def _json_array(items):
+    '''Yields the pieces of a JSON array of the JSON texts ``items``.'''
+    separator = '['
+    for item in items:
+        yield separator
+        yield item
+        separator = ','
+    yield ']' if separator == ',' else '[]'
+
+
+def _serializes_unchanged(field):
+    '''Whether ``field`` serializes values as they are.'''
+    cls = type(field)
+    return (cls.serialize.im_func is BaseField.serialize.im_func and
+            cls.to_serial.im_func is BaseField.to_serial.im_func)
+
+
+def _compile_serializers(cls, lazy=False):
+    '''Generates the functions behind :meth:`Model.to_dict` with
+    ``serial=True`` and :meth:`Model.to_json` with ``direct=True``. Both read
+    every field of an instance of ``cls`` without probing it first, and
+    raise :class:`KeyError` or :class:`AttributeError` when one isn't set,
+    in which case the generic implementation must be used.
+
+    The ``lazy`` variant serves instances of a lazy model holding their
+    source dictionary: fields that weren't loaded yet are read from it,
+    values of the types in :data:`_SERIAL_TYPES` as they are, and other
+    ones through the attribute, which converts them.
+
+    Values of fields which serialize them unchanged are copied as they are
+    into the dictionary, and values of the basic field types are written as
+    JSON by inline expressions, as are nested models. Other values go through
+    :meth:`~micromodels.fields.BaseField.to_serial`, and the ``encode``
+    function passed to the JSON writer.
+
+    '''
+    from json.encoder import encode_basestring_ascii
+    namespace = {'Model': Model, 'quote': encode_basestring_ascii,
+                 'text': _json_text, 'inf': float('inf')}
+    values, items, parts = [], [], []
+    fields = sorted(getattr(cls, '_fields', {}).items())
+    for index, (name, field) in enumerate(fields):
+        slot = getattr(cls, name, None)
+        serial_types = _SERIAL_TYPES.get(type(field))
+        if lazy and slot is None and serial_types:
+            namespace['default_%d' % index] = field.default
+            namespace['types_%d' % index] = serial_types
+            values.append('    v%d = data[%r] if %r in data else '
+                          'raw.get(%r, default_%d)'
+                          % (index, name, name, field.source or name, index))
+            values.append('    if type(v%d) not in types_%d: v%d = instance.%s'
+                          % (index, index, index, name))
+        elif lazy and slot is None:
+            namespace['default_%d' % index] = field.default
+            namespace['convert_%d' % index] = field.converter()
+            values.append('    if %r in data: v%d = data[%r]'
+                          % (name, index, name))
+            values.append('    else: v%d = data[%r] = convert_%d(raw.get(%r, '
+                          'default_%d))' % (index, name, index,
+                                            field.source or name, index))
+        elif lazy:
+            values.append('    v%d = instance.%s' % (index, name))
+        elif slot is None:
+            values.append('    v%d = data[%r]' % (index, name))
+        elif isinstance(slot, types.MemberDescriptorType):
+            namespace['get_%d' % index] = slot.__get__
+            values.append('    v%d = get_%d(instance)' % (index, index))
+        else:
+            values.append('    v%d = instance.%s' % (index, name))
+        if _serializes_unchanged(field):
+            items.append('%r: v%d' % (name, index))
+        else:
+            namespace['serial_%d' % index] = field.to_serial
+            items.append('%r: serial_%d(v%d)' % (name, index, index))
+        inline = _INLINE_JSON.get(type(field))
+        if inline:
+            value = inline % {'v': 'v%d' % index, 'serial': 'serial_%d' % index}
+        elif (type(field) is FieldCollectionField and
+                _serializes_unchanged(field._instance)):
+            value = 'encode(v%d)' % index
+        elif _serializes_unchanged(field):
+            value = 'encode(v%d)' % index
+        else:
+            value = 'text(serial_%d(v%d), encode, quote)' % (index, index)
+        parts.append('%r, %s' % ((',' if index else '{') +
+                                 encode_basestring_ascii(name) + ':', value))
+
+    if lazy:
+        values.insert(0, '    raw = instance._raw')
+    lines = ['def serialize(instance):',
+             '    data = instance.__dict__'] + values + [
+             '    return {%s}' % ', '.join(items),
+             '',
+             'def write(instance, encode):',
+             '    data = instance.__dict__'] + values + [
+             "    return ''.join((%s))" % ', '.join(parts + ["'}'"]
+                                                   if parts else ["'{}'"])]
+    exec compile('\n'.join(lines), '<%s serializer>' % cls.__name__, 'exec') \
+        in namespace
+    return namespace['serialize'], namespace['write']
+
+
+def _compile_comparisons(cls):
+    '''Generates the functions behind :meth:`Model.__eq__` and
+    :meth:`Model.__hash__` for ``cls``, which compare and hash the values of
+    the fields declared on the class, in a single expression. Lists held by
+    collection fields are hashed as tuples, and nested models by the values
+    of their fields, as they are compared, even if their class isn't
+    ``_hashable``.
+
+    '''
+    names = sorted(cls._clsfields)
+    comparisons = ' and '.join('self.%s == other.%s' % (name, name)
+                               for name in names)
+    values = []
+    for name in names:
+        if isinstance(cls._clsfields[name], (FieldCollectionField, ModelField,
+                                              ModelCollectionField)):
+            values.append('freeze(self.%s)' % name)
+        else:
+            values.append('self.%s' % name)
+    lines = ['def eq(self, other):',
+             '    if type(other) is not cls:',
+             '        return False',
+             '    return %s' % (comparisons or 'True'),
+             '',
+             'def hash_(self):',
+             '    return hash((%s))' % ''.join(value + ', ' for value in values)]
+    namespace = {'cls': cls, 'freeze': _hashable_value}
+    exec compile('\n'.join(lines), '<%s comparisons>' % cls.__name__,
+                 'exec') in namespace
+    return namespace['eq'], namespace['hash_']
+
+
+def _hashable_value(value):
+    '''Returns a hashable equivalent of the value of a collection or model
+    field.
+
+    '''
+    if isinstance(value, Model):
+        return type(value)._get_comparisons()[1](value)
+    if type(value) is list:
+        return tuple(map(_hashable_value, value))
+    return value
+
+
+#: Attributes of instances holding their state, which default to ``None``,
+#: by the class flag making compact models store them in slots: assigned
+#: fields are always tracked, the other ones only by some models.
+_INSTANCE_STATE = {
+    '_changed': None,
+    '_raw': '_lazy',
+    '_json_texts': '_cache_json',
+    '_parents': '_cache_json',
+}
+
+
+def _discard(instance, key):
+    '''Resets the state attribute ``key`` of ``instance`` to ``None``.'''
+    try:
+        object.__delattr__(instance, key)
+    except AttributeError:
+        pass
+
+
+def _is_set(instance, key):
+    '''Whether ``key`` is set on ``instance``, without lazily converting it.'''
+    try:
+        object.__getattribute__(instance, key)
+    except AttributeError:
+        return False
+    return True
 
 
 class Model(object):
@@ -25,64 +308,497 @@ class Model(object):
 
     First, the model checks if it has a field with a name matching the key.
 
-    If there is a matching field, then :meth:`to_python` is called on the field
-    with the value.
-        If :meth:`to_python` does not raise an exception, then the result of
-        :meth:`to_python` is set on the instance, and the method is completed.
-        Essentially, this means that the first thing setting an attribute tries
-        to do is process the data as if it was a "primitive" data type.
+    If there is a matching field, then the field's :meth:`convert` method is
+    called with the value, and the result is set on the instance. Fields
+    accept both "primitive" data, such as the strings found in JSON, and
+    values that already are of the appropriate Python type.
 
-        If :meth:`to_python` does raise an exception, this means that the data
-        might already be an appropriate Python type. The :class:`Model` then
-        attempts to *serialize* the data into a "primitive" type using the
-        field's :meth:`to_serial` method.
+    If the instance doesn't have a field matching the key, then the key and
+    value are just set on the instance like any other assignment in Python.
 
-            If this fails, a ``TypeError`` is raised.
+    Subclasses inherit the fields of their bases, and may override them by
+    declaring another field, or remove them by declaring any other
+    attribute with the same name.
 
-            If it does not fail, the value is set on the instance, and the
-            method is complete.
+    Setting ``_compact = True`` on a model class stores the values of its
+    fields in ``__slots__`` instead of a per-instance dictionary, which
+    makes instances several times smaller when many of them are held in
+    memory. Subclasses of a compact model are compact too, unless they set
+    ``_compact = False``. The fields assigned since the instance was loaded
+    are tracked in a slot too, as are the source dictionary of lazy models
+    and the cached JSON of models setting ``_cache_json``. Any other
+    attribute set on a compact instance still goes into an instance
+    dictionary, created on first use.
 
-    If the instance doesn't have a field matching the key, then the key and
-    value are just set on the instance like any other assignment in Python.
+    Setting ``_lazy = True`` makes :meth:`from_dict` keep a reference to the
+    source dictionary instead of converting it. Each field is then converted
+    the first time it is read, and the result is cached on the instance.
+    :meth:`to_dict` with ``serial=True`` and :meth:`to_json` pass the source
+    values of fields that were never read straight through when they need
+    no conversion.
+    The source dictionary should not be modified while the instance is in
+    use.
+
+    Setting ``_key`` to the name of a field identifying instances, such as
+    ``'id'``, gives the class an identity map: when it is nested in another
+    model through a :class:`~micromodels.ModelField` or a
+    :class:`~micromodels.ModelCollectionField`, dictionaries with the same
+    key are decoded once, into an instance shared by every model they
+    appear in. The map keeps the ``_identity_size`` most recently used
+    instances along with their source dictionary, until
+    :meth:`clear_identity_map` is called. Source dictionaries holding other
+    values for the declared fields of a known key raise :class:`ValueError`
+    (other keys, and keys missing from either dictionary, aren't compared),
+    unless ``_key_conflict`` is ``'replace'``, to decode them into a new
+    instance that is then shared instead, or ``'keep'``, to share the known
+    instance without comparing the data. Shared instances should not be
+    modified.
+
+    Instances track which fields were assigned since they were built or
+    loaded with :meth:`set_data`, or since :meth:`mark_clean` was last
+    called. :meth:`changed_fields` returns their names, ``to_dict()`` and
+    ``to_json()`` with ``changed_only=True`` only include them, and
+    :meth:`set_data` with ``delta=True`` applies a partial update, so a
+    change can be sent or applied at a cost that depends on its size only::
+
+        >>> tweet.text = 'edited'
+        >>> tweet.to_json(changed_only=True)
+        '{"text": "edited"}'
+        >>> copy.set_data({'text': 'edited'}, delta=True)
+
+    Setting ``_cache_json = True`` makes every instance keep the JSON text
+    returned by :meth:`to_json`, for each backend, so serializing an
+    unchanged instance again costs a dictionary lookup. Assigning a field,
+    :meth:`add_field` and :meth:`set_data` discard the text, as does any
+    such change to a model nested in the instance, at any depth, even if
+    the nested class doesn't cache its own JSON. Changes made in place, such
+    as appending to a list, aren't detected: :meth:`clear_json_cache` must
+    then be called.
+
+    Instances are equal when they are of the same class and the fields
+    declared on it have equal values, compared by a function generated for
+    the class. Setting ``_hashable = True`` hashes them by the same values,
+    so models that aren't modified once built can be deduplicated with a
+    set, or used as dictionary keys. :meth:`fingerprint` returns a digest
+    of the serialized values, cached like the JSON text.
 
     """
     class __metaclass__(type):
         '''Creates the metaclass for Model. The main function of this metaclass
-        is to move all of fields into the _fields variable on the class.
+        is to move all of fields into the _fields variable on the class,
+        along with the fields inherited from its bases.
 
         '''
-        def __init__(cls, name, bases, attrs):
-            cls._clsfields = {}
-            for key, value in attrs.iteritems():
+        def __new__(mcs, name, bases, attrs):
+            declared = {}
+            for key, value in attrs.items():
                 if isinstance(value, BaseField):
-                    cls._clsfields[key] = value
-                    cls._fields = cls._clsfields
-                    delattr(cls, key)
+                    declared[key] = value
+                    del attrs[key]
+            attrs['_declared_fields'] = declared
+            compact = attrs.get('_compact', any(getattr(base, '_compact', False)
+                                                for base in bases))
+            if compact:
+                # Every field that may be inherited, and the state the
+                # instances use, gets a slot, unless a base already has one.
+                names = set(declared)
+                for key, flag in _INSTANCE_STATE.iteritems():
+                    if flag is None or attrs.get(flag, any(
+                            getattr(base, flag, False) for base in bases)):
+                        names.add(key)
+                for base in bases:
+                    names.update(key for key in getattr(base, '_clsfields', ())
+                                 if key not in attrs)
+                attrs['__slots__'] = tuple(
+                    key for key in names if not any(
+                        isinstance(getattr(base, key, None),
+                                   types.MemberDescriptorType)
+                        for base in bases))
+            cls = type.__new__(mcs, name, bases, attrs)
+            # Fields are inherited in the order of the MRO, unless a class
+            # closer to this one declares another attribute with that name.
+            fields = {}
+            for klass in reversed(cls.__mro__):
+                for key, value in vars(klass).iteritems():
+                    if key in fields and not isinstance(
+                            value, types.MemberDescriptorType):
+                        del fields[key]
+                fields.update(vars(klass).get('_declared_fields', {}))
+            cls._clsfields = cls._fields = fields
+            return cls
+
+    #: Fields added to an instance with :meth:`add_field`.
+    _extra = None
+
+    #: Whether field values are stored in ``__slots__``.
+    _compact = False
+
+    #: Whether :meth:`from_dict` converts fields on first access.
+    _lazy = False
+
+    #: The source dictionary of a lazy instance.
+    _raw = None
+
+    #: Name of the field identifying instances in the identity map.
+    _key = None
+
+    #: Number of instances kept by the identity map.
+    _identity_size = 10000
+
+    #: What the identity map does with other data for a known key:
+    #: ``'error'``, ``'replace'`` or ``'keep'``.
+    _key_conflict = 'error'
+
+    #: Names of the fields assigned since the instance was loaded.
+    _changed = None
+
+    #: Whether instances keep the JSON text returned by :meth:`to_json`.
+    _cache_json = False
+
+    #: Whether instances are hashed by the values of their fields.
+    _hashable = False
+
+    #: The serialized forms kept by an instance: JSON texts by backend or
+    #: encode function, and the ``'fingerprint'``.
+    _json_texts = None
+
+    #: The instances holding this one in a field, which have cached
+    #: serialized forms, weakly referenced by id: equal hashable instances
+    #: must all be registered, and dropped ones are forgotten.
+    _parents = None
 
     def __init__(self):
-        super(Model, self).__setattr__('_extra', {})
         for name, field in self._clsfields.iteritems():
-            setattr(self, name, field.default)
+            object.__setattr__(self, name, field.converter()(field.default))
 
     def __eq__(self, other):
-        eq = type(other) == type(self)
-        if eq:
-            for name, field in self._clsfields.iteritems():
-                eq = eq and getattr(self, name) == getattr(other, name)
-        return eq
+        cls = type(self)
+        try:
+            return cls.__dict__['_comparisons'][0](self, other)
+        except KeyError:
+            return cls._get_comparisons()[0](self, other)
+
+    def __ne__(self, other):
+        return not self == other
 
+    def __hash__(self):
+        '''Instances of classes setting ``_hashable = True`` are hashed by
+        the values of their fields, like they are compared, and must not be
+        modified while they are held in a set or used as a dictionary key.
+        Other instances are hashed by identity.
+
+        '''
+        cls = type(self)
+        if not cls._hashable:
+            return object.__hash__(self)
+        try:
+            return cls.__dict__['_comparisons'][1](self)
+        except KeyError:
+            return cls._get_comparisons()[1](self)
 
     @classmethod
-    def from_dict(cls, D, is_json=False):
+    def _get_comparisons(cls):
+        '''Returns the functions generated for this class by
+        :func:`_compile_comparisons`, compiling them on first use.
+
+        '''
+        try:
+            return cls.__dict__['_comparisons']
+        except KeyError:
+            comparisons = _compile_comparisons(cls)
+            setattr(cls, '_comparisons', comparisons)
+            return comparisons
+
+    def fingerprint(self):
+        '''Returns the SHA-1 digest, in hexadecimal, of the JSON text of
+        ``to_dict(serial=True)`` with sorted keys, a stable fingerprint of
+        the values of the fields suitable as an ETag, or for deduplicating
+        instances. The digest is cached until the instance, or a model
+        nested in it, is assigned a field.
+
+        '''
+        digest = self._json_texts and self._json_texts.get('fingerprint')
+        if not digest:
+            import hashlib
+            from json import dumps
+            text = dumps(self.to_dict(serial=True), sort_keys=True,
+                         separators=(',', ':'))
+            digest = hashlib.sha1(text).hexdigest()
+            self._keep_json('fingerprint', digest)
+        return digest
+
+
+    @classmethod
+    def from_dict(cls, D, is_json=False, backend=None):
         '''This factory for :class:`Model`
         takes either a native Python dictionary or a JSON dictionary/object
         if ``is_json`` is ``True``. The dictionary passed does not need to
         contain all of the values that the Model declares.
+
+        JSON is decoded with the default backend of
+        :mod:`micromodels.backends`, or the one called ``backend``.
         '''
+        if is_json:
+            D = json.decode(D, backend)
+        if isinstance(D, dict):
+            decode = cls._get_decoder()
+            if decode is not None:
+                return decode(D)
         instance = cls()
-        instance.set_data(D, is_json=is_json)
+        instance.set_data(D)
+        return instance
+
+    @classmethod
+    def from_dicts(cls, rows, is_json=False, generator=False, backend=None):
+        '''Decodes every dictionary of the iterable ``rows`` (or JSON
+        object, if ``is_json`` is ``True``) into an instance of the class,
+        like :meth:`from_dict` would. The class-level work is done once, and
+        rows are then decoded in a tight loop.
+
+        JSON is decoded with the default backend of
+        :mod:`micromodels.backends`, or the one called ``backend``. A list is
+        returned, or a generator if ``generator`` is ``True``.
+
+        '''
+        decode = cls._get_decoder() or cls.from_dict
+        if is_json:
+            rows = imap(json.get(backend).decode, rows)
+        if generator:
+            return imap(decode, rows)
+        return map(decode, rows)
+
+    @classmethod
+    def iter_json(cls, fileobj, path=None, chunk_size=65536):
+        '''Reads a JSON array from the file-like object ``fileobj`` in
+        chunks of ``chunk_size`` bytes, and yields an instance of the class
+        for each of its objects as soon as it has been read. Memory use does
+        not depend on the size of the array.
+
+        If ``path`` is given, the array is looked up under that key, or list
+        of keys, of the top-level object, e.g. ``path='statuses'`` for
+        ``{"statuses": [...]}``. See
+        :class:`~micromodels.streaming.JSONArrayDecoder`.
+
+        '''
+        return cls.from_dicts(iter_json_array(fileobj, path, chunk_size),
+                              generator=True)
+
+    @classmethod
+    def read_jsonl(cls, path_or_file, chunk_size=65536):
+        '''Yields an instance of the class for every line of a `JSON Lines
+        <http://jsonlines.org/>`_ file, given as a path or as a file-like
+        object, read in chunks of ``chunk_size`` bytes. Gzip-compressed
+        files are decompressed transparently.
+
+        '''
+        if isinstance(path_or_file, basestring):
+            with open(path_or_file, 'rb') as fileobj:
+                for instance in cls.read_jsonl(fileobj, chunk_size):
+                    yield instance
+            return
+        for instance in cls.from_dicts(iter_lines(path_or_file, chunk_size),
+                                       is_json=True, generator=True):
+            yield instance
+
+    @classmethod
+    def write_jsonl(cls, path_or_file, instances, compress=None,
+                    chunk_size=65536):
+        '''Writes each of ``instances`` as a line of JSON, to a JSON Lines
+        file given as a path or as a file-like object, in chunks of about
+        ``chunk_size`` bytes. The output is gzip-compressed if ``compress`` is
+        ``True`` or, by default, if the path ends with ``.gz``.
+
+        '''
+        if isinstance(path_or_file, basestring):
+            if compress is None:
+                compress = path_or_file.endswith('.gz')
+            with open(path_or_file, 'wb') as fileobj:
+                cls.write_jsonl(fileobj, instances, compress, chunk_size)
+            return
+        lines = (instance.to_json(direct=True) for instance in instances)
+        write_lines(path_or_file, lines, compress, chunk_size)
+
+    @classmethod
+    def write_records(cls, path_or_file, instances):
+        '''Writes ``instances`` to a record file, given as a path or as a
+        file-like object positioned at its start. Each instance is encoded
+        like :meth:`to_binary` does, and an index of their offsets is added,
+        so that :meth:`open_records` can read any of them directly.
+
+        '''
+        if isinstance(path_or_file, basestring):
+            with open(path_or_file, 'wb') as fileobj:
+                cls.write_records(fileobj, instances)
+            return
+        with RecordWriter(path_or_file, cls) as writer:
+            writer.extend(instances)
+
+    @classmethod
+    def open_records(cls, path):
+        '''Maps the record file at ``path``, written by
+        :meth:`write_records`, in memory, and returns a
+        :class:`~micromodels.records.RecordFile` decoding its records into
+        instances of the class on demand.
+
+        '''
+        return RecordFile(path, cls)
+
+    @classmethod
+    def dump_json_array(cls, fileobj, instances, backend=None,
+                        chunk_size=65536):
+        '''Writes a JSON array of ``instances``, which may be any iterable,
+        to the file-like object or socket ``fileobj``. Each instance is
+        encoded like :meth:`to_json` does with ``direct=True``, and the text
+        is written in chunks of about ``chunk_size`` bytes, so memory use
+        does not depend on the number of instances.
+
+        '''
+        encode = json.get(backend).encode
+        write_chunks(fileobj, _json_array(
+            instance._write_json(encode) for instance in instances),
+            chunk_size)
+
+    @classmethod
+    def stream_decoder(cls, framing='lines', path=None):
+        '''Returns a :class:`~micromodels.streaming.StreamDecoder`, which
+        decodes instances of the class incrementally from data fed to it as
+        it arrives, e.g. from a socket. ``framing`` is ``'lines'`` for JSON
+        Lines, or ``'array'`` for the items of a JSON array found at
+        ``path``.
+
+        '''
+        return StreamDecoder(cls, framing, path)
+
+    @classmethod
+    def from_json_many(cls, lines, workers=None, chunksize=1000):
+        '''Decodes every JSON object of the iterable ``lines`` into an
+        instance of the class, spreading the work across a pool of
+        ``workers`` processes (by default, one per CPU). The JSON text is
+        sent to the workers in chunks of ``chunksize`` lines, and the field
+        values of each instance are sent back. A list of instances is
+        returned, in the order of ``lines``.
+
+        The class must be importable by the workers, i.e. defined at the top
+        level of a module. With ``workers=1``, everything runs in the current
+        process.
+
+        '''
+        return parallel.decode_many(cls, lines, workers, chunksize)
+
+    @classmethod
+    def to_json_many(cls, instances, workers=None, chunksize=1000):
+        '''The counterpart of :meth:`from_json_many`: returns the list of the
+        :meth:`to_json` representations of ``instances``, computed by a pool
+        of ``workers`` processes. Only the fields declared on the class are
+        encoded.
+
+        '''
+        return parallel.encode_many(cls, instances, workers, chunksize)
+
+    @classmethod
+    def _get_decoder(cls):
+        '''Returns the decoder generated for this class by
+        :func:`_compile_decoder`, compiling it on first use.
+
+        '''
+        try:
+            return cls.__dict__['_decoder']
+        except KeyError:
+            decoder = _compile_decoder(cls)
+            setattr(cls, '_decoder', decoder)
+            return decoder
+
+    @classmethod
+    def _from_nested(cls, D):
+        '''Decodes the dictionary ``D`` nested in another model, going
+        through the identity map of the class if it has a ``_key``.
+
+        '''
+        if cls._key is None or not isinstance(D, dict):
+            return cls.from_dict(D)
+        identities, source = cls._get_identity_map()
+        key = D.get(source)
+        if key is None:
+            return cls.from_dict(D)
+        known = identities.get(key)
+        if known is not None:
+            data, instance = known
+            if (data is D or cls._key_conflict == 'keep' or
+                    not cls._conflicts(data, D)):
+                return instance
+            if cls._key_conflict != 'replace':
+                raise ValueError('Conflicting data for the %s with %s %r'
+                                 % (cls.__name__, cls._key, key))
+        instance = cls.from_dict(D)
+        identities[key] = (D, instance)
         return instance
 
+    @classmethod
+    def _conflicts(cls, data, D):
+        '''Whether the source dictionaries ``data`` and ``D`` hold different
+        values for a declared field.
+
+        '''
+        for source in cls._get_plan()[1]:
+            if source in data and source in D and data[source] != D[source]:
+                return True
+        return False
+
+    @classmethod
+    def _get_identity_map(cls):
+        '''Returns the identity map of the class, mapping keys to their
+        source dictionary and instance, along with the source key of the
+        ``_key`` field.
+
+        '''
+        try:
+            return cls.__dict__['_identity_map']
+        except KeyError:
+            if cls._key not in cls._clsfields:
+                raise ValueError('%s._key names no field: %r'
+                                 % (cls.__name__, cls._key))
+            identity_map = (LRUCache(cls._identity_size),
+                            cls._clsfields[cls._key].source or cls._key)
+            setattr(cls, '_identity_map', identity_map)
+            return identity_map
+
+    @classmethod
+    def clear_identity_map(cls):
+        '''Forgets the instances shared by the identity map of the class,
+        e.g. at the end of a decoding session.
+
+        '''
+        identity_map = cls.__dict__.get('_identity_map')
+        if identity_map is not None:
+            identity_map[0].clear()
+
+    @classmethod
+    def from_binary(cls, data):
+        '''Builds an instance from the output of :meth:`to_binary`, either
+        base64 text or raw bytes. This is faster than calling :meth:`loads`
+        on a new instance, as no default value is converted first.
+
+        '''
+        if not binary.is_binary(data):
+            import base64
+            data = base64.b64decode(data)
+        return binary.loads(cls, data)
+
+    @classmethod
+    def _get_serializers(cls, lazy=False):
+        '''Returns the serializers generated for this class by
+        :func:`_compile_serializers`, or their ``lazy`` variant, compiling
+        them on first use.
+
+        '''
+        key = '_lazy_serializers' if lazy else '_serializers'
+        try:
+            return cls.__dict__[key]
+        except KeyError:
+            serializers = _compile_serializers(cls, lazy)
+            setattr(cls, key, serializers)
+            return serializers
+
     @classmethod
     def from_kwargs(cls, **kwargs):
         '''This factory for :class:`Model` only takes keywork arguments.
@@ -94,80 +810,392 @@ class Model(object):
         instance.set_data(kwargs)
         return instance
 
-    def set_data(self, data, is_json=False, is_binary=False):
+    def set_data(self, data, is_json=False, is_binary=False, backend=None,
+                 delta=False):
+        '''Loads the values of the fields from ``data``: a dictionary, a
+        JSON object if ``is_json`` is ``True``, the output of
+        :meth:`to_binary` if ``is_binary`` is ``True``, or another instance.
+        Fields missing from a dictionary keep their value, and the instance
+        is then clean, as after :meth:`mark_clean`.
+
+        With ``delta=True``, ``data`` is a dictionary holding new values for
+        some fields, which are assigned as if set one by one, so they are
+        tracked as changed. Only the keys of ``data`` are looked at.
+
+        '''
         if is_json:
-            data = json.decode(data)
+            data = json.decode(data, backend)
 
-        if is_binary:
-            data = cPickle.loads(base64.b64decode(data))
-            for key, field in data._clsfields.iteritems():
-                self.__dict__[key] = data.__dict__[key]
+        if delta:
+            sources = self._get_plan()[1]
+            extra = self._extra
+            for key, value in data.iteritems():
+                for name, source, convert in sources.get(key, ()):
+                    self.__setattr__(name, value)
+                if extra and key in extra and key not in sources:
+                    self.__setattr__(key, value)
             return
 
-        if isinstance(data, self.__class__):
-            data = data.to_dict()
+        if is_binary:
+            if not binary.is_binary(data):
+                import base64
+                data = base64.b64decode(data)
+            binary.loads(type(self), data, self)
+        elif isinstance(data, self.__class__):
+            # The values of another instance are already converted, but the
+            # lists of collection fields are copied so they aren't shared.
+            for name, field in self._clsfields.iteritems():
+                value = getattr(data, name)
+                if value is not None and isinstance(
+                        field, (FieldCollectionField, ModelCollectionField)):
+                    value = list(value)
+                object.__setattr__(self, name, value)
+        else:
+            plan, sources = self._get_plan()
+            setter = object.__setattr__
+            if len(data) < len(plan):
+                # Sparse data: only its keys are looked up.
+                for key in data:
+                    for name, source, convert in sources.get(key, ()):
+                        setter(self, name, convert(data[key]))
+            else:
+                for name, source, convert in plan:
+                    if source in data:
+                        setter(self, name, convert(data[source]))
+        self.clear_json_cache()
+        self.mark_clean()
 
-        for name, field in self._clsfields.iteritems():
-            key = field.source or name
-            if key in data:
-                self.__setattr__(name, data.get(key))
+    @classmethod
+    def _get_plan(cls):
+        '''Returns the plan :meth:`set_data` follows to decode a
+        dictionary: a tuple of the ``(name, source key, converter)`` of every
+        field of the class, sorted by name, along with a dictionary mapping
+        each source key to the tuple of the entries reading it. The plan is
+        built on first use.
+
+        '''
+        try:
+            return cls.__dict__['_plan']
+        except KeyError:
+            plan = tuple(sorted((name, field.source or name, field.converter())
+                                for name, field in cls._clsfields.iteritems()))
+            sources = {}
+            for entry in plan:
+                sources[entry[1]] = sources.get(entry[1], ()) + (entry,)
+            setattr(cls, '_plan', (plan, sources))
+            return cls.__dict__['_plan']
 
     def __setattr__(self, key, value):
-        if key in self._fields:
-            field = self._fields[key]
-            field.populate(value)
-            self.__dict__[key] = field.to_python()
+        field = self._fields.get(key)
+        if field is None and self._extra:
+            field = self._extra.get(key)
+        if field is not None:
+            object.__setattr__(self, key, field.converter()(value))
+            changed = self._changed
+            if changed is None:
+                changed = set()
+                object.__setattr__(self, '_changed', changed)
+            changed.add(key)
+            if self._json_texts is not None or self._parents is not None:
+                self.clear_json_cache()
         else:
             self.__dict__[key] = value
 
+    def changed_fields(self):
+        '''Returns the set of the names of the fields assigned since the
+        instance was loaded, or since :meth:`mark_clean` was called.
+
+        '''
+        return set(self._changed or ())
+
+    def mark_clean(self):
+        '''Forgets which fields were assigned, e.g. once the changes have
+        been saved.
+
+        '''
+        if self._changed is not None:
+            _discard(self, '_changed')
+
+    def __getattr__(self, key):
+        field = self._clsfields.get(key)
+        if field is None:
+            if key in _INSTANCE_STATE:
+                # An empty slot of a compact instance.
+                return None
+            raise AttributeError(key)
+        if self._raw is None:
+            raise AttributeError(key)
+        value = self._raw.get(field.source or key, field.default)
+        value = field.converter()(value)
+        object.__setattr__(self, key, value)
+        return value
+
+    def __getstate__(self):
+        state = dict((name, getattr(self, name)) for name in self._clsfields
+                     if hasattr(self, name))
+        if self.__dict__:
+            state.update(self.__dict__)
+            state.pop('_raw', None)
+            state.pop('_changed', None)
+            state.pop('_json_texts', None)
+            state.pop('_parents', None)
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.iteritems():
+            object.__setattr__(self, key, value)
+
     def add_field(self, key, value, field):
         ''':meth:`add_field` must be used to add a field to an existing
         instance of Model. This method is required so that serialization of the
         data is possible. Data on existing fields (defined in the class) can be
         reassigned without using this method.
 
+        The field is only added to this instance, not to the class.
+
         '''
-        self._fields[key] = field
+        if self._extra is None:
+            super(Model, self).__setattr__('_extra', {})
+        self._extra[key] = field
         self.__setattr__(key, value)
 
-    def to_dict(self, serial=False):
+    def to_dict(self, serial=False, changed_only=False):
         '''A dictionary representing the the data of the class is returned.
         Native Python objects will still exist in this dictionary (for example,
         a ``datetime`` object will be returned rather than a string)
         unless ``serial`` is set to True.
 
+        If ``changed_only`` is ``True``, only the fields returned by
+        :meth:`changed_fields` are included.
+
         '''
+        if changed_only:
+            extra = self._extra or {}
+            fields = [(key, self._fields.get(key) or extra[key])
+                      for key in self._changed or ()]
+        else:
+            if serial and not self._extra:
+                try:
+                    return self._get_serializers(
+                        self._raw is not None)[0](self)
+                except (KeyError, AttributeError):
+                    pass
+            fields = self._fields.items()
+            if self._extra:
+                fields += self._extra.items()
+        if serial and self._raw is not None:
+            return dict(self._lazy_serial_items(fields))
         if serial:
-            return dict((key, self._fields[key].to_serial(getattr(self, key)))
-                        for key in self._fields.keys() if hasattr(self, key))
+            return dict((key, field.to_serial(getattr(self, key)))
+                        for key, field in fields if hasattr(self, key))
         else:
-            return dict((key, getattr(self, key)) for key in self._fields.keys()
+            return dict((key, getattr(self, key)) for key, field in fields
                        if hasattr(self, key))
 
-    def to_json(self):
+    @classmethod
+    def to_dicts(cls, instances, serial=False, generator=False):
+        '''The counterpart of :meth:`from_dicts`: returns the
+        :meth:`to_dict` representation of every instance of the iterable
+        ``instances``, as a list or as a generator if ``generator`` is
+        ``True``.
+
+        '''
+        to_dict = lambda instance: instance.to_dict(serial=serial)
+        if generator:
+            return imap(to_dict, instances)
+        return map(to_dict, instances)
+
+    def _lazy_serial_items(self, fields):
+        raw = self._raw
+        loaded = self.__dict__
+        for key, field in fields:
+            source = field.source or key
+            if (key not in loaded and source in raw and
+                    type(raw[source]) in _SERIAL_TYPES.get(type(field), ()) and
+                    not (self._compact and _is_set(self, key))):
+                yield key, raw[source]
+            else:
+                yield key, field.to_serial(getattr(self, key))
+
+    def to_json(self, backend=None, direct=False, changed_only=False):
         '''Returns a representation of the model as a JSON string. This method
-        relies on the :meth:`~micromodels.Model.to_dict` method.
+        relies on the :meth:`~micromodels.Model.to_dict` method, and only
+        includes the fields returned by :meth:`changed_fields` if
+        ``changed_only`` is ``True``.
+
+        The JSON is encoded with the default backend of
+        :mod:`micromodels.backends`, or the one called ``backend``.
+
+        If ``direct`` is ``True``, the JSON text is written straight from the
+        values of the fields by a function generated for the class, without
+        building the dictionary first. Only values of types other than
+        strings, numbers and booleans are passed to the backend. The output
+        is compact, with the keys in alphabetical order.
+
+        '''
+        if changed_only:
+            return json.encode(self.to_dict(serial=True, changed_only=True),
+                               backend)
+        if direct:
+            return self._write_json(json.get(backend).encode)
+        if self._cache_json:
+            encoder = json.get(backend)
+            text = self._json_texts and self._json_texts.get(encoder)
+            if not text:
+                text = encoder.encode(self.to_dict(serial=True))
+                self._keep_json(encoder, text)
+            return text
+        return json.encode(self.to_dict(serial=True), backend)
+
+    def dump_json(self, fileobj, backend=None, chunk_size=65536):
+        '''Writes the JSON text of :meth:`to_json`, with ``direct=True``,
+        to the file-like object or socket ``fileobj`` in chunks of about
+        ``chunk_size`` bytes. The items of model collection fields are
+        encoded and written one at a time, so huge collections are never
+        held in memory as dictionaries or as a single string.
 
         '''
-        return json.encode(self.to_dict(serial=True))
+        write_chunks(fileobj, self._iter_json(json.get(backend).encode),
+                     chunk_size)
 
-    def to_binary(self):
-        return base64.b64encode(cPickle.dumps(self))
+    def _iter_json(self, encode):
+        '''Yields the JSON text of :meth:`dump_json` piece by piece.'''
+        from json.encoder import encode_basestring_ascii
+        fields = sorted(self._fields.items())
+        if self._extra:
+            fields = sorted(fields + self._extra.items())
+        separator = '{'
+        for key, field in fields:
+            if not hasattr(self, key):
+                continue
+            yield separator + encode_basestring_ascii(key) + ':'
+            separator = ','
+            value = getattr(self, key)
+            if type(field) is ModelCollectionField and value is not None:
+                for piece in _json_array(item._write_json(encode)
+                                         for item in value):
+                    yield piece
+            elif type(field) is ModelField and isinstance(value, Model):
+                for piece in value._iter_json(encode):
+                    yield piece
+            else:
+                yield _json_text(field.to_serial(value), encode,
+                                 encode_basestring_ascii)
+        yield '}' if separator == ',' else '{}'
+
+    def _write_json(self, encode):
+        '''Returns the JSON text of :meth:`to_json` with ``direct=True``,
+        using the ``encode`` function of a backend.
+
+        '''
+        if self._cache_json and self._json_texts is not None:
+            text = self._json_texts.get(encode)
+            if text is not None:
+                return text
+        text = None
+        if not self._extra:
+            try:
+                text = self._get_serializers(
+                    self._raw is not None)[1](self, encode)
+            except (KeyError, AttributeError):
+                pass
+        if text is None:
+            text = encode(self.to_dict(serial=True))
+        if self._cache_json:
+            self._keep_json(encode, text)
+        return text
+
+    def _keep_json(self, key, text):
+        '''Caches the JSON ``text`` under ``key``, and registers the
+        instance with the models nested in it, which discard the text when
+        they change.
+
+        '''
+        texts = self._json_texts
+        if texts is None:
+            texts = {}
+            object.__setattr__(self, '_json_texts', texts)
+            self._link_nested(set())
+        texts[key] = text
+
+    def _link_nested(self, seen):
+        '''Registers the instance with the models nested in it, and these
+        with their own nested models, at any depth, so that a change to any
+        of them reaches the instance. ``seen`` holds the ids of the models
+        already walked.
+
+        '''
+        seen.add(id(self))
+        for child in self._nested_models():
+            if child._parents is None:
+                object.__setattr__(child, '_parents', WeakValueDictionary())
+            child._parents[id(self)] = self
+            if id(child) not in seen:
+                child._link_nested(seen)
+
+    def _nested_models(self):
+        '''Yields the models held by the fields of the instance.'''
+        fields = self._fields.items()
+        if self._extra:
+            fields += self._extra.items()
+        for name, field in fields:
+            if not isinstance(field, (WrappedObjectField,
+                                      FieldCollectionField)):
+                continue
+            value = getattr(self, name, None)
+            if isinstance(value, Model):
+                yield value
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, Model):
+                        yield item
+
+    def clear_json_cache(self):
+        '''Discards the JSON text and the fingerprint cached by the
+        instance, and by the models it is nested in, e.g. after modifying a
+        list held by a field in place.
+
+        '''
+        if self._json_texts is None and self._parents is None:
+            return
+        parents = self._parents or {}
+        _discard(self, '_json_texts')
+        _discard(self, '_parents')
+        for parent in parents.values():
+            parent.clear_json_cache()
+
+    def to_binary(self, raw=False):
+        '''Returns a compact binary representation of the values of the
+        fields of the model, as base64 text, or as a byte string if ``raw``
+        is ``True``. Both are restored by :meth:`from_binary`, or by
+        :meth:`loads` with ``binary=True``.
+
+        The format relies on the fields declared on the class, which must be
+        the same when the data is loaded, and only contains plain values, so
+        it can safely be loaded from an untrusted source. See
+        :mod:`micromodels.binary`.
+
+        '''
+        data = binary.dumps(self)
+        if raw:
+            return data
+        import base64
+        return base64.b64encode(data)
 
-    def loads(self, data, binary=False):
+    def loads(self, data, binary=False, backend=None):
         '''
         Makes restoring from JSON simplier.
         '''
         if binary:
             self.set_data(data, is_binary=True)
         else:
-            self.set_data(data, is_json=True)
+            self.set_data(data, is_json=True, backend=backend)
 
-    def dumps(self, binary=False):
+    def dumps(self, binary=False, backend=None):
         '''
         Alias for :meth:`~micromodels.Model.to_json` method.
         '''
         if binary:
             return self.to_binary()
         else:
-            return self.to_json()
+            return self.to_json(backend)
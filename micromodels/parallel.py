@@ -0,0 +1,82 @@
+from itertools import imap, islice
+from operator import attrgetter
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _getter(names):
+    '''Returns a function returning the tuple of the ``names`` attributes of
+    an instance.
+
+    '''
+    if not names:
+        return lambda instance: ()
+    if len(names) == 1:
+        get = attrgetter(names[0])
+        return lambda instance: (get(instance),)
+    return attrgetter(*names)
+
+
+def _restore(cls, names, rows):
+    '''Builds instances of ``cls`` from tuples of the values of the fields
+    ``names``, as returned by :func:`_getter`.
+
+    '''
+    new = cls.__new__ if cls._get_decoder() is not None else None
+    for values in rows:
+        instance = new(cls) if new else cls()
+        for name, value in zip(names, values):
+            object.__setattr__(instance, name, value)
+        yield instance
+
+
+def _decode_chunk(task):
+    cls, names, lines = task
+    return map(_getter(names), cls.from_dicts(lines, is_json=True))
+
+
+def _encode_chunk(task):
+    cls, names, rows = task
+    return [instance.to_json() for instance in _restore(cls, names, rows)]
+
+
+def _run(worker, cls, names, items, workers, chunksize):
+    '''Runs ``worker`` on chunks of ``items`` in a pool of ``workers``
+    processes, and yields its results in order.
+
+    '''
+    tasks = ((cls, names, chunk) for chunk in _chunks(items, chunksize))
+    if workers == 1:
+        results = (worker(task) for task in tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(worker, tasks)
+    try:
+        for result in results:
+            for item in result:
+                yield item
+    finally:
+        if workers != 1:
+            pool.terminate()
+
+
+def decode_many(cls, lines, workers=None, chunksize=1000):
+    '''See :meth:`micromodels.Model.from_json_many`.'''
+    names = tuple(cls._clsfields)
+    rows = _run(_decode_chunk, cls, names, lines, workers, chunksize)
+    return list(_restore(cls, names, rows))
+
+
+def encode_many(cls, instances, workers=None, chunksize=1000):
+    '''See :meth:`micromodels.Model.to_json_many`.'''
+    names = tuple(cls._clsfields)
+    rows = imap(_getter(names), instances)
+    return list(_run(_encode_chunk, cls, names, rows, workers, chunksize))
@@ -0,0 +1,149 @@
+'''Record files: instances of a model stored on disk, one after the other,
+and read back by position without loading the file.
+
+A record file starts with a header made of ``MMRF``, the version of the
+format and the checksum of the field layout of the model, followed by the
+fields of every instance encoded as in :mod:`micromodels.binary`. An index
+of the offset of every record follows them, and the file ends with the
+offset of that index and the number of records.
+
+'''
+import mmap
+import struct
+
+from . import binary
+
+
+VERSION = 1
+_MAGIC = 'MMRF'
+_HEADER = struct.Struct('<4sBi')
+_FOOTER = struct.Struct('<QQ')
+_OFFSET = struct.Struct('<Q')
+
+
+class RecordWriter(object):
+    """Writes instances of the :class:`~micromodels.Model` class ``model``
+    to the file-like object ``fileobj``, which must be positioned at its
+    start. The index is written by :meth:`close`, which must be called once
+    every instance has been appended, and leaves ``fileobj`` open.
+
+    """
+    def __init__(self, fileobj, model):
+        self._fileobj = fileobj
+        self._model = model
+        self._offsets = []
+        self._position = _HEADER.size
+        fileobj.write(_HEADER.pack(_MAGIC, VERSION, binary.checksum(model)))
+
+    def append(self, instance):
+        '''Writes ``instance`` at the end of the file.'''
+        if type(instance) is not self._model:
+            raise TypeError('Expected an instance of %s, got %r'
+                            % (self._model.__name__, instance))
+        data = binary.dump_fields(instance)
+        self._fileobj.write(data)
+        self._offsets.append(self._position)
+        self._position += len(data)
+
+    def extend(self, instances):
+        '''Writes every instance of the iterable ``instances``.'''
+        for instance in instances:
+            self.append(instance)
+
+    def close(self):
+        '''Writes the index of the records.'''
+        offsets = self._offsets
+        for start in xrange(0, len(offsets), 8192):
+            chunk = offsets[start:start + 8192]
+            self._fileobj.write(struct.pack('<%dQ' % len(chunk), *chunk))
+        self._fileobj.write(_FOOTER.pack(self._position, len(offsets)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+
+
+class RecordFile(object):
+    """A record file written by :class:`RecordWriter`, mapped in memory.
+
+    ``len()`` gives the number of records, and indexing the file decodes the
+    record at that position into an instance of ``model``, reading nothing
+    but its bytes. Slicing returns another :class:`RecordFile` sharing the
+    same mapping, so no record is read until it is indexed or iterated over::
+
+        >>> with Tweet.open_records('tweets.rec') as tweets:
+        ...     tweets[123456].text
+        ...     for tweet in tweets[1000:2000]:
+        ...         pass
+
+    Instances must not be decoded once the file has been closed.
+
+    """
+    def __init__(self, path, model, _parent=None, _indices=None):
+        self.model = model
+        if _parent is not None:
+            self._mmap, self._index = _parent._mmap, _parent._index
+            self._indices = _indices
+            return
+        with open(path, 'rb') as fileobj:
+            self._mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, checksum = _HEADER.unpack_from(self._mmap)
+            self._index, count = _FOOTER.unpack_from(
+                self._mmap, len(self._mmap) - _FOOTER.size)
+        except struct.error:
+            magic = None
+        if magic != _MAGIC or version != VERSION:
+            self.close()
+            raise ValueError('%s is not a record file, or uses an unsupported '
+                             'version of the format' % path)
+        if checksum != binary.checksum(model):
+            self.close()
+            raise ValueError('%s was written for another layout of %s'
+                             % (path, model.__name__))
+        self._indices = xrange(count)
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordFile(None, self.model, self, self._slice(index))
+        try:
+            position = self._indices[index]
+        except IndexError:
+            raise IndexError('RecordFile index out of range')
+        offset, = _OFFSET.unpack_from(self._mmap,
+                                      self._index + position * _OFFSET.size)
+        return binary.load_fields(self.model, self._mmap, offset)[0]
+
+    def _slice(self, index):
+        '''Returns the positions of the records selected by the slice
+        ``index``, as an :func:`xrange`.
+
+        '''
+        indices = self._indices
+        start, stop, step = index.indices(len(indices))
+        count = len(xrange(start, stop, step))
+        if not count:
+            return xrange(0)
+        first = indices[start]
+        step *= indices[1] - indices[0] if len(indices) > 1 else 1
+        return xrange(first, first + count * step, step)
+
+    def __iter__(self):
+        for index in xrange(len(self._indices)):
+            yield self[index]
+
+    def close(self):
+        '''Unmaps the file.'''
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
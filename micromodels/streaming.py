@@ -0,0 +1,336 @@
+from itertools import chain
+import re
+import zlib
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER_CHARACTERS = frozenset('0123456789.eE+-')
+_GZIP_MAGIC = '\x1f\x8b'
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class JSONArrayDecoder(object):
+    """Incremental parser for the items of a JSON array.
+
+    Data is passed in chunks of any size to :meth:`feed`, which returns the
+    items that were completed by that chunk, as decoded Python objects. Only
+    the current chunk and the item being parsed are kept in memory, so arrays
+    of any size can be decoded as they are read from a file or a socket.
+    :meth:`close` must be called once all the data has been fed, and raises
+    :class:`ValueError` if the input was incomplete.
+
+    The array is either the whole document or, if ``path`` is given, the
+    value found by following the keys of ``path`` (a list of keys or a
+    string of dot-separated keys) through nested objects. For example, the
+    path ``'statuses'`` selects the array in ``{"statuses": [...]}``. Other
+    keys of those objects are skipped, and anything after the array is
+    ignored.
+
+    """
+    def __init__(self, path=None):
+        if isinstance(path, basestring):
+            path = path.split('.')
+        self._path = list(path or [])
+        self._state = 'object' if self._path else 'array'
+        self._buffer = ''
+        self._pending = []
+        self._pending_size = 0
+        self._pos = 0
+        self._key = None
+        self._retry = 0
+        from json import JSONDecoder
+        self._decoder = JSONDecoder()
+
+    def feed(self, data):
+        '''Parses the chunk ``data``, and returns the list of items it
+        completed.
+
+        '''
+        self._pending.append(data)
+        self._pending_size += len(data)
+        # Only retry an incomplete value once the data has doubled, so large
+        # values spanning many chunks are neither copied nor parsed again for
+        # every chunk.
+        if len(self._buffer) - self._pos + self._pending_size < self._retry:
+            return []
+        self._join()
+        return self._parse(final=False)
+
+    def _join(self):
+        '''Appends the chunks fed since the last parse to the unparsed part
+        of the buffer.
+
+        '''
+        self._pending.insert(0, self._buffer[self._pos:])
+        self._buffer = ''.join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self._pos = 0
+
+    def close(self):
+        '''Signals the end of the input, and returns the last items.'''
+        self._join()
+        items = self._parse(final=True)
+        if self._state != 'done':
+            raise ValueError('Unexpected end of JSON input')
+        return items
+
+    @property
+    def done(self):
+        '''Whether the end of the array has been reached.'''
+        return self._state == 'done'
+
+    def _value(self, pos, final):
+        '''Decodes the value at ``pos``, returning it with the position
+        following it, or ``(None, None)`` when more data is needed.
+
+        '''
+        buffer = self._buffer
+        try:
+            value, end = self._decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if final:
+                raise
+            value, end = None, None
+        else:
+            # A number at the end of the buffer, or followed by what may be
+            # the start of its fraction or exponent, may continue in the next
+            # chunk. Any other value is complete.
+            if not final and buffer[pos] in _NUMBER_CHARACTERS and (
+                    end == len(buffer) or buffer[end] in _NUMBER_CHARACTERS):
+                self._retry = 0
+                return None, None
+        self._retry = 0 if end else 2 * (len(buffer) - pos)
+        return value, end
+
+    def _expect(self, char, expected):
+        if char not in expected:
+            raise ValueError('Expected %s, found %r at position %d'
+                             % (' or '.join(map(repr, expected)), char,
+                                self._pos))
+
+    def _parse(self, final):
+        items = []
+        buffer = self._buffer
+        while self._state != 'done':
+            pos = _WHITESPACE.match(buffer, self._pos).end()
+            if pos == len(buffer):
+                break
+            self._pos = pos
+            char = buffer[pos]
+            state = self._state
+
+            if state == 'object':
+                self._expect(char, '{')
+                self._state = 'key'
+            elif state == 'key':
+                if char == '}':
+                    raise KeyError(self._path[0])
+                self._expect(char, '"')
+                self._key, end = self._value(pos, final)
+                if end is None:
+                    break
+                self._pos = end
+                self._state = 'colon'
+                continue
+            elif state == 'colon':
+                self._expect(char, ':')
+                if self._key == self._path[0]:
+                    self._path.pop(0)
+                    self._state = 'object' if self._path else 'array'
+                else:
+                    self._state = 'skip'
+            elif state == 'skip':
+                value, end = self._value(pos, final)
+                if end is None:
+                    break
+                self._pos = end
+                self._state = 'next key'
+                continue
+            elif state == 'next key':
+                if char == '}':
+                    raise KeyError(self._path[0])
+                self._expect(char, ',')
+                self._state = 'key'
+            elif state == 'array':
+                self._expect(char, '[')
+                self._state = 'first item'
+            elif state == 'first item' and char == ']':
+                self._state = 'done'
+            elif state in ('first item', 'item'):
+                value, end = self._value(pos, final)
+                if end is None:
+                    break
+                items.append(value)
+                self._pos = end
+                self._state = 'next item'
+                continue
+            elif state == 'next item':
+                self._expect(char, ',]')
+                self._state = 'item' if char == ',' else 'done'
+            self._pos = pos + 1
+        return items
+
+
+def iter_json_array(fileobj, path=None, chunk_size=65536):
+    '''Yields the items of the JSON array read from ``fileobj``, decoded
+    incrementally with :class:`JSONArrayDecoder`.
+
+    '''
+    decoder = JSONArrayDecoder(path)
+    while not decoder.done:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        for item in decoder.feed(chunk):
+            yield item
+    for item in decoder.close():
+        yield item
+
+
+class LineSplitter(object):
+    """Incremental splitter for newline-delimited data, such as `JSON Lines
+    <http://jsonlines.org/>`_. :meth:`feed` takes chunks of any size and
+    returns the non-blank lines they completed, without their line endings.
+
+    """
+    def __init__(self):
+        self._pending = ''
+
+    def feed(self, data):
+        '''Splits the chunk ``data``, and returns the list of lines it
+        completed.
+
+        '''
+        lines = data.split('\n')
+        lines[0] = self._pending + lines[0]
+        self._pending = lines.pop()
+        return [line for line in lines if line and not line.isspace()]
+
+    def close(self):
+        '''Signals the end of the input, and returns the last line, if it
+        was not terminated by a line feed.
+
+        '''
+        line, self._pending = self._pending, ''
+        return [line] if line and not line.isspace() else []
+
+
+class StreamDecoder(object):
+    """Incremental decoder of a stream of JSON objects into instances of the
+    :class:`~micromodels.Model` class ``model``.
+
+    The objects are either the lines of a JSON Lines stream, if ``framing``
+    is ``'lines'``, or the items of a JSON array if it is ``'array'``, in
+    which case ``path`` is passed on to :class:`JSONArrayDecoder`.
+
+    The decoder does no I/O: the data is passed to :meth:`feed` as it
+    arrives, in chunks of any size, and the instances completed by each
+    chunk are returned. This lets any event loop decode models from a socket
+    as the data comes in, without buffering whole bodies, e.g. from the
+    ``data_received`` callback of a protocol. The time spent in a single
+    call is bounded by the size of the chunk passed, so an event loop can
+    feed large bodies in slices, or call :meth:`feed` from a thread pool.
+
+    """
+    def __init__(self, model, framing='lines', path=None):
+        if framing == 'lines':
+            self._parser = LineSplitter()
+            self._decode = lambda lines: model.from_dicts(lines, is_json=True)
+        elif framing == 'array':
+            self._parser = JSONArrayDecoder(path)
+            self._decode = model.from_dicts
+        else:
+            raise ValueError('Unknown framing %r' % framing)
+
+    def feed(self, data):
+        '''Decodes the chunk ``data``, and returns the list of instances it
+        completed.
+
+        '''
+        return self._decode(self._parser.feed(data))
+
+    def close(self):
+        '''Signals the end of the stream, and returns the last instances.'''
+        return self._decode(self._parser.close())
+
+
+def _gunzip(chunks):
+    '''Decompresses the chunks of a gzip stream, which may be made of several
+    concatenated members.
+
+    '''
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+            if chunk:
+                yield decompressor.flush()
+                decompressor = zlib.decompressobj(_GZIP_WBITS)
+    yield decompressor.flush()
+
+
+def iter_lines(fileobj, chunk_size=65536):
+    '''Yields the non-blank lines read from ``fileobj`` in chunks of
+    ``chunk_size`` bytes, without their line endings. Gzip-compressed input
+    is detected and decompressed on the fly.
+
+    '''
+    chunks = iter(lambda: fileobj.read(chunk_size), '')
+    first = next(chunks, '')
+    chunks = chain([first], chunks)
+    if first.startswith(_GZIP_MAGIC):
+        chunks = _gunzip(chunks)
+    splitter = LineSplitter()
+    for chunk in chunks:
+        for line in splitter.feed(chunk):
+            yield line
+    for line in splitter.close():
+        yield line
+
+
+def _chunks(pieces, chunk_size):
+    '''Joins the strings of ``pieces`` into chunks of about ``chunk_size``
+    bytes.
+
+    '''
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    yield ''.join(buffer)
+
+
+def _lines(lines):
+    for line in lines:
+        yield line
+        yield '\n'
+
+
+def write_lines(fileobj, lines, compress=False, chunk_size=65536):
+    '''Writes every string of ``lines`` to ``fileobj``, followed by a line
+    feed, in chunks of about ``chunk_size`` bytes, gzip-compressing them if
+    ``compress`` is ``True``.
+
+    '''
+    compressor = compress and zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+    for data in _chunks(_lines(lines), chunk_size):
+        fileobj.write(compressor.compress(data) if compressor else data)
+    if compressor:
+        fileobj.write(compressor.flush())
+
+
+def write_chunks(fileobj, pieces, chunk_size=65536):
+    '''Writes the strings of ``pieces`` to ``fileobj`` in chunks of about
+    ``chunk_size`` bytes, so that only one chunk is held in memory at a time.
+    ``fileobj`` is a file-like object, or a socket.
+
+    '''
+    write = getattr(fileobj, 'write', None) or fileobj.sendall
+    for data in _chunks(pieces, chunk_size):
+        if data:
+            write(data)
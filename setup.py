@@ -28,10 +28,6 @@ setup(
     author='Jamie Matthews',
     author_email='jamie.matthews@gmail.com',
     license='Public Domain',
-    install_requires=[
-        'egenix-mx-base',
-        'python-cjson',
-    ],
     classifiers = [
         'Programming Language :: Python',
         'Development Status :: 3 - Alpha',
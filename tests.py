@@ -1,8 +1,44 @@
 from datetime import date
+from random import Random
+from StringIO import StringIO
+import base64
+import cPickle
+import datetime
+import gc
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import sys
+import threading
+import time
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import micromodels
+import micromodels.binary
+import micromodels.dates
+from micromodels import backends
 from micromodels.models import json
+from micromodels.streaming import JSONArrayDecoder
+
+
+class Point(micromodels.Model):
+    x = micromodels.IntegerField()
+    y = micromodels.IntegerField()
+    label = micromodels.CharField()
+
+
+class CompactPoint(micromodels.Model):
+    _compact = True
+    x = micromodels.IntegerField()
+    y = micromodels.IntegerField()
+    label = micromodels.CharField()
 
 class ClassCreationTestCase(unittest.TestCase):
 
@@ -48,6 +84,80 @@ class BaseFieldTestCase(unittest.TestCase):
         self.assertEqual(field.source, 'customsource')
 
 
+class ConvertTestCase(unittest.TestCase):
+
+    def test_convert_is_stateless(self):
+        """convert should not store the value on the field"""
+        field = micromodels.IntegerField()
+        self.assertEqual(field.convert('12'), 12)
+        self.assertFalse(hasattr(field, 'data'))
+
+    def test_serialize(self):
+        field = micromodels.DateField('%Y-%m-%d', serial_format='%d/%m/%Y')
+        self.assertEqual(field.serialize(date(2011, 1, 30)), '30/01/2011')
+        self.assertEqual(field.to_serial(date(2011, 1, 30)), '30/01/2011')
+
+    def test_stateful_subclass_still_used(self):
+        """Subclasses that only override to_python should keep working"""
+        class ShoutingField(micromodels.CharField):
+            def to_python(self):
+                return super(ShoutingField, self).to_python().upper()
+
+        class Person(micromodels.Model):
+            name = ShoutingField()
+
+        self.assertEqual(Person.from_dict({'name': 'eric'}).name, 'ERIC')
+        instance = Person()
+        instance.name = 'john'
+        self.assertEqual(instance.name, 'JOHN')
+
+
+class ConcurrencyTestCase(unittest.TestCase):
+
+    def test_parallel_decoding(self):
+        """One model class should decode correctly from several threads"""
+        class Item(micromodels.Model):
+            number = micromodels.IntegerField()
+            label = micromodels.CharField()
+            day = micromodels.DateField('%Y-%m-%d')
+            tags = micromodels.FieldCollectionField(micromodels.IntegerField())
+
+        class Order(micromodels.Model):
+            number = micromodels.IntegerField()
+            item = micromodels.ModelField(Item)
+
+        errors = []
+
+        def decode(offset):
+            for number in xrange(offset, offset + 300):
+                item = {'number': str(number), 'label': number,
+                        'day': '2011-01-%02d' % (number % 28 + 1),
+                        'tags': [number, str(number)]}
+                order = Order.from_dict({'number': number, 'item': item})
+                other = Order()
+                other.set_data({'number': number, 'item': item})
+                for decoded in (order, other):
+                    if (decoded.number != number or
+                            decoded.item.number != number or
+                            decoded.item.label != unicode(number) or
+                            decoded.item.day.day != number % 28 + 1 or
+                            decoded.item.tags != [number, number]):
+                        errors.append(number)
+
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=decode, args=(i * 1000,))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+
+
 class CharFieldTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -62,6 +172,35 @@ class CharFieldTestCase(unittest.TestCase):
         self.field.populate(None)
         self.assertEqual(self.field.to_python(), '')
 
+    def test_intern(self):
+        class Account(micromodels.Model):
+            country = micromodels.CharField(intern=True)
+            tags = micromodels.FieldCollectionField(
+                micromodels.CharField(intern=True))
+
+        rows = [{'country': ''.join(['f', 'r']), 'tags': [u'new', 'new']}
+                for _ in range(3)]
+        accounts = list(Account.from_dicts(rows))
+        self.assertEqual(accounts[0].country, u'fr')
+        self.assertIsInstance(accounts[0].country, unicode)
+        self.assertIs(accounts[0].country, accounts[2].country)
+        self.assertIs(accounts[0].tags[0], accounts[1].tags[1])
+        self.assertEqual(Account.from_dict({}).country, '')
+        self.assertEqual(Account._fields['country'].convert(12), u'12')
+
+    def test_intern_size(self):
+        field = micromodels.CharField(intern=True, intern_size=2)
+        first = field.convert('a')
+        field.convert('b')
+        self.assertIs(field.convert(u'a'), first)
+        field.convert('c')
+        self.assertEqual(len(field._interned), 1)
+        self.assertEqual(field.convert('a'), first)
+
+    def test_not_interned_by_default(self):
+        self.assertIsNot(self.field.convert('somestring'),
+                         self.field.convert('somestring'))
+
 
 class IntegerFieldTestCase(unittest.TestCase):
 
@@ -212,6 +351,962 @@ class InstanceTestCase(unittest.TestCase):
         self.assertEqual(instance.first, data['custom_source'])
 
 
+class DateParserTestCase(unittest.TestCase):
+
+    formats = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%d',
+               '%a %b %d %H:%M:%S +0000 %Y', '%d %B %y, %H:%M', '%H:%M',
+               '%Y%m%d%H%M%S', '%m/%d/%Y %%', '%Y-%j', '%I:%M %p']
+
+    def strings(self, format, random):
+        """Yields valid and invalid strings for ``format``"""
+        for _ in range(100):
+            value = datetime.datetime(random.randint(1, 9999),
+                                      random.randint(1, 12),
+                                      random.randint(1, 28),
+                                      random.randint(0, 23),
+                                      random.randint(0, 59),
+                                      random.randint(0, 59),
+                                      random.randint(0, 999999))
+            string = value.strftime(format) if value.year >= 1900 else \
+                value.replace(year=1900 + value.year % 100).strftime(format)
+            yield string
+            yield string.upper()
+            yield string.replace('0', '', 1)
+            yield string.replace('0', ' ', 1)
+            yield string.replace(' ', '\t ', 1)
+            position = random.randrange(len(string))
+            for character in '0159 :-A':
+                yield string[:position] + character + string[position + 1:]
+            yield string[:position]
+            yield string + '0'
+        for string in ('2011-02-29T00:00:00', '2011-13-01T00:00:00',
+                       '2011-12-32T00:00:00', '2011-12-01T24:00:00',
+                       '2011-12-01T23:60:00', '2011-12-01T23:00:60',
+                       '2011-12-01T23:00:61', 'Xyz Mar 21 20:50:14 +0000 2006',
+                       'Tue Abc 21 20:50:14 +0000 2006', ''):
+            yield string
+
+    def test_matches_strptime(self):
+        """Compiled parsers should behave exactly like strptime"""
+        random = Random(42)
+        for format in self.formats:
+            for kind, project in ((datetime.datetime, lambda value: value),
+                                  (datetime.date, lambda value: value.date()),
+                                  (datetime.time, lambda value: value.time())):
+                parse = micromodels.dates.compile_parser(format, kind)
+                for string in self.strings(format, random):
+                    try:
+                        expected = project(
+                            datetime.datetime.strptime(string, format))
+                    except ValueError:
+                        self.assertRaises(ValueError, parse, string)
+                    else:
+                        self.assertEqual(parse(string), expected,
+                                         (format, string))
+
+    def test_fields(self):
+        field = micromodels.TimeField('%H:%M:%S', cache_size=2)
+        self.assertEqual(field.convert('12:30:05'), datetime.time(12, 30, 5))
+        self.assertTrue(field.convert('12:30:05') is field.convert('12:30:05'))
+        field = micromodels.DateField('%d %b %Y')
+        self.assertEqual(field.convert('01 Feb 2011'), date(2011, 2, 1))
+        self.assertRaises(ValueError, field.convert, '31 Feb 2011')
+
+    def test_lru_cache(self):
+        cache = micromodels.dates.LRUCache(2)
+        cache['a'], cache['b'] = 1, 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')),
+                         (1, None, 3))
+        cache['c'] = 4
+        cache['d'] = 5
+        self.assertEqual((cache.get('a'), cache.get('c'), cache.get('d')),
+                         (None, 4, 5))
+        self.assertEqual(len(cache), 2)
+
+
+class MXFieldTestCase(unittest.TestCase):
+    """The fields formerly based on mx.DateTime should keep its behavior"""
+
+    class Offset(datetime.tzinfo):
+        def utcoffset(self, value):
+            return datetime.timedelta(hours=2)
+
+        def dst(self, value):
+            return datetime.timedelta(0)
+
+    class FakeMXDateTime(object):
+        def gmtime(self):
+            return self
+
+        def pydatetime(self):
+            return datetime.datetime(2011, 1, 30, 12)
+
+    def setUp(self):
+        self.field = micromodels.MXDateTimeField()
+        self.delta_field = micromodels.MXTimeDeltaField()
+        self.utc = micromodels.dates.utc
+
+    def test_datetime_convert(self):
+        convert = self.field.convert
+        expected = datetime.datetime(2011, 1, 30, 10, 0, tzinfo=self.utc)
+        self.assertEqual(convert(None), None)
+        for value in (datetime.datetime(2011, 1, 30, 10, 0),
+                      datetime.datetime(2011, 1, 30, 12, 0, tzinfo=self.Offset()),
+                      1296381600, 1296381600.0, '2011-01-30T10:00:00Z',
+                      u'2011-01-30 12:00+02:00', '20110130T080000-0200',
+                      'Sun, 30 Jan 2011 12:00:00 +0200',
+                      'Sun Jan 30 10:00:00 +0000 2011'):
+            converted = convert(value)
+            self.assertEqual(converted, expected, value)
+            self.assertTrue(converted.tzinfo is self.utc)
+        self.assertEqual(convert('2011-01-30T10:00:00.25Z').microsecond, 250000)
+        self.assertEqual(convert(self.FakeMXDateTime()),
+                         datetime.datetime(2011, 1, 30, 12, tzinfo=self.utc))
+
+    def test_local_strings(self):
+        """Strings without a time zone are in local time"""
+        timestamp = time.mktime((2011, 1, 30, 10, 0, 0, 0, 0, -1))
+        expected = datetime.datetime.utcfromtimestamp(timestamp)
+        for value in ('2011-01-30 10:00', 'Sun Jan 30 10:00:00 2011'):
+            self.assertEqual(self.field.convert(value).replace(tzinfo=None),
+                             expected)
+
+    def test_datetime_errors(self):
+        self.assertRaises(ValueError, self.field.convert, 'yesterday')
+        self.assertRaises(TypeError, self.field.convert, [2011])
+        self.assertRaises(TypeError, self.field.serialize, 1296381600)
+
+    def test_datetime_serialize(self):
+        value = self.field.convert('2011-01-30T10:00:00.5Z')
+        self.assertEqual(self.field.serialize(value), 1296381600)
+        self.assertEqual(self.field.serialize(None), None)
+        self.assertEqual(cPickle.loads(cPickle.dumps(value, 2)).tzinfo,
+                         self.utc)
+
+    def test_timedelta(self):
+        convert, serialize = self.delta_field.convert, self.delta_field.serialize
+        delta = datetime.timedelta(seconds=90)
+        for value in (delta, 90, 90.0):
+            self.assertEqual(convert(value), delta)
+            self.assertEqual(serialize(value), 90.0)
+        self.assertEqual(convert(None), None)
+        self.assertEqual(serialize(None), None)
+        self.assertRaises(TypeError, convert, '90')
+        self.assertRaises(TypeError, serialize, [90])
+        for string, seconds in (('90', 90), ('0:01:30', 90), ('-1:30', -5400),
+                                ('1d 2:30', 95400), ('1 day, 2:30:00', 95400),
+                                ('0:00:01.5', 1.5)):
+            self.assertEqual(serialize(string), seconds)
+        self.assertRaises(ValueError, serialize, 'soon')
+
+
+class DecoderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Person(micromodels.Model):
+            name = micromodels.CharField(source='full_name')
+            age = micromodels.IntegerField(default=18)
+            height = micromodels.FloatField(null=True)
+            admin = micromodels.BooleanField()
+            born = micromodels.DateTimeField(format='%Y-%m-%d')
+        self.Person = Person
+
+    def legacy_decode(self, data):
+        instance = self.Person()
+        instance.set_data(data)
+        return instance
+
+    def test_matches_set_data(self):
+        """from_dict should produce the same instance as __init__ followed by set_data"""
+        for data in ({'full_name': 'Eric', 'age': '21', 'height': 1.8,
+                      'admin': 'true', 'born': '1990-01-02'},
+                     {'full_name': None, 'age': None, 'born': '1990-01-02'},
+                     {'born': '1990-01-02'}):
+            decoded = self.Person.from_dict(data)
+            self.assertEqual(decoded.to_dict(), self.legacy_decode(data).to_dict())
+
+    def test_decoder_cached_per_class(self):
+        """The generated decoder should be compiled once per class"""
+        self.Person.from_dict({'born': '1990-01-02'})
+        decoder = self.Person.__dict__['_decoder']
+        self.Person.from_dict({'born': '1990-01-02'})
+        self.assertTrue(self.Person.__dict__['_decoder'] is decoder)
+
+    def test_custom_init_is_called(self):
+        """Models defining __init__ should still have it called by from_dict"""
+        class Tagged(micromodels.Model):
+            name = micromodels.CharField()
+
+            def __init__(self):
+                super(Tagged, self).__init__()
+                self.tag = 'set in __init__'
+
+        instance = Tagged.from_dict({'name': 'Eric'})
+        self.assertEqual(instance.tag, 'set in __init__')
+        self.assertEqual(instance.name, 'Eric')
+
+    def test_add_field_is_per_instance(self):
+        """Fields added with add_field should not leak into the class"""
+        first = self.Person.from_dict({'born': '1990-01-02'})
+        first.add_field('nickname', 'E', micromodels.CharField())
+        second = self.Person.from_dict({'born': '1990-01-02'})
+        self.assertEqual(first.to_dict()['nickname'], 'E')
+        self.assertFalse('nickname' in second.to_dict())
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Tag(micromodels.Model):
+            name = micromodels.CharField()
+
+        class Person(micromodels.Model):
+            name = micromodels.CharField(source='full_name')
+            age = micromodels.IntegerField(default=18)
+            height = micromodels.FloatField(null=True)
+            admin = micromodels.BooleanField()
+            born = micromodels.DateTimeField(format='%Y-%m-%d')
+            tags = micromodels.ModelCollectionField(Tag)
+            main_tag = micromodels.ModelField(Tag)
+            extra = micromodels.BaseField()
+        self.Person = Person
+        self.instances = [
+            Person.from_dict({'full_name': u'\xc9ric "E" /', 'age': 2 ** 70,
+                              'height': 1.8, 'admin': 'true',
+                              'born': '1990-01-02', 'tags': [{'name': 'a'}],
+                              'main_tag': {'name': 'b'},
+                              'extra': {'nested': [1, None]}}),
+            Person.from_dict({'height': float('nan')}),
+            Person(),
+        ]
+
+    def generic_serial(self, instance):
+        return dict((key, field.to_serial(getattr(instance, key)))
+                    for key, field in instance._fields.iteritems()
+                    if hasattr(instance, key))
+
+    def test_matches_generic(self):
+        """The generated serializer should match the generic one"""
+        for instance in self.instances:
+            self.assertEqual(instance.to_dict(serial=True),
+                             self.generic_serial(instance))
+
+    def test_direct_json(self):
+        for instance in self.instances:
+            decoded = json.decode(instance.to_json('json', direct=True), 'json')
+            expected = json.decode(instance.to_json(backend='json'), 'json')
+            if instance.height != instance.height:
+                self.assertTrue(decoded.pop('height') != decoded.get('height'))
+                expected.pop('height')
+            self.assertEqual(decoded, expected)
+        self.assertEqual(self.Person.from_dict({'age': 3}).to_json(direct=True),
+                         '{"admin":false,"age":3,"born":null,"extra":null,'
+                         '"height":null,"main_tag":{"name":""},"name":"",'
+                         '"tags":[]}')
+
+    def test_unset_fields(self):
+        """Instances missing a field should fall back to the generic path"""
+        for instance in self.instances:
+            del instance.age
+            self.assertEqual(instance.to_dict(serial=True),
+                             self.generic_serial(instance))
+            self.assertFalse('age' in json.decode(
+                instance.to_json('json', direct=True), 'json'))
+        compact = CompactPoint.__new__(CompactPoint)
+        compact.x = 1
+        self.assertEqual(compact.to_dict(serial=True), {'x': 1})
+        self.assertEqual(compact.to_json(direct=True), '{"x":1}')
+
+
+class DumpJSONTestCase(unittest.TestCase):
+
+    class Recorder(object):
+        def __init__(self):
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(data)
+
+    def setUp(self):
+        class Polygon(micromodels.Model):
+            name = micromodels.CharField()
+            points = micromodels.ModelCollectionField(Point)
+            center = micromodels.ModelField(Point)
+        self.Polygon = Polygon
+        self.polygon = Polygon.from_dict({
+            'name': 'square', 'center': {'x': 1, 'y': 1},
+            'points': [{'x': i, 'y': i % 2, 'label': str(i)}
+                       for i in range(500)]})
+
+    def test_dump_json(self):
+        fileobj = self.Recorder()
+        self.polygon.dump_json(fileobj, chunk_size=100)
+        data = ''.join(fileobj.writes)
+        self.assertEqual(data, self.polygon.to_json(direct=True))
+        self.assertEqual(self.Polygon.from_dict(data, is_json=True),
+                         self.polygon)
+        self.assertTrue(len(fileobj.writes) > 100)
+        self.assertTrue(max(map(len, fileobj.writes)) < 150)
+
+    def test_dump_json_fallbacks(self):
+        """Lazy instances and added fields should be written too"""
+        Lazy = type('Lazy', (micromodels.Model,),
+                    dict(self.Polygon._clsfields, _lazy=True))
+        polygon = Lazy.from_dict(self.polygon.to_dict(serial=True))
+        polygon.add_field('sides', 4, micromodels.IntegerField())
+        fileobj = StringIO()
+        polygon.dump_json(fileobj)
+        self.assertEqual(json.decode(fileobj.getvalue()),
+                         polygon.to_dict(serial=True))
+
+    def test_dump_json_array(self):
+        for count in (0, 1, 500):
+            fileobj = StringIO()
+            Point.dump_json_array(fileobj, (point for point in
+                                            self.polygon.points[:count]),
+                                  chunk_size=64)
+            self.assertEqual(list(Point.iter_json(StringIO(fileobj.getvalue()))),
+                             self.polygon.points[:count])
+
+    def test_socket(self):
+        server, client = socket.socketpair()
+        received = []
+
+        def receive():
+            for chunk in iter(lambda: server.recv(4096), ''):
+                received.append(chunk)
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        Point.dump_json_array(client, self.polygon.points)
+        client.close()
+        receiver.join()
+        server.close()
+        self.assertEqual(Point.from_dicts(json.decode(''.join(received))),
+                         self.polygon.points)
+
+
+def instance_size(instance):
+    """Bytes used by an instance and the dictionaries it owns"""
+    return sys.getsizeof(instance) + sum(
+        sys.getsizeof(referent) for referent in gc.get_referents(instance)
+        if isinstance(referent, dict))
+
+
+class BulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{'x': i, 'y': str(i), 'label': 'point %d' % i}
+                     for i in range(5)]
+
+    def test_from_dicts(self):
+        points = Point.from_dicts(self.rows)
+        self.assertTrue(isinstance(points, list))
+        self.assertEqual(points, [Point.from_dict(row) for row in self.rows])
+
+    def test_from_dicts_generator(self):
+        points = Point.from_dicts(iter(self.rows), generator=True)
+        self.assertFalse(isinstance(points, list))
+        self.assertEqual(list(points), Point.from_dicts(self.rows))
+
+    def test_from_dicts_json(self):
+        rows = [json.encode(row) for row in self.rows]
+        self.assertEqual(Point.from_dicts(rows, is_json=True),
+                         Point.from_dicts(self.rows))
+
+    def test_from_dicts_custom_init(self):
+        class Tagged(micromodels.Model):
+            name = micromodels.CharField()
+
+            def __init__(self):
+                super(Tagged, self).__init__()
+                self.tag = 'set in __init__'
+
+        tagged = Tagged.from_dicts([{'name': 'a'}, {'name': 'b'}])
+        self.assertEqual([t.tag for t in tagged], ['set in __init__'] * 2)
+        self.assertEqual([t.name for t in tagged], ['a', 'b'])
+
+    def test_to_dicts(self):
+        points = Point.from_dicts(self.rows)
+        serial = Point.to_dicts(points, serial=True)
+        self.assertEqual(serial, [dict(row, y=int(row['y'])) for row in self.rows])
+        self.assertEqual(list(Point.to_dicts(points, generator=True)),
+                         [point.to_dict() for point in points])
+
+
+class ModelBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Sample(micromodels.Model):
+            count = micromodels.IntegerField()
+            ratio = micromodels.FloatField(source='rate')
+            valid = micromodels.BooleanField()
+            maybe = micromodels.IntegerField(null=True)
+            name = micromodels.CharField()
+            day = micromodels.DateField('%Y-%m-%d')
+
+        self.Sample = Sample
+        self.rows = [{'count': 1, 'rate': 0.5, 'valid': 'true', 'maybe': 3,
+                      'name': 'a', 'day': '2011-01-30'},
+                     {'count': '2', 'rate': 1, 'valid': 0, 'maybe': None,
+                      'name': 'b', 'day': '2011-01-31'}]
+
+    def test_array_columns(self):
+        batch = micromodels.ModelBatch(self.Sample, self.rows, use_numpy=False)
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.columns['count'].typecode, 'l')
+        self.assertEqual(list(batch.columns['count']), [1, 2])
+        self.assertEqual(list(batch.columns['ratio']), [0.5, 1.0])
+        self.assertEqual(batch.columns['valid'], [True, False])
+        self.assertIs(batch[0].valid, True)
+        self.assertIs(batch[1].to_dict(serial=True)['valid'], False)
+        self.assertEqual(batch.columns['maybe'], [3, None])
+        self.assertEqual(batch.columns['name'], [u'a', u'b'])
+        self.assertEqual(batch.columns['day'],
+                         [date(2011, 1, 30), date(2011, 1, 31)])
+
+    def test_rows(self):
+        batch = micromodels.ModelBatch(self.Sample, self.rows)
+        self.assertEqual(list(batch), self.Sample.from_dicts(self.rows))
+        self.assertEqual(batch[-1], self.Sample.from_dict(self.rows[1]))
+        self.assertRaises(IndexError, batch.__getitem__, 2)
+
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_numpy_columns(self):
+        batch = micromodels.ModelBatch(self.Sample, self.rows, use_numpy=True)
+        self.assertEqual(batch.columns['count'].sum(), 3)
+        self.assertEqual(batch.columns['valid'].dtype, numpy.bool_)
+        self.assertIs(batch[0].valid, True)
+
+
+class JSONArrayDecoderTestCase(unittest.TestCase):
+
+    def decode(self, text, path=None, chunk_size=1):
+        decoder = JSONArrayDecoder(path)
+        items = []
+        for start in range(0, len(text), chunk_size):
+            items.extend(decoder.feed(text[start:start + chunk_size]))
+        return items + decoder.close()
+
+    def test_array(self):
+        text = ' [ {"a": [1, "]"]}, 12345, -1.5e3 ,"x\\"y", null, true ] '
+        expected = [{'a': [1, ']']}, 12345, -1500.0, 'x"y', None, True]
+        for chunk_size in (1, 2, 3, 7, len(text)):
+            self.assertEqual(self.decode(text, chunk_size=chunk_size), expected)
+
+    def test_empty_array(self):
+        self.assertEqual(self.decode('[]'), [])
+        self.assertEqual(self.decode(' [ ]', path=[]), [])
+
+    def test_path(self):
+        text = ('{"meta": {"count": [1, 2]}, "data": {"skip": "[",'
+                ' "statuses": [{"id": 1}, {"id": 2}], "after": 1}}')
+        self.assertEqual(self.decode(text, path='data.statuses'),
+                         [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.decode(text, path=['data', 'statuses']),
+                         [{'id': 1}, {'id': 2}])
+        self.assertRaises(KeyError, self.decode, text, path='data.missing')
+
+    def test_items_returned_as_soon_as_complete(self):
+        decoder = JSONArrayDecoder()
+        self.assertEqual(decoder.feed('[{"id": 1}, {"id"'), [{'id': 1}])
+        self.assertEqual(decoder.feed(': 2}, 3'), [{'id': 2}])
+        self.assertEqual(decoder.feed('4]'), [34])
+        self.assertTrue(decoder.done)
+
+    def test_value_at_chunk_end_not_held_back(self):
+        decoder = JSONArrayDecoder()
+        self.assertEqual(decoder.feed('[{"id": 1, "text": "%s"}' % ('x' * 100)),
+                         [{'id': 1, 'text': 'x' * 100}])
+        self.assertEqual(decoder.feed(', "a"'), ['a'])
+        self.assertEqual(decoder.feed(', 1'), [])
+        self.assertEqual(decoder.feed(' '), [1])
+        self.assertEqual(decoder.feed(', [2]]'), [[2]])
+
+    def test_invalid_input(self):
+        self.assertRaises(ValueError, self.decode, '[1, 2')
+        self.assertRaises(ValueError, self.decode, '[1 2]')
+        self.assertRaises(ValueError, self.decode, '{"a": 1}')
+        self.assertRaises(ValueError, self.decode, '[1, }]')
+
+    def test_iter_json(self):
+        rows = [{'x': i, 'y': str(i), 'label': 'point %d' % i}
+                for i in range(100)]
+        fileobj = StringIO(json.encode({'points': rows}))
+        points = Point.iter_json(fileobj, path='points', chunk_size=16)
+        self.assertFalse(isinstance(points, list))
+        self.assertEqual(list(points), Point.from_dicts(rows))
+
+
+class JSONLinesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.points = [Point.from_dict({'x': i, 'y': -i, 'label': u'p\xe9 %d' % i})
+                       for i in range(50)]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_objects(self):
+        fileobj = StringIO()
+        Point.write_jsonl(fileobj, self.points, chunk_size=64)
+        lines = fileobj.getvalue().splitlines()
+        self.assertEqual(len(lines), 50)
+        self.assertEqual(json.decode(lines[1]), self.points[1].to_dict(serial=True))
+        fileobj.seek(0)
+        self.assertEqual(list(Point.read_jsonl(fileobj, chunk_size=7)),
+                         self.points)
+
+    def test_blank_lines_and_missing_final_newline(self):
+        fileobj = StringIO('\n{"x": 1}\r\n  \n{"x": 2}')
+        self.assertEqual([point.x for point in Point.read_jsonl(fileobj)], [1, 2])
+
+    def test_paths_and_gzip(self):
+        for name in ('points.jsonl', 'points.jsonl.gz'):
+            path = os.path.join(self.directory, name)
+            Point.write_jsonl(path, self.points, chunk_size=100)
+            with open(path, 'rb') as fileobj:
+                compressed = fileobj.read(2) == '\x1f\x8b'
+            self.assertEqual(compressed, name.endswith('.gz'))
+            self.assertEqual(list(Point.read_jsonl(path, chunk_size=10)),
+                             self.points)
+
+    def test_concatenated_gzip_members(self):
+        first, second = StringIO(), StringIO()
+        Point.write_jsonl(first, self.points[:20], compress=True)
+        Point.write_jsonl(second, self.points[20:], compress=True)
+        fileobj = StringIO(first.getvalue() + second.getvalue())
+        self.assertEqual(list(Point.read_jsonl(fileobj, chunk_size=16)),
+                         self.points)
+
+
+class RecordFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.points = [Point.from_dict({'x': i, 'y': -i, 'label': u'p\xe9 %d' % i})
+                       for i in range(50)]
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'points.rec')
+        Point.write_records(self.path, self.points)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_random_access(self):
+        with Point.open_records(self.path) as records:
+            self.assertEqual(len(records), 50)
+            self.assertEqual(records[37], self.points[37])
+            self.assertEqual(records[-1], self.points[-1])
+            self.assertRaises(IndexError, records.__getitem__, 50)
+            self.assertEqual(list(records), self.points)
+
+    def test_slices(self):
+        with Point.open_records(self.path) as records:
+            for index in (slice(10, 20), slice(None, None, -3),
+                          slice(40, 5, -7), slice(60, 70), slice(-5, None)):
+                self.assertEqual(list(records[index]), self.points[index])
+            self.assertEqual(list(records[5:45:2][3:-1:4]),
+                             self.points[5:45:2][3:-1:4])
+            self.assertEqual(records[10:20][-1], self.points[19])
+
+    def test_empty(self):
+        Point.write_records(self.path, [])
+        with Point.open_records(self.path) as records:
+            self.assertEqual(list(records), [])
+
+    def test_invalid(self):
+        Other = type('Point', (micromodels.Model,),
+                     {'x': micromodels.FloatField()})
+        self.assertRaises(ValueError, Other.open_records, self.path)
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write('{"x": 1}\n')
+        self.assertRaises(ValueError, Point.open_records, self.path)
+        self.assertRaises(TypeError, Point.write_records, StringIO(),
+                          [CompactPoint()])
+
+
+class ParallelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{'x': i, 'y': str(i), 'label': 'point %d' % i}
+                     for i in range(25)]
+        self.lines = [json.encode(row) for row in self.rows]
+
+    def test_from_json_many(self):
+        expected = Point.from_dicts(self.rows)
+        for workers in (1, 2):
+            self.assertEqual(Point.from_json_many(iter(self.lines), workers=workers,
+                                                  chunksize=4), expected)
+
+    def test_to_json_many(self):
+        points = Point.from_dicts(self.rows)
+        for workers in (1, 2):
+            lines = Point.to_json_many(points, workers=workers, chunksize=4)
+            self.assertEqual([json.decode(line) for line in lines],
+                             [point.to_dict(serial=True) for point in points])
+
+    def test_compact_and_empty(self):
+        rows = [{'x': i} for i in range(5)]
+        lines = [json.encode(row) for row in rows]
+        self.assertEqual(CompactPoint.from_json_many(lines, workers=2),
+                         CompactPoint.from_dicts(rows))
+        self.assertEqual(Point.from_json_many([], workers=2), [])
+
+
+class StreamDecoderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [{'x': i, 'y': str(i), 'label': 'point %d' % i}
+                     for i in range(40)]
+
+    def test_lines(self):
+        decoder = Point.stream_decoder()
+        self.assertEqual(decoder.feed('{"x": 1}\n{"x"'), [Point.from_dict({'x': 1})])
+        self.assertEqual(decoder.feed(': 2}\n\n'), [Point.from_dict({'x': 2})])
+        self.assertEqual(decoder.feed('{"x": 3}'), [])
+        self.assertEqual(decoder.close(), [Point.from_dict({'x': 3})])
+
+    def test_array(self):
+        decoder = Point.stream_decoder('array', path='points')
+        data = json.encode({'points': self.rows})
+        points = []
+        for start in range(0, len(data), 5):
+            points.extend(decoder.feed(data[start:start + 5]))
+        points.extend(decoder.close())
+        self.assertEqual(points, Point.from_dicts(self.rows))
+
+    def test_unknown_framing(self):
+        self.assertRaises(ValueError, Point.stream_decoder, 'csv')
+
+    def test_socket(self):
+        """Models should be decoded as they arrive over a local socket"""
+        server, client = socket.socketpair()
+        data = ''.join(json.encode(row) + '\n' for row in self.rows)
+
+        def send():
+            for start in range(0, len(data), 97):
+                client.sendall(data[start:start + 97])
+            client.close()
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        decoder = Point.stream_decoder()
+        points = []
+        while True:
+            chunk = server.recv(64)
+            if not chunk:
+                break
+            points.extend(decoder.feed(chunk))
+        points.extend(decoder.close())
+        sender.join()
+        server.close()
+        self.assertEqual(points, Point.from_dicts(self.rows))
+
+
+class JSONBackendTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.state = (backends._preference[:], dict(backends._loaders),
+                      dict(backends._backends))
+
+    def tearDown(self):
+        preference, loaders, registered = self.state
+        backends._preference[:] = preference
+        backends._loaders = loaders
+        backends._backends = registered
+        backends.use()
+
+    def test_available(self):
+        """The standard library's json module is always available"""
+        self.assertTrue('json' in backends.available())
+        self.assertEqual(backends.get().name, backends.available()[0])
+
+    def test_use(self):
+        backends.use('json')
+        self.assertEqual(backends.get().name, 'json')
+        backends.use()
+        self.assertEqual(backends.get().name, backends.available()[0])
+        self.assertRaises(ValueError, backends.use, 'yaml')
+
+    def test_per_call(self):
+        calls = []
+
+        def encode(obj):
+            calls.append('encode')
+            return backends.encode(obj, 'json')
+
+        def decode(data):
+            calls.append('decode')
+            return backends.decode(data, 'json')
+
+        backends.register('recording', encode, decode)
+        self.assertEqual(backends.available()[-1], 'recording')
+        point = Point.from_dict('{"x": 1, "y": 2}', is_json=True,
+                                backend='recording')
+        self.assertEqual(json.decode(point.to_json(backend='recording')),
+                         {'x': 1, 'y': 2, 'label': ''})
+        Point.from_dicts(['{"x": 1}'], is_json=True, backend='recording')
+        self.assertEqual(calls, ['decode', 'encode', 'decode'])
+        backends.register('recording', encode, decode, preferred=True)
+        self.assertEqual(backends.get().name, 'recording')
+
+    def test_register_keeps_chosen_default(self):
+        backends.use('json')
+        backends.register('other', backends.encode, backends.decode,
+                          preferred=True)
+        self.assertEqual(backends.get().name, 'json')
+        backends.use()
+        self.assertEqual(backends.get().name, 'other')
+
+    def test_large_integers(self):
+        """Every backend handles integers beyond 64 bits"""
+        for name in backends.available():
+            for value in (2 ** 64, -2 ** 70):
+                point = Point.from_dict({'x': value, 'y': 1})
+                for direct in (False, True):
+                    text = point.to_json(backend=name, direct=direct)
+                    self.assertEqual(json.decode(text, 'json')['x'], value)
+                    self.assertEqual(Point.from_dict(
+                        text, is_json=True, backend=name).x, value)
+        if 'ujson' in backends.available():
+            self.assertRaises(ValueError, backends.decode, '[1', 'ujson')
+
+    def test_buffers(self):
+        """Byte strings, unicode strings and buffers are all decoded"""
+        data = '{"x": 1, "y": 2, "label": "a"}'
+        for name in backends.available():
+            for value in (data, unicode(data), buffer(data), memoryview(data)):
+                point = Point.from_dict(value, is_json=True, backend=name)
+                self.assertEqual((point.x, point.y, point.label), (1, 2, 'a'))
+
+
+class BinaryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Tag(micromodels.Model):
+            name = micromodels.CharField()
+
+        class Record(micromodels.Model):
+            count = micromodels.IntegerField()
+            ratio = micromodels.FloatField()
+            active = micromodels.BooleanField()
+            name = micromodels.CharField(null=True)
+            created = micromodels.DateTimeField('%Y-%m-%d %H:%M:%S')
+            day = micromodels.DateField('%Y-%m-%d')
+            main_tag = micromodels.ModelField(Tag)
+            tags = micromodels.ModelCollectionField(Tag)
+            sizes = micromodels.FieldCollectionField(micromodels.IntegerField())
+            extra = micromodels.BaseField()
+
+        self.Record = Record
+        self.instance = Record.from_dict({
+            'count': 2 ** 70, 'ratio': 0.25, 'active': True, 'name': None,
+            'created': '2011-01-30 12:34:56', 'day': '2011-01-30',
+            'main_tag': {'name': u'caf\xe9'},
+            'tags': [{'name': 'a'}, {'name': 'b'}], 'sizes': [1, -2],
+            'extra': {'id': 2 ** 40, 'when': datetime.datetime(2011, 1, 30, tzinfo=micromodels.dates.utc),
+                      'delta': datetime.timedelta(-1, 5, 6), 'raw': 'x' * 300},
+        })
+
+    def test_round_trip(self):
+        for raw in (False, True):
+            restored = self.Record()
+            restored.loads(self.instance.to_binary(raw=raw), binary=True)
+            self.assertEqual(restored, self.instance)
+            self.assertEqual(restored.to_dict(serial=True),
+                             self.instance.to_dict(serial=True))
+            self.assertEqual(
+                self.Record.from_binary(self.instance.to_binary(raw=raw)),
+                self.instance)
+        self.assertEqual(restored.main_tag.name, u'caf\xe9')
+        self.assertEqual(restored.extra['when'].tzinfo, micromodels.dates.utc)
+
+    def test_size(self):
+        """The format should be much smaller than pickle and base64"""
+        point = Point.from_dict({'x': 1, 'y': 2, 'label': 'origin'})
+        pickled = base64.b64encode(cPickle.dumps(point))
+        self.assertTrue(len(point.to_binary()) < len(pickled) / 2)
+        self.assertTrue(len(point.to_binary(raw=True)) <
+                        len(point.to_binary()))
+
+    def test_no_pickle(self):
+        """Pickles should never be loaded"""
+        point = Point.from_dict({'x': 1, 'y': 2, 'label': 'origin'})
+        pickled = base64.b64encode(cPickle.dumps(point, 2))
+        self.assertRaises(ValueError, Point().loads, pickled, binary=True)
+
+    def test_invalid(self):
+        data = self.instance.to_binary(raw=True)
+        Other = type('Record', (micromodels.Model,),
+                     {'count': micromodels.FloatField()})
+        self.assertRaises(ValueError, Other().loads, data, binary=True)
+        for invalid in (data[:-3], data + 'N', data[:6] + '?' + data[7:]):
+            self.assertRaises(ValueError, self.Record().loads, invalid,
+                              binary=True)
+
+    def test_nested_layout(self):
+        def models(user_fields):
+            user = type('User', (micromodels.Model,), user_fields)
+            return type('Post', (micromodels.Model,),
+                        {'user': micromodels.ModelField(user)})
+
+        Post = models({'name': micromodels.CharField(),
+                       'age': micromodels.IntegerField()})
+        data = Post.from_dict({'user': {'name': 'bob', 'age': 3}}).to_binary()
+        Changed = models({'age': micromodels.CharField(),
+                          'email': micromodels.DateTimeField('%Y')})
+        self.assertNotEqual(micromodels.binary.checksum(Changed),
+                            micromodels.binary.checksum(Post))
+        self.assertRaises(ValueError, Changed.from_binary, data)
+        self.assertEqual(Post.from_binary(data).user.age, 3)
+
+    def test_field_types(self):
+        class Upper(micromodels.CharField):
+            def convert(self, value):
+                return super(Upper, self).convert(value).upper()
+
+        Tagged = type('Tagged', (micromodels.Model,), {
+            'count': micromodels.IntegerField(), 'tag': Upper()})
+        tagged = Tagged.from_dict({'count': 1, 'tag': 'a'})
+        object.__setattr__(tagged, 'tag', 'b')
+        self.assertEqual(Tagged.from_binary(tagged.to_binary()).tag, u'B')
+        object.__setattr__(tagged, 'count', 'many')
+        self.assertRaises(ValueError, Tagged.from_binary, tagged.to_binary())
+
+    def test_unsupported_value(self):
+        self.instance.extra = object()
+        self.assertRaises(TypeError, self.instance.to_binary)
+
+
+class CompactModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {'x': 1, 'y': '2', 'label': 'origin'}
+        self.instance = CompactPoint.from_dict(self.data)
+
+    def test_no_instance_dict(self):
+        """Field values should live in slots, not in an instance dictionary"""
+        self.assertEqual(sorted(CompactPoint.__slots__),
+                         ['_changed', 'label', 'x', 'y'])
+        self.instance.x = 5
+        self.assertEqual(self.instance.changed_fields(), set(['x']))
+        self.instance.mark_clean()
+        self.assertEqual(self.instance.changed_fields(), set())
+        for referent in gc.get_referents(self.instance):
+            self.assertFalse(isinstance(referent, dict))
+
+    def test_attributes(self):
+        self.assertEqual(self.instance.y, 2)
+        self.instance.y = '3'
+        self.assertEqual(self.instance.y, 3)
+        self.assertEqual(self.instance.to_dict(),
+                         {'x': 1, 'y': 3, 'label': 'origin'})
+        self.assertEqual(CompactPoint().to_dict(), {'x': 0, 'y': 0, 'label': ''})
+
+    def test_equality(self):
+        self.assertEqual(self.instance, CompactPoint.from_dict(self.data))
+        self.assertNotEqual(self.instance, Point.from_dict(self.data))
+
+    def test_pickling(self):
+        for protocol in (0, 2):
+            restored = cPickle.loads(cPickle.dumps(self.instance, protocol))
+            self.assertEqual(restored, self.instance)
+        restored = CompactPoint()
+        restored.loads(self.instance.dumps(binary=True), binary=True)
+        self.assertEqual(restored, self.instance)
+
+    def test_add_field(self):
+        self.instance.add_field('z', '4', micromodels.IntegerField())
+        self.assertEqual(self.instance.to_dict()['z'], 4)
+
+    def test_memory_per_instance(self):
+        """Compact instances should be much smaller than regular ones"""
+        regular = instance_size(Point.from_dict(self.data))
+        compact = instance_size(self.instance)
+        self.assertTrue(compact * 3 < regular,
+                        'bytes per instance: %d regular, %d compact'
+                        % (regular, compact))
+        self.instance.label = 'moved'
+        self.instance.mark_clean()
+        self.assertEqual(instance_size(self.instance), compact)
+
+
+class LazyModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class User(micromodels.Model):
+            _lazy = True
+            name = micromodels.CharField()
+
+        class Event(micromodels.Model):
+            _lazy = True
+            title = micromodels.CharField(source='name')
+            count = micromodels.IntegerField(default=1)
+            when = micromodels.DateField('%Y-%m-%d')
+            owner = micromodels.ModelField(User)
+
+        self.Event = Event
+        self.data = {'name': 'Launch', 'when': '2011-01-30',
+                     'owner': {'name': 'Eric'}}
+
+    def test_fields_converted_on_access(self):
+        event = self.Event.from_dict(self.data)
+        self.assertEqual(event.__dict__.keys(), ['_raw'])
+        self.assertEqual(event.when, date(2011, 1, 30))
+        self.assertTrue('when' in event.__dict__)
+        self.assertFalse('title' in event.__dict__)
+        self.assertEqual(event.title, 'Launch')
+        self.assertEqual(event.count, 1)
+        self.assertEqual(event.owner.name, 'Eric')
+
+    def test_converted_once(self):
+        event = self.Event.from_dict(self.data)
+        self.assertTrue(event.owner is event.owner)
+
+    def test_unknown_attribute(self):
+        event = self.Event.from_dict(self.data)
+        self.assertRaises(AttributeError, getattr, event, 'missing')
+
+    def test_assignment(self):
+        event = self.Event.from_dict(self.data)
+        event.count = '5'
+        self.assertEqual(event.count, 5)
+        self.assertEqual(self.data.get('count'), None)
+
+    def test_serial_passthrough(self):
+        """Untouched primitive values should be serialized without conversion"""
+        event = self.Event.from_dict(self.data)
+        serial = event.to_dict(serial=True)
+        self.assertEqual(serial, {'title': 'Launch', 'count': 1,
+                                  'when': '2011-01-30',
+                                  'owner': {'name': 'Eric'}})
+        self.assertFalse('title' in event.__dict__)
+        self.assertTrue('when' in event.__dict__)
+
+    def test_generated_serializers(self):
+        event = self.Event.from_dict(self.data)
+        event.count = '5'
+        self.assertEqual(event.to_json(direct=True),
+                         '{"count":5,"owner":{"name":"Eric"},'
+                         '"title":"Launch","when":"2011-01-30"}')
+        self.assertTrue('_lazy_serializers' in self.Event.__dict__)
+        self.assertFalse('title' in event.__dict__)
+        self.assertTrue(event.owner is event.owner)
+        serial = self.Event.from_dict(self.data).to_dict(serial=True)
+        self.assertEqual(serial['owner'], {'name': 'Eric'})
+        self.assertEqual(serial['count'], 1)
+
+    def test_equality_and_state(self):
+        event = self.Event.from_dict(self.data)
+        self.assertEqual(event, self.Event.from_dict(self.data))
+        state = event.__getstate__()
+        self.assertFalse('_raw' in state)
+        self.assertEqual(sorted(state), ['count', 'owner', 'title', 'when'])
+
+
 class ModelFieldTestCase(unittest.TestCase):
 
     def test_model_field_creation(self):
@@ -238,6 +1333,77 @@ class ModelFieldTestCase(unittest.TestCase):
         post = Post.from_dict(data)
         self.assertEqual(post.to_dict(serial=True), data)
 
+    def test_nested_model_decoded_once(self):
+        """Each nested dictionary should be decoded exactly once"""
+        calls = []
+
+        class Leaf(micromodels.Model):
+            name = micromodels.CharField()
+
+            @classmethod
+            def from_dict(cls, D, is_json=False):
+                calls.append(D)
+                return super(Leaf, cls).from_dict(D, is_json)
+
+        class Branch(micromodels.Model):
+            leaf = micromodels.ModelField(Leaf)
+            leaves = micromodels.ModelCollectionField(Leaf)
+
+        class Tree(micromodels.Model):
+            branch = micromodels.ModelField(Branch)
+
+        data = {'branch': {'leaf': {'name': 'a'},
+                           'leaves': [{'name': 'b'}, {'name': 'c'}]}}
+        tree = Tree.from_dict(data)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(tree.to_dict(serial=True), data)
+
+    def test_model_instance_kept(self):
+        """Assigning an instance of the nested class should not copy it"""
+        class User(micromodels.Model):
+            name = micromodels.CharField()
+
+        class Post(micromodels.Model):
+            author = micromodels.ModelField(User)
+            readers = micromodels.ModelCollectionField(User)
+
+        user = User.from_dict({'name': 'Eric'})
+        post = Post.from_dict({'author': user, 'readers': [user, {'name': 'Jo'}]})
+        self.assertTrue(post.author is user)
+        self.assertTrue(post.readers[0] is user)
+        self.assertEqual(post.readers[1].name, 'Jo')
+
+    def test_from_model_instance(self):
+        """from_dict should copy another instance, including sourced fields"""
+        class User(micromodels.Model):
+            name = micromodels.CharField(source='full_name')
+
+        class Post(micromodels.Model):
+            author = micromodels.ModelField(User)
+
+        post = Post.from_dict({'author': {'full_name': 'Eric'}})
+        copy = Post.from_dict(post)
+        self.assertTrue(copy is not post)
+        self.assertTrue(copy.author is post.author)
+        self.assertEqual(copy.author.name, 'Eric')
+
+    def test_from_model_instance_copies_lists(self):
+        """Copying an instance should not share its lists"""
+        class User(micromodels.Model):
+            name = micromodels.CharField()
+
+        class Post(micromodels.Model):
+            tags = micromodels.FieldCollectionField(micromodels.CharField())
+            readers = micromodels.ModelCollectionField(User)
+
+        post = Post.from_dict({'tags': ['a'], 'readers': [{'name': 'Jo'}]})
+        copy = Post.from_dict(post)
+        copy.tags.append(u'b')
+        copy.readers.append(User.from_dict({'name': 'Al'}))
+        self.assertEqual(post.tags, [u'a'])
+        self.assertEqual(len(post.readers), 1)
+        self.assertTrue(copy.readers[0] is post.readers[0])
+
 class ModelCollectionFieldTestCase(unittest.TestCase):
 
     def test_model_collection_field_creation(self):
@@ -286,6 +1452,426 @@ class ModelCollectionFieldTestCase(unittest.TestCase):
         processed = eric.to_dict(serial=True)
         self.assertEqual(processed, data)
 
+class IdentityMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class User(micromodels.Model):
+            _key = 'id'
+            _identity_size = 2
+            id = micromodels.IntegerField(source='user_id')
+            name = micromodels.CharField()
+
+        class Post(micromodels.Model):
+            author = micromodels.ModelField(User)
+            likes = micromodels.ModelCollectionField(User)
+
+        self.User, self.Post = User, Post
+
+    def user(self, id, name='jack'):
+        return {'user_id': id, 'name': name}
+
+    def test_shared(self):
+        posts = list(self.Post.from_dicts([
+            {'author': self.user(1), 'likes': [self.user(2), self.user(1)]},
+            {'author': self.user(1), 'likes': [self.user(2)]},
+        ]))
+        self.assertEqual(posts[0].author.name, u'jack')
+        self.assertIs(posts[0].author, posts[1].author)
+        self.assertIs(posts[0].author, posts[0].likes[1])
+        self.assertIs(posts[0].likes[0], posts[1].likes[0])
+        self.assertIsNot(self.User.from_dict(self.user(1)), posts[0].author)
+
+    def test_without_key(self):
+        first = self.Post.from_dict({'author': {'name': 'jack'}})
+        second = self.Post.from_dict({'author': {'name': 'jack'}})
+        self.assertIsNot(first.author, second.author)
+
+    def test_bounded(self):
+        first = self.Post.from_dict({'author': self.user(1)}).author
+        for id in (2, 3):
+            self.Post.from_dict({'author': self.user(id)})
+        self.assertIsNot(self.Post.from_dict({'author': self.user(1)}).author,
+                         first)
+        self.User.clear_identity_map()
+        self.assertEqual(len(self.User._get_identity_map()[0]), 0)
+
+    def test_conflict(self):
+        first = self.Post.from_dict({'author': self.user(1)}).author
+        self.assertRaises(ValueError, self.Post.from_dict,
+                          {'author': self.user(1, 'jill')})
+        self.User._key_conflict = 'keep'
+        self.assertIs(self.Post.from_dict(
+            {'author': self.user(1, 'jill')}).author, first)
+        self.User._key_conflict = 'replace'
+        second = self.Post.from_dict({'author': self.user(1, 'jill')}).author
+        self.assertEqual(second.name, u'jill')
+        self.assertIs(self.Post.from_dict(
+            {'author': self.user(1, 'jill')}).author, second)
+
+    def test_undeclared_and_missing_keys(self):
+        """Only the declared fields present in both dictionaries are compared"""
+        first = self.Post.from_dict({'author': self.user(1)}).author
+        extra = dict(self.user(1), profile_image_url='x')
+        self.assertIs(self.Post.from_dict({'author': extra}).author, first)
+        self.assertIs(self.Post.from_dict({'author': {'user_id': 1}}).author,
+                      first)
+
+    def test_invalid_key(self):
+        self.User._key = 'missing'
+        self.assertRaises(ValueError, self.Post.from_dict,
+                          {'author': self.user(1)})
+
+
+class ChangeTrackingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Profile(micromodels.Model):
+            name = micromodels.CharField()
+            age = micromodels.IntegerField(source='years')
+            born = micromodels.DateField('%Y-%m-%d', serial_format='%Y-%m-%d')
+            friends = micromodels.ModelCollectionField(Point)
+
+        class CompactProfile(micromodels.Model):
+            _compact = True
+            name = micromodels.CharField()
+            age = micromodels.IntegerField(source='years')
+
+        self.Profile, self.CompactProfile = Profile, CompactProfile
+        self.data = {'name': 'Ann', 'years': 30, 'born': '1990-01-02',
+                     'friends': [{'x': 1, 'y': 2}]}
+
+    def test_tracking(self):
+        for model in (self.Profile, self.CompactProfile):
+            profile = model.from_dict(self.data)
+            self.assertEqual(profile.changed_fields(), set())
+            self.assertEqual(profile.to_dict(changed_only=True), {})
+            profile.age = '31'
+            profile.note = 'not a field'
+            self.assertEqual(profile.changed_fields(), set(['age']))
+            self.assertEqual(profile.to_dict(serial=True, changed_only=True),
+                             {'age': 31})
+            self.assertEqual(profile.to_json(backend='json',
+                                             changed_only=True),
+                             '{"age": 31}')
+            profile.mark_clean()
+            self.assertEqual(profile.changed_fields(), set())
+        self.assertEqual(self.Profile().changed_fields(), set())
+
+    def test_serial(self):
+        profile = self.Profile.from_dict(self.data)
+        profile.born = date(1990, 3, 4)
+        self.assertEqual(profile.to_dict(serial=True, changed_only=True),
+                         {'born': '1990-03-04'})
+        profile.add_field('nickname', 'annie', micromodels.CharField())
+        self.assertEqual(profile.to_dict(changed_only=True),
+                         {'born': date(1990, 3, 4), 'nickname': u'annie'})
+
+    def test_set_data(self):
+        profile = self.Profile()
+        profile.set_data(self.data)
+        self.assertEqual(profile.changed_fields(), set())
+        profile.name = 'Bob'
+        profile.set_data({'years': 40, 'unknown': 1, 'name': None},
+                         delta=True)
+        self.assertEqual(profile.age, 40)
+        self.assertEqual(profile.name, u'')
+        self.assertEqual(profile.born, date(1990, 1, 2))
+        self.assertEqual(profile.changed_fields(), set(['age', 'name']))
+        self.assertFalse(hasattr(profile, 'unknown'))
+        profile.set_data('{"name": "Cy"}', is_json=True)
+        self.assertEqual(profile.changed_fields(), set())
+
+    def test_pickle(self):
+        point = Point.from_dict({'x': 1, 'y': 2})
+        point.label = 'moved'
+        restored = cPickle.loads(cPickle.dumps(point, 2))
+        self.assertEqual(restored.label, u'moved')
+        self.assertEqual(restored.changed_fields(), set())
+
+
+class JSONCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Owner(micromodels.Model):
+            name = micromodels.CharField()
+
+        class Pet(micromodels.Model):
+            _cache_json = True
+            name = micromodels.CharField()
+            owner = micromodels.ModelField(Owner)
+
+        class Shelter(micromodels.Model):
+            _cache_json = True
+            pets = micromodels.ModelCollectionField(Pet)
+            tags = micromodels.FieldCollectionField(micromodels.CharField())
+
+        self.Owner, self.Pet, self.Shelter = Owner, Pet, Shelter
+        self.shelter = Shelter.from_dict({
+            'pets': [{'name': 'Rex', 'owner': {'name': 'Ann'}}],
+            'tags': ['dogs']})
+
+    def decoded(self, instance, **kwargs):
+        return json.decode(instance.to_json(**kwargs))
+
+    def test_cached(self):
+        for kwargs in ({}, {'direct': True}, {'backend': 'json'}):
+            text = self.shelter.to_json(**kwargs)
+            self.assertIs(self.shelter.to_json(**kwargs), text)
+        self.assertEqual(len(self.shelter._json_texts), 3)
+        self.assertIsNot(self.Owner(), self.Owner().to_json())
+
+    def test_assignment(self):
+        pet = self.shelter.pets[0]
+        self.shelter.to_json()
+        pet.name = 'Max'
+        self.assertEqual(self.decoded(self.shelter)['pets'][0]['name'], 'Max')
+        pet.set_data({'name': 'Bo'})
+        self.assertEqual(self.decoded(self.shelter)['pets'][0]['name'], 'Bo')
+        self.shelter.add_field('city', 'Oslo', micromodels.CharField())
+        self.assertEqual(self.decoded(self.shelter)['city'], 'Oslo')
+        self.shelter.set_data({'tags': ['cats']})
+        self.assertEqual(self.decoded(self.shelter, direct=True)['tags'],
+                         ['cats'])
+
+    def test_nested(self):
+        owner = self.shelter.pets[0].owner
+        self.shelter.to_json(direct=True)
+        self.shelter.to_json()
+        owner.name = 'Bob'
+        for kwargs in ({}, {'direct': True}):
+            self.assertEqual(self.decoded(self.shelter, **kwargs)['pets'][0]
+                             ['owner']['name'], 'Bob')
+        self.assertEqual(owner.to_dict(), {'name': u'Bob'})
+
+    def test_nested_without_cache(self):
+        class Collar(micromodels.Model):
+            owner = micromodels.ModelField(self.Owner)
+
+        class Dog(micromodels.Model):
+            _cache_json = True
+            collar = micromodels.ModelField(Collar)
+
+        dog = Dog.from_dict({'collar': {'owner': {'name': 'bob'}}})
+        dog.to_json()
+        digest = dog.fingerprint()
+        dog.collar.owner.name = 'alice'
+        self.assertEqual(self.decoded(dog)['collar']['owner']['name'],
+                         'alice')
+        self.assertNotEqual(dog.fingerprint(), digest)
+        dog.collar.owner.name = 'carol'
+        self.assertEqual(self.decoded(dog, direct=True)['collar']['owner']
+                         ['name'], 'carol')
+
+    def test_equal_parents(self):
+        class Tag(micromodels.Model):
+            _cache_json = True
+            _hashable = True
+            owner = micromodels.ModelField(self.Owner)
+
+        owner = self.Owner.from_dict({'name': 'bob'})
+        first, second = [Tag.from_dict({'owner': owner}) for _ in range(2)]
+        self.assertEqual(first, second)
+        first.to_json()
+        second.to_json()
+        owner.name = 'alice'
+        for tag in (first, second):
+            self.assertEqual(self.decoded(tag)['owner']['name'], 'alice')
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+
+    def test_dropped_parents_forgotten(self):
+        class Tag(micromodels.Model):
+            _cache_json = True
+            owner = micromodels.ModelField(self.Owner)
+
+        owner = self.Owner.from_dict({'name': 'bob'})
+        for _ in range(10):
+            Tag.from_dict({'owner': owner}).to_json()
+        tag = Tag.from_dict({'owner': owner})
+        tag.to_json()
+        self.assertEqual(len(owner._parents), 1)
+
+    def test_in_place(self):
+        self.shelter.to_json()
+        self.shelter.tags.append('cats')
+        self.assertEqual(self.decoded(self.shelter)['tags'], ['dogs'])
+        self.shelter.clear_json_cache()
+        self.assertEqual(self.decoded(self.shelter)['tags'], ['dogs', 'cats'])
+
+    def test_state(self):
+        pet = self.shelter.pets[0]
+        self.shelter.to_json()
+        pet.to_json()
+        self.assertEqual(pet.__getstate__(), {'name': u'Rex',
+                                              'owner': pet.owner})
+        self.assertEqual(pet.owner.__getstate__(), {'name': u'Ann'})
+
+
+class ComparisonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Tag(micromodels.Model):
+            _hashable = True
+            name = micromodels.CharField()
+            aliases = micromodels.FieldCollectionField(micromodels.CharField())
+
+        class Photo(micromodels.Model):
+            url = micromodels.CharField()
+            tags = micromodels.ModelCollectionField(Tag)
+            taken = micromodels.DateTimeField('%Y-%m-%d')
+
+        self.Tag, self.Photo = Tag, Photo
+        self.data = {'url': 'a.png', 'taken': '2012-03-04',
+                     'tags': [{'name': 'sea', 'aliases': ['ocean']}]}
+
+    def test_eq(self):
+        first, second = [self.Photo.from_dict(self.data) for _ in range(2)]
+        self.assertTrue(first == second)
+        self.assertFalse(first != second)
+        second.url = 'b.png'
+        self.assertFalse(first == second)
+        self.assertTrue(first != second)
+        self.assertNotEqual(self.Tag.from_dict({'name': 'a.png'}),
+                            self.Photo.from_dict({'url': 'a.png'}))
+        self.assertNotEqual(first, None)
+
+    def test_subclass(self):
+        class NamedPhoto(self.Photo):
+            title = micromodels.CharField()
+        self.assertEqual(self.Photo.from_dict(self.data),
+                         self.Photo.from_dict(self.data))
+        self.assertNotEqual(NamedPhoto.from_dict({'title': 'a'}),
+                            NamedPhoto.from_dict({'title': 'b'}))
+
+    def test_hash(self):
+        tags = [self.Tag.from_dict({'name': name, 'aliases': ['x']})
+                for name in ('sea', 'sky', 'sea')]
+        self.assertEqual(hash(tags[0]), hash(tags[2]))
+        self.assertEqual(len(set(tags)), 2)
+
+    def test_hash_nested_not_hashable(self):
+        """Nested models are hashed by value even if not _hashable"""
+        class Album(micromodels.Model):
+            _hashable = True
+            cover = micromodels.ModelField(self.Photo)
+            photos = micromodels.ModelCollectionField(self.Photo)
+
+        data = {'cover': self.data, 'photos': [self.data, self.data]}
+        first, second = Album.from_dict(data), Album.from_dict(data)
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertEqual(len(set([first, second])), 1)
+        second.photos[1].url = 'b.png'
+        self.assertEqual(len(set([first, Album.from_dict(data)])), 1)
+        self.assertNotEqual(first, second)
+        photo = self.Photo.from_dict(self.data)
+        self.assertEqual(hash(photo), object.__hash__(photo))
+
+    def test_fingerprint(self):
+        first, second = [self.Photo.from_dict(self.data) for _ in range(2)]
+        digest = first.fingerprint()
+        self.assertEqual(len(digest), 40)
+        self.assertEqual(digest, second.fingerprint())
+        self.assertIs(first.fingerprint(), digest)
+        first.tags[0].name = 'lake'
+        self.assertNotEqual(first.fingerprint(), digest)
+        first.tags[0].name = 'sea'
+        self.assertEqual(first.fingerprint(), digest)
+        first.tags[0].aliases.append('water')
+        first.tags[0].clear_json_cache()
+        self.assertNotEqual(first.fingerprint(), digest)
+
+
+class InheritanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        class Base(micromodels.Model):
+            id = micromodels.IntegerField()
+            name = micromodels.CharField()
+            note = micromodels.CharField()
+
+        class Child(Base):
+            name = micromodels.CharField(source='title')
+            note = None
+            age = micromodels.IntegerField()
+
+        class Mixin(micromodels.Model):
+            id = micromodels.CharField()
+            color = micromodels.CharField()
+
+        class Mixed(Mixin, Child):
+            pass
+
+        self.Base, self.Child, self.Mixed = Base, Child, Mixed
+
+    def test_fields(self):
+        self.assertEqual(sorted(self.Child._clsfields), ['age', 'id', 'name'])
+        self.assertIs(self.Child._fields, self.Child._clsfields)
+        self.assertEqual(sorted(self.Mixed._fields),
+                         ['age', 'color', 'id', 'name'])
+        self.assertIsInstance(self.Mixed._fields['id'], micromodels.CharField)
+        self.assertEqual(sorted(self.Base._clsfields), ['id', 'name', 'note'])
+
+    def test_decode(self):
+        data = {'id': 3, 'title': 'Ann', 'name': 'ignored', 'age': '30'}
+        for child in (self.Child.from_dict(data), self.Child()):
+            child.set_data(data)
+            self.assertEqual((child.id, child.name, child.age),
+                             (3, u'Ann', 30))
+            self.assertEqual(child.to_dict(), {'id': 3, 'name': u'Ann',
+                                               'age': 30})
+        self.assertEqual(self.Mixed.from_dict(data).id, u'3')
+
+    def test_diamond(self):
+        class A(micromodels.Model):
+            f = micromodels.CharField()
+            g = micromodels.CharField()
+
+        class B(A):
+            pass
+
+        class C(A):
+            f = micromodels.IntegerField()
+            g = None
+
+        class D(B, C):
+            pass
+
+        self.assertIsInstance(D._fields['f'], micromodels.IntegerField)
+        self.assertEqual(sorted(D._fields), ['f'])
+        self.assertEqual(D.from_dict({'f': '5', 'g': 'x'}).f, 5)
+
+    def test_compact(self):
+        class CompactBase(micromodels.Model):
+            _compact = True
+            x = micromodels.IntegerField()
+
+        class CompactChild(CompactBase):
+            y = micromodels.IntegerField()
+
+        self.assertEqual(CompactChild.__slots__, ('y',))
+        child = CompactChild.from_dict({'x': 1, 'y': 2})
+        self.assertEqual((child.x, child.y), (1, 2))
+        self.assertFalse(child.__dict__)
+
+    def test_sparse(self):
+        attrs = dict(('field_%d' % index, micromodels.IntegerField())
+                     for index in range(10))
+        attrs['created'] = micromodels.DateField('%Y-%m-%d', source='date')
+        attrs['updated'] = micromodels.DateField('%Y-%m-%d', source='date')
+        Wide = type('Wide', (micromodels.Model,), attrs)
+        full = dict(('field_%d' % index, index) for index in range(10))
+        full['date'] = '2012-01-02'
+        for data in ({'date': '2012-01-02', 'other': 1}, full):
+            instance = Wide()
+            instance.set_data(data)
+            self.assertEqual(instance.created, date(2012, 1, 2))
+            self.assertEqual(instance.updated, date(2012, 1, 2))
+        self.assertEqual(instance.field_9, 9)
+        instance.set_data({'date': '2013-01-02'}, delta=True)
+        self.assertEqual(instance.changed_fields(),
+                         set(['created', 'updated']))
+
+
 class FieldCollectionFieldTestCase(unittest.TestCase):
 
     def test_field_collection_field_creation(self):
@@ -379,5 +1965,36 @@ class ModelTestCase(unittest.TestCase):
         self.assertEqual(instance.to_dict()['birthday'], today)
 
 
+class ImportTestCase(unittest.TestCase):
+    """``import micromodels`` must not load the dependencies of the fields
+    and methods that aren't used yet.
+
+    """
+    DEFERRED = ['base64', 'calendar', 'cPickle', 'email.utils', 'json',
+                'multiprocessing', 'numpy', '_strptime', 'threading', 'pytz',
+                'mx.DateTime', 'cjson', 'ujson', 'simplejson']
+
+    def loaded_after(self, code):
+        script = ('import sys\n%s\nprint " ".join(name for name in %r '
+                  'if name in sys.modules)' % (code, self.DEFERRED))
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.split()
+
+    def test_import(self):
+        self.assertEqual(self.loaded_after('import micromodels'), [])
+
+    def test_loaded_on_use(self):
+        loaded = self.loaded_after(
+            'import micromodels\n'
+            'class Sample(micromodels.Model):\n'
+            '    created = micromodels.DateTimeField(format="%Y-%m-%d")\n'
+            'Sample.from_dict({"created": "2012-01-01"}).to_binary()')
+        self.assertIn('_strptime', loaded)
+        self.assertIn('base64', loaded)
+        self.assertNotIn('multiprocessing', loaded)
+
+
 if __name__ == "__main__":
     unittest.main()